@@ -0,0 +1,102 @@
+"""Init migration
+
+Начальная схема БД - таблицы в том виде, в каком их создавало
+приложение до появления миграций. Существующая база помечается
+этой ревизией (alembic stamp 5b0f3c2e9a41) и обновляется следующими.
+
+Revision ID: 5b0f3c2e9a41
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "5b0f3c2e9a41"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(), nullable=True),
+        sa.Column("api_key", sa.String(), nullable=True),
+        sa.Column("password", sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_users_api_key"), "users", ["api_key"], unique=True
+    )
+    op.create_index(op.f("ix_users_id"), "users", ["id"], unique=True)
+    op.create_index(op.f("ix_users_name"), "users", ["name"], unique=False)
+    op.create_index(
+        op.f("ix_users_password"), "users", ["password"], unique=False
+    )
+    op.create_table(
+        "followers",
+        sa.Column("following_user_id", sa.Integer(), nullable=False),
+        sa.Column("followed_user_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["followed_user_id"], ["users.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["following_user_id"], ["users.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("following_user_id", "followed_user_id"),
+    )
+    op.create_table(
+        "tweets",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("content", sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_tweets_content"), "tweets", ["content"], unique=False
+    )
+    op.create_index(op.f("ix_tweets_id"), "tweets", ["id"], unique=False)
+    op.create_table(
+        "medias",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("tweet_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_medias_id"), "medias", ["id"], unique=False)
+    op.create_table(
+        "likes",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column("tweet_id", sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "user_id", "tweet_id", name="_unique_who_tweet_likes"
+        ),
+    )
+    op.create_index(op.f("ix_likes_id"), "likes", ["id"], unique=False)
+    op.create_index(
+        op.f("ix_likes_tweet_id"), "likes", ["tweet_id"], unique=False
+    )
+    op.create_index(
+        op.f("ix_likes_user_id"), "likes", ["user_id"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("likes")
+    op.drop_table("medias")
+    op.drop_table("tweets")
+    op.drop_table("followers")
+    op.drop_table("users")
@@ -0,0 +1,296 @@
+"""Counters, feed, search and sync
+
+Изменения схемы после начальной: денормализованные счетчики
+(likes_count, followers_count) и их заполнение по существующим
+лайкам и подпискам, флаг fanout_on_read, материализованные ленты
+и их заполнение последними твитами авторов по существующим
+подпискам, полнотекстовый поиск,
+хэштеги и упоминания, журнал изменений, владелец и варианты медиа,
+индексы горячих запросов. Хэштеги и упоминания уже опубликованных
+твитов разбираются отдельно: python -m project.tweets.jobs
+backfill-entities.
+
+Revision ID: 8d2a7c41f6b3
+Revises: 5b0f3c2e9a41
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "8d2a7c41f6b3"
+down_revision = "5b0f3c2e9a41"
+branch_labels = None
+depends_on = None
+
+# Порог подписчиков, с которого лента автора собирается при чтении
+# (project.timelines.services.FANOUT_ON_READ_THRESHOLD на момент
+# создания ревизии).
+FANOUT_ON_READ_THRESHOLD = 10000
+# Сколько последних твитов автора попадает в ленту подписчика
+# (project.timelines.services.TIMELINE_BACKFILL_LIMIT на момент
+# создания ревизии).
+TIMELINE_BACKFILL_LIMIT = 200
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users",
+        sa.Column(
+            "followers_count",
+            sa.Integer(),
+            server_default="0",
+            nullable=False,
+        ),
+    )
+    op.add_column(
+        "users",
+        sa.Column(
+            "fanout_on_read",
+            sa.Boolean(),
+            server_default="false",
+            nullable=False,
+        ),
+    )
+    op.drop_index("ix_users_password", table_name="users")
+
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "likes_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed(
+                "to_tsvector('russian'::regconfig, coalesce(content, ''))",
+                persisted=True,
+            ),
+            nullable=True,
+        ),
+    )
+    op.drop_index("ix_tweets_content", table_name="tweets")
+    op.create_index(
+        "ix_tweets_user_id_popularity",
+        "tweets",
+        ["user_id", sa.text("likes_count DESC"), sa.text("id DESC")],
+        unique=False,
+    )
+    op.create_index(
+        "ix_tweets_search_vector",
+        "tweets",
+        ["search_vector"],
+        unique=False,
+        postgresql_using="gin",
+    )
+
+    op.add_column("medias", sa.Column("renditions", sa.JSON(), nullable=True))
+    op.add_column("medias", sa.Column("user_id", sa.Integer(), nullable=True))
+    op.create_foreign_key(
+        "medias_user_id_fkey",
+        "medias",
+        "users",
+        ["user_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+    op.create_index(
+        op.f("ix_medias_tweet_id"), "medias", ["tweet_id"], unique=False
+    )
+    op.create_index(
+        op.f("ix_medias_user_id"), "medias", ["user_id"], unique=False
+    )
+
+    op.drop_index("ix_likes_tweet_id", table_name="likes")
+    op.create_index(
+        "ix_likes_tweet_id_id", "likes", ["tweet_id", "id"], unique=False
+    )
+
+    op.create_index(
+        "ix_followers_followed_user_id",
+        "followers",
+        ["followed_user_id"],
+        unique=False,
+    )
+
+    op.create_table(
+        "timelines",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("tweet_id", sa.Integer(), nullable=False),
+        sa.Column("author_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["author_id"], ["users.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id", "tweet_id"),
+    )
+    op.create_index(
+        "ix_timelines_tweet_id", "timelines", ["tweet_id"], unique=False
+    )
+    op.create_index(
+        "ix_timelines_user_id_author_id",
+        "timelines",
+        ["user_id", "author_id"],
+        unique=False,
+    )
+    op.create_table(
+        "hashtags",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("name"),
+    )
+    op.create_table(
+        "tweet_hashtags",
+        sa.Column("hashtag_id", sa.Integer(), nullable=False),
+        sa.Column("tweet_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["hashtag_id"], ["hashtags.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("hashtag_id", "tweet_id"),
+    )
+    op.create_index(
+        "ix_tweet_hashtags_tweet_id",
+        "tweet_hashtags",
+        ["tweet_id"],
+        unique=False,
+    )
+    op.create_table(
+        "mentions",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("tweet_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id", "tweet_id"),
+    )
+    op.create_index(
+        "ix_mentions_tweet_id", "mentions", ["tweet_id"], unique=False
+    )
+    op.create_table(
+        "changes",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "version",
+            sa.BigInteger(),
+            server_default=sa.text("(pg_current_xact_id()::text)::bigint"),
+            nullable=False,
+        ),
+        sa.Column("kind", sa.String(), nullable=False),
+        sa.Column("entity_id", sa.Integer(), nullable=False),
+        sa.Column("author_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_changes_author_id_version",
+        "changes",
+        ["author_id", "version"],
+        unique=False,
+    )
+    op.create_index("ix_changes_version", "changes", ["version"], unique=False)
+
+    # Заполнение по данным, накопленным до ревизии
+    op.execute(
+        """
+        UPDATE tweets SET likes_count = counts.likes_count
+        FROM (
+            SELECT tweet_id, count(*) AS likes_count
+            FROM likes GROUP BY tweet_id
+        ) AS counts
+        WHERE tweets.id = counts.tweet_id
+        """
+    )
+    op.execute(
+        f"""
+        UPDATE users
+        SET followers_count = counts.followers_count,
+            fanout_on_read = counts.followers_count
+                >= {FANOUT_ON_READ_THRESHOLD}
+        FROM (
+            SELECT followed_user_id, count(*) AS followers_count
+            FROM followers GROUP BY followed_user_id
+        ) AS counts
+        WHERE users.id = counts.followed_user_id
+        """
+    )
+    op.execute(
+        """
+        UPDATE medias SET user_id = tweets.user_id
+        FROM tweets
+        WHERE tweets.id = medias.tweet_id
+        """
+    )
+    op.execute(
+        f"""
+        INSERT INTO timelines (user_id, tweet_id, author_id)
+        SELECT followers.following_user_id, recent.id, users.id
+        FROM followers
+        JOIN users ON users.id = followers.followed_user_id
+        CROSS JOIN LATERAL (
+            SELECT tweets.id FROM tweets
+            WHERE tweets.user_id = followers.followed_user_id
+            ORDER BY tweets.id DESC
+            LIMIT {TIMELINE_BACKFILL_LIMIT}
+        ) AS recent
+        WHERE NOT users.fanout_on_read
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_changes_version", table_name="changes")
+    op.drop_index("ix_changes_author_id_version", table_name="changes")
+    op.drop_table("changes")
+    op.drop_index("ix_mentions_tweet_id", table_name="mentions")
+    op.drop_table("mentions")
+    op.drop_index("ix_tweet_hashtags_tweet_id", table_name="tweet_hashtags")
+    op.drop_table("tweet_hashtags")
+    op.drop_table("hashtags")
+    op.drop_index("ix_timelines_user_id_author_id", table_name="timelines")
+    op.drop_index("ix_timelines_tweet_id", table_name="timelines")
+    op.drop_table("timelines")
+
+    op.drop_index("ix_followers_followed_user_id", table_name="followers")
+
+    op.drop_index("ix_likes_tweet_id_id", table_name="likes")
+    op.create_index(
+        op.f("ix_likes_tweet_id"), "likes", ["tweet_id"], unique=False
+    )
+
+    op.drop_index(op.f("ix_medias_user_id"), table_name="medias")
+    op.drop_index(op.f("ix_medias_tweet_id"), table_name="medias")
+    op.drop_constraint("medias_user_id_fkey", "medias", type_="foreignkey")
+    op.drop_column("medias", "user_id")
+    op.drop_column("medias", "renditions")
+
+    op.drop_index("ix_tweets_search_vector", table_name="tweets")
+    op.drop_index("ix_tweets_user_id_popularity", table_name="tweets")
+    op.create_index(
+        op.f("ix_tweets_content"), "tweets", ["content"], unique=False
+    )
+    op.drop_column("tweets", "search_vector")
+    op.drop_column("tweets", "likes_count")
+
+    op.create_index(
+        op.f("ix_users_password"), "users", ["password"], unique=False
+    )
+    op.drop_column("users", "fanout_on_read")
+    op.drop_column("users", "followers_count")
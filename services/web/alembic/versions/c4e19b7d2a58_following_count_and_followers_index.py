@@ -0,0 +1,63 @@
+"""Following count and followers index
+
+Денормализованный счетчик подписок users.following_count
+с заполнением по существующим подпискам. Индекс подписчиков
+дополняется id подписчика: страницы подписчиков читаются
+по индексу без сортировки.
+
+Revision ID: c4e19b7d2a58
+Revises: 8d2a7c41f6b3
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "c4e19b7d2a58"
+down_revision = "8d2a7c41f6b3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users",
+        sa.Column(
+            "following_count",
+            sa.Integer(),
+            server_default="0",
+            nullable=False,
+        ),
+    )
+    op.execute(
+        """
+        UPDATE users SET following_count = counts.following_count
+        FROM (
+            SELECT following_user_id, count(*) AS following_count
+            FROM followers GROUP BY following_user_id
+        ) AS counts
+        WHERE users.id = counts.following_user_id
+        """
+    )
+    op.create_index(
+        "ix_followers_followed_user_id_following_user_id",
+        "followers",
+        ["followed_user_id", "following_user_id"],
+        unique=False,
+    )
+    op.drop_index("ix_followers_followed_user_id", table_name="followers")
+
+
+def downgrade() -> None:
+    op.create_index(
+        "ix_followers_followed_user_id",
+        "followers",
+        ["followed_user_id"],
+        unique=False,
+    )
+    op.drop_index(
+        "ix_followers_followed_user_id_following_user_id",
+        table_name="followers",
+    )
+    op.drop_column("users", "following_count")
@@ -0,0 +1,46 @@
+"""Timeline likes count
+
+Копия счетчика лайков твита в строках материализованной ленты
+и индекс ленты по популярности: страница ленты читается одним
+диапазоном индекса без сортировки.
+
+Revision ID: e5b83a9c1d27
+Revises: c4e19b7d2a58
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "e5b83a9c1d27"
+down_revision = "c4e19b7d2a58"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "timelines",
+        sa.Column(
+            "likes_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.execute(
+        """
+        UPDATE timelines SET likes_count = tweets.likes_count
+        FROM tweets
+        WHERE tweets.id = timelines.tweet_id AND tweets.likes_count <> 0
+        """
+    )
+    op.create_index(
+        "ix_timelines_user_id_popularity",
+        "timelines",
+        ["user_id", sa.text("likes_count DESC"), sa.text("tweet_id DESC")],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_timelines_user_id_popularity", table_name="timelines")
+    op.drop_column("timelines", "likes_count")
@@ -0,0 +1,43 @@
+"""Idempotency keys
+
+Ответы POST-запросов с заголовком Idempotency-Key хранятся в БД:
+ключ занимается одним INSERT ... ON CONFLICT, атомарно для всех
+воркеров.
+
+Revision ID: f27a6d4b9c13
+Revises: e5b83a9c1d27
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "f27a6d4b9c13"
+down_revision = "e5b83a9c1d27"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "idempotency_keys",
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("request_hash", sa.String(), nullable=True),
+        sa.Column("response", sa.JSON(), nullable=True),
+        sa.Column("expires_at", sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint("key"),
+    )
+    op.create_index(
+        "ix_idempotency_keys_expires_at",
+        "idempotency_keys",
+        ["expires_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "ix_idempotency_keys_expires_at", table_name="idempotency_keys"
+    )
+    op.drop_table("idempotency_keys")
@@ -0,0 +1,74 @@
+"""
+compare.py
+----------
+Сравнение двух сохраненных прогонов run.py по перцентилям задержек,
+пропускной способности и числу SQL-запросов на запрос.
+
+Пример:
+    python -m benchmarks.compare benchmarks/results/base.json \\
+        benchmarks/results/latest.json
+
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import Optional
+
+METRICS = ("p50_ms", "p95_ms", "p99_ms", "mean_ms")
+
+
+def delta(before: Optional[float], after: Optional[float]) -> str:
+    if not before or after is None:
+        return "n/a"
+    return f"{100 * (after - before) / before:+.1f}%"
+
+
+def row(label: str, before, after) -> str:
+    return (
+        f"{label:<45} {before!s:>12} {after!s:>12} {delta(before, after):>9}"
+    )
+
+
+def compare(base: dict, head: dict) -> str:
+    lines = [f"{'metric':<45} {'base':>12} {'head':>12} {'delta':>9}"]
+    lines.append(
+        row("throughput_rps", base["throughput_rps"], head["throughput_rps"])
+    )
+    lines.append(
+        row(
+            "queries_per_request",
+            base.get("queries_per_request"),
+            head.get("queries_per_request"),
+        )
+    )
+    for metric in METRICS:
+        lines.append(
+            row(
+                f"total {metric}", base["total"][metric], head["total"][metric]
+            )
+        )
+    for label, stats in head["operations"].items():
+        base_stats = base["operations"].get(label, {})
+        for metric in ("p50_ms", "p99_ms"):
+            lines.append(
+                row(f"{label} {metric}", base_stats.get(metric), stats[metric])
+            )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("base", type=Path)
+    parser.add_argument("head", type=Path)
+    args = parser.parse_args()
+    print(
+        compare(
+            json.loads(args.base.read_text()),
+            json.loads(args.head.read_text()),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+datagen.py
+----------
+Генератор тестовых данных для нагрузочных прогонов: N пользователей,
+граф подписок со степенным распределением популярности, M твитов
+и лайки, сосредоточенные на популярных твитах.
+
+"""
+
+import random
+from typing import Dict, List, Sequence
+
+from sqlalchemy import func, insert, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from project.database import Like, Tweet, User, followers, timelines
+from project.timelines.services import FANOUT_ON_READ_THRESHOLD
+
+API_KEY_PREFIX = "bench-"
+BATCH_SIZE = 5000
+
+
+def power_law_weights(n: int, alpha: float) -> List[float]:
+    # Вес элемента ранга r пропорционален 1 / r^alpha (закон Ципфа)
+    return [1.0 / (rank**alpha) for rank in range(1, n + 1)]
+
+
+def sample_distinct(
+    rng: random.Random,
+    population: Sequence[int],
+    weights: Sequence[float],
+    k: int,
+) -> set:
+    k = min(k, len(population))
+    chosen: set = set()
+    while len(chosen) < k:
+        chosen.update(rng.choices(population, weights=weights, k=k))
+    return set(list(chosen)[:k])
+
+
+async def insert_batches(session: AsyncSession, table, rows: List[Dict]):
+    for start in range(0, len(rows), BATCH_SIZE):
+        end = start + BATCH_SIZE
+        await session.execute(insert(table), rows[start:end])
+
+
+async def generate(
+    session: AsyncSession,
+    users: int = 1000,
+    tweets: int = 10000,
+    avg_follows: int = 30,
+    avg_likes: int = 5,
+    alpha: float = 1.1,
+    seed: int = 42,
+) -> Dict[str, int]:
+    """
+    Заполняет пустую базу данными и пересчитывает денормализованные
+    счетчики и материализованные ленты
+
+    :return: Dict[str, int]
+        Число созданных строк по таблицам
+    """
+    rng = random.Random(seed)
+
+    await insert_batches(
+        session,
+        User.__table__,
+        [
+            {
+                "name": f"user{i}",
+                "api_key": f"{API_KEY_PREFIX}{i}",
+                "password": "bench",
+            }
+            for i in range(users)
+        ],
+    )
+    q = await session.execute(select(User.id).order_by(User.id))
+    user_ids = q.scalars().all()
+    popularity = power_law_weights(len(user_ids), alpha)
+
+    follow_rows = []
+    for user_id in user_ids:
+        count = max(1, int(rng.expovariate(1 / avg_follows)))
+        for followed_id in sample_distinct(
+            rng, user_ids, popularity, count
+        ) - {user_id}:
+            follow_rows.append(
+                {"following_user_id": user_id, "followed_user_id": followed_id}
+            )
+    await insert_batches(session, followers, follow_rows)
+
+    author_ids = rng.choices(user_ids, weights=popularity, k=tweets)
+    await insert_batches(
+        session,
+        Tweet.__table__,
+        [
+            {"user_id": author_id, "content": f"bench tweet {i} #tag{i % 50}"}
+            for i, author_id in enumerate(author_ids)
+        ],
+    )
+    q = await session.execute(select(Tweet.id).order_by(Tweet.id))
+    tweet_ids = q.scalars().all()
+    tweet_popularity = power_law_weights(len(tweet_ids), alpha)
+    rng.shuffle(tweet_popularity)
+
+    like_rows = []
+    for user_id in user_ids:
+        count = int(rng.expovariate(1 / avg_likes))
+        for tweet_id in sample_distinct(
+            rng, tweet_ids, tweet_popularity, count
+        ):
+            like_rows.append({"user_id": user_id, "tweet_id": tweet_id})
+    await insert_batches(session, Like.__table__, like_rows)
+
+    await rebuild_denormalized(session)
+    await session.commit()
+
+    return {
+        "users": len(user_ids),
+        "followers": len(follow_rows),
+        "tweets": len(tweet_ids),
+        "likes": len(like_rows),
+    }
+
+
+async def rebuild_denormalized(session: AsyncSession):
+    followers_count = (
+        select(func.count())
+        .where(followers.c.followed_user_id == User.id)
+        .scalar_subquery()
+    )
+    following_count = (
+        select(func.count())
+        .where(followers.c.following_user_id == User.id)
+        .scalar_subquery()
+    )
+    await session.execute(
+        update(User).values(
+            followers_count=followers_count,
+            following_count=following_count,
+            fanout_on_read=followers_count >= FANOUT_ON_READ_THRESHOLD,
+        )
+    )
+    likes_count = (
+        select(func.count()).where(Like.tweet_id == Tweet.id).scalar_subquery()
+    )
+    await session.execute(update(Tweet).values(likes_count=likes_count))
+    await session.execute(
+        insert(timelines).from_select(
+            ["user_id", "tweet_id", "author_id", "likes_count"],
+            select(
+                followers.c.following_user_id,
+                Tweet.id,
+                Tweet.user_id,
+                Tweet.likes_count,
+            )
+            .join(Tweet, Tweet.user_id == followers.c.followed_user_id)
+            .join(User, User.id == Tweet.user_id)
+            .where(User.fanout_on_read.is_(False)),
+        )
+    )
+    await session.execute(text("ANALYZE"))
@@ -0,0 +1,93 @@
+"""
+importtime.py
+----------
+Время импорта модулей приложения по python -X importtime: каждый
+замер - отдельный процесс, поэтому кеш модулей не влияет на результат.
+Результат - медиана суммарного времени импорта и модули с наибольшим
+собственным временем. Без базы данных.
+
+Пример:
+    python -m benchmarks.importtime --module project.main --repeat 5
+
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# Каталог services/web, из которого импортируется project.
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """
+    Строки вывода -X importtime: (модуль, собственное время,
+    время с вложенными импортами), микросекунды
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        if not self_us.strip().isdigit():
+            continue
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def measure_import(module: str, code: str = "") -> Dict[str, object]:
+    """
+    Импортирует module в новом процессе и выполняет code
+
+    :return: Dict[str, object]
+        total_ms - время импорта module с вложенными, modules - строки
+        вывода -X importtime
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}\n{code}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = parse_importtime(result.stderr)
+    total = next(cumulative for name, _, cumulative in rows if name == module)
+    return {"total_ms": total / 1000, "modules": rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--module", default="project.main")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    runs = [measure_import(args.module) for _ in range(args.repeat)]
+    slowest = sorted(
+        (row for row in runs[-1]["modules"] if row[0].startswith("project")),
+        key=lambda row: row[1],
+        reverse=True,
+    )
+    print(
+        json.dumps(
+            {
+                "module": args.module,
+                "total_ms_median": round(
+                    statistics.median(run["total_ms"] for run in runs), 1
+                ),
+                "slowest_project_modules_ms": {
+                    name: round(self_us / 1000, 1)
+                    for name, self_us, _ in slowest[: args.top]
+                },
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+serialization.py
+----------
+Сравнение сериализации страницы ленты без базы данных:
+- fastapi: валидация по response_model=Union[TweetListOutSchema,
+  ErrorSchema], jsonable_encoder и json из стандартной библиотеки;
+- orjson: FastJSONResponse для собранных сервисом словарей;
+- fragments: склейка уже закодированных фрагментов твитов из кеша.
+Результат - микросекунды на килобайт ответа и экономия
+относительно fastapi.
+
+Пример:
+    python -m benchmarks.serialization --tweets 200
+
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Callable, Dict, List, Union
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from project.responses import FastJSONResponse, dumps, dumps_str
+from project.schemas_overal import ErrorSchema
+from project.tweets.schemas import TweetListOutSchema
+
+
+def make_page(tweets: int) -> Dict:
+    return {
+        "result": True,
+        "tweets": [
+            {
+                "id": tweet_id,
+                "content": "Твит номер {} про нагрузочное тестирование".format(
+                    tweet_id
+                ),
+                "attachments": [
+                    f"/static/media_files/{tweet_id:060x}{n:04x}_feed.webp"
+                    for n in range(tweet_id % 3)
+                ],
+                "author": {
+                    "id": tweet_id % 97,
+                    "name": f"user{tweet_id % 97}",
+                },
+                "likes": [
+                    {"user_id": user_id, "name": f"user{user_id}"}
+                    for user_id in range(tweet_id % 21)
+                ],
+                "likes_count": tweet_id % 21,
+            }
+            for tweet_id in range(1, tweets + 1)
+        ],
+        "next_cursor": "WzEwLDEyMzRd",
+    }
+
+
+RESPONSE_FIELD = create_response_field(
+    name="response", type_=Union[TweetListOutSchema, ErrorSchema]
+)
+
+
+async def encode_fastapi(page: Dict) -> bytes:
+    content = await serialize_response(
+        field=RESPONSE_FIELD, response_content=page
+    )
+    return JSONResponse(content=jsonable_encoder(content)).body
+
+
+async def encode_orjson(page: Dict) -> bytes:
+    return FastJSONResponse(content=page).body
+
+
+def fragments_encoder(page: Dict) -> Callable:
+    fragments = [dumps_str(tweet) for tweet in page["tweets"]]
+
+    async def encode(_: Dict) -> bytes:
+        return FastJSONResponse(
+            content=b"".join(
+                (
+                    b'{"result":true,"tweets":[',
+                    ",".join(fragments).encode(),
+                    b'],"next_cursor":',
+                    dumps(page["next_cursor"]),
+                    b"}",
+                )
+            )
+        ).body
+
+    return encode
+
+
+async def measure(encode: Callable, page: Dict, repeat: int) -> Dict:
+    body = await encode(page)
+    timings: List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await encode(page)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {
+        "kb": round(len(body) / 1024, 1),
+        "best_ms": round(best * 1000, 3),
+        "us_per_kb": round(1e6 * best / (len(body) / 1024), 3),
+        "decoded": json.loads(body),
+    }
+
+
+async def main_async(args):
+    page = make_page(args.tweets)
+    encoders = {
+        "fastapi": encode_fastapi,
+        "orjson": encode_orjson,
+        "fragments": fragments_encoder(page),
+    }
+    results = {
+        name: await measure(encode, page, args.repeat)
+        for name, encode in encoders.items()
+    }
+
+    baseline = results["fastapi"]
+    expected = baseline["decoded"]
+    for result in results.values():
+        # Все способы должны давать один и тот же JSON
+        assert result.pop("decoded") == expected
+        result["us_per_kb_saved"] = round(
+            baseline["us_per_kb"] - result["us_per_kb"], 3
+        )
+    print(json.dumps(results, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tweets", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=50)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+workloads.py
+----------
+Сценарии нагрузки: набор операций с весами. Каждая операция по
+генератору случайных чисел и контексту данных строит HTTP-запрос.
+
+"""
+
+import random
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Sequence
+
+from .datagen import API_KEY_PREFIX, power_law_weights
+
+
+@dataclass
+class DataContext:
+    """
+    Сведения о сгенерированных данных, нужные для построения запросов
+    """
+
+    users: int
+    tweet_ids: Sequence[int]
+    alpha: float = 1.1
+
+    def __post_init__(self):
+        self.tweet_weights = power_law_weights(len(self.tweet_ids), self.alpha)
+
+    def api_key(self, rng: random.Random) -> str:
+        return f"{API_KEY_PREFIX}{rng.randrange(self.users)}"
+
+    def user_id(self, rng: random.Random) -> int:
+        return rng.randint(1, self.users)
+
+    def hot_tweet(self, rng: random.Random) -> int:
+        return rng.choices(self.tweet_ids, weights=self.tweet_weights)[0]
+
+
+@dataclass
+class Operation:
+    label: str
+    weight: float
+    build: Callable[[random.Random, DataContext], Dict]
+
+
+def _png(width: int = 64, height: int = 64) -> bytes:
+    # Минимальный PNG без зависимостей: серое изображение без фильтров
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        body = kind + data
+        return (
+            len(data).to_bytes(4, "big")
+            + body
+            + zlib.crc32(body).to_bytes(4, "big")
+        )
+
+    header = (
+        width.to_bytes(4, "big")
+        + height.to_bytes(4, "big")
+        + b"\x08\x00\0\0\0"
+    )
+    raw = b"".join(b"\x00" + b"\x80" * width for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+PNG_BYTES = _png()
+
+
+def get_feed(rng, ctx):
+    return {
+        "method": "GET",
+        "url": "/api/tweets/",
+        "headers": {"api-key": ctx.api_key(rng)},
+    }
+
+
+def get_tweet(rng, ctx):
+    return {"method": "GET", "url": f"/api/tweets/{ctx.hot_tweet(rng)}"}
+
+
+def get_user(rng, ctx):
+    return {"method": "GET", "url": f"/api/users/{ctx.user_id(rng)}"}
+
+
+def post_tweet(rng, ctx):
+    return {
+        "method": "POST",
+        "url": "/api/tweets/",
+        "headers": {"api-key": ctx.api_key(rng)},
+        "json": {"tweet_data": f"bench {rng.random()}"},
+    }
+
+
+def toggle_like(rng, ctx):
+    return {
+        "method": rng.choice(("POST", "DELETE")),
+        "url": f"/api/tweets/{ctx.hot_tweet(rng)}/likes",
+        "headers": {"api-key": ctx.api_key(rng)},
+    }
+
+
+def upload_image(rng, ctx):
+    return {
+        "method": "POST",
+        "url": "/api/medias/",
+        "headers": {"api-key": ctx.api_key(rng)},
+        "files": {"file": ("bench.png", PNG_BYTES, "image/png")},
+    }
+
+
+WORKLOADS: Dict[str, List[Operation]] = {
+    "feed": [
+        Operation("GET /api/tweets", 0.8, get_feed),
+        Operation("GET /api/tweets/{id}", 0.15, get_tweet),
+        Operation("GET /api/users/{id}", 0.05, get_user),
+    ],
+    "likes": [
+        Operation("POST|DELETE /api/tweets/{id}/likes", 0.9, toggle_like),
+        Operation("GET /api/tweets/{id}", 0.1, get_tweet),
+    ],
+    "uploads": [
+        Operation("POST /api/medias", 0.7, upload_image),
+        Operation("POST /api/tweets", 0.3, post_tweet),
+    ],
+    "mixed": [
+        Operation("GET /api/tweets", 0.6, get_feed),
+        Operation("GET /api/tweets/{id}", 0.15, get_tweet),
+        Operation("POST|DELETE /api/tweets/{id}/likes", 0.15, toggle_like),
+        Operation("POST /api/tweets", 0.05, post_tweet),
+        Operation("POST /api/medias", 0.05, upload_image),
+    ],
+}
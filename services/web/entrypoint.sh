@@ -1,4 +1,9 @@
 #!/bin/sh
+# Режимы запуска:
+#   migrate - применить миграции и выйти (повторный запуск ничего не меняет)
+#   web     - production: gunicorn с воркерами uvicorn, см. gunicorn.conf.py
+#   dev     - миграции и один uvicorn с перезагрузкой при изменении кода
+# Любая другая команда выполняется как есть.
 
 if [ "$DATABASE" = "postgres" ]
 then
@@ -10,12 +15,17 @@ then
     echo "PostgreSQL started"
 fi
 
-mkdir -p alembic/versions
-alembic revision --message="Init migration" --autogenerate
-alembic upgrade head
-
-uvicorn project.main:app --port=1111 --host='0.0.0.0' --reload
-
-
+case "$1" in
+    migrate)
+        exec alembic upgrade head
+        ;;
+    web)
+        exec gunicorn project.main:app
+        ;;
+    dev)
+        alembic upgrade head
+        exec uvicorn project.main:app --port=1111 --host='0.0.0.0' --reload
+        ;;
+esac
 
 exec "$@"
@@ -0,0 +1,44 @@
+"""
+gunicorn.conf.py
+----------
+Настройки production-запуска: gunicorn управляет воркерами uvicorn,
+перезапускает упавшие и плавно перезапускает воркер после
+web_max_requests запросов. Воркеров по числу доступных ядер,
+uvloop и httptools используются, если установлены. С несколькими
+воркерами живые обновления идут через postgres (см. stream_backend),
+а без общего Redis (cache_redis_url) кеши ответов и api-key отключаются.
+Запуск: gunicorn project.main:app
+
+"""
+
+import os
+
+from project.config import cache_overrides_for, settings, stream_backend_for
+
+
+def cpu_count() -> int:
+    # Учитывает ограничение ядер контейнера через cpuset
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+bind = f"0.0.0.0:{settings.web_port}"
+workers = settings.web_workers or cpu_count()
+# Воркеры получают настройки мастера (модуль настроек уже импортирован
+# до fork) и окружение
+settings.stream_backend = stream_backend_for(settings, workers)
+os.environ["STREAM_BACKEND"] = settings.stream_backend
+for name, value in cache_overrides_for(settings, workers).items():
+    setattr(settings, name, value)
+    os.environ[name.upper()] = str(value)
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = settings.web_keepalive
+max_requests = settings.web_max_requests
+max_requests_jitter = settings.web_max_requests_jitter
+timeout = settings.web_timeout
+graceful_timeout = settings.web_graceful_timeout
+# Приложение импортируется в каждом воркере: пулы соединений
+# и фоновые задачи не должны переживать fork
+preload_app = False
+accesslog = "-"
@@ -0,0 +1,360 @@
+"""
+cache.py
+----------
+Модуль реализует кеш в памяти процесса с TTL и вытеснением LRU
+и необязательный общий для воркеров уровень в Redis.
+
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from collections import OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+)
+
+from .config import settings
+from .metrics import CACHE_REQUESTS
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Кеш в памяти процесса с временем жизни записей и вытеснением
+    давно не использованных записей при переполнении
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+class RedisBackend:
+    """
+    Общий для всех воркеров кеш в Redis, значения хранятся в JSON
+    """
+
+    def __init__(self, url: str):
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError(
+                "cache_redis_url is set but the redis package is missing"
+            ) from e
+        self._client = redis.from_url(url)
+
+    async def get(self, key: str) -> Any:
+        raw = await self._client.get(key)
+        if raw is None:
+            return MISSING
+        return json.loads(raw)
+
+    async def get_many(self, keys: List[str]) -> List[Any]:
+        raws = await self._client.mget(keys)
+        return [MISSING if raw is None else json.loads(raw) for raw in raws]
+
+    async def set(self, key: str, value: Any, ttl: float):
+        await self._client.set(key, json.dumps(value), px=int(ttl * 1000))
+
+    async def add(self, key: str, value: Any, ttl: float) -> bool:
+        return bool(
+            await self._client.set(
+                key, json.dumps(value), px=int(ttl * 1000), nx=True
+            )
+        )
+
+    async def delete(self, key: str):
+        await self._client.delete(key)
+
+
+class TwoLevelCache:
+    """
+    Кеш из двух уровней: память процесса и необязательный общий backend.
+    При наличии общего уровня записи в памяти живут не дольше
+    cache_local_ttl, чтобы воркеры быстро сходились после инвалидации
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        maxsize: int,
+        ttl: float,
+        shared: Optional[RedisBackend] = None,
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.shared = shared
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._hits = CACHE_REQUESTS.labels(namespace, "hit")
+        self._misses = CACHE_REQUESTS.labels(namespace, "miss")
+
+    def _shared_key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def _local_ttl(self, ttl: float) -> float:
+        if self.shared is None:
+            return ttl
+        return min(ttl, settings.cache_local_ttl)
+
+    async def get(self, key: str) -> Any:
+        value = self.local.get(key)
+        if value is MISSING and self.shared is not None:
+            value = await self.shared.get(self._shared_key(key))
+            if value is not MISSING:
+                self.local.set(key, value, ttl=self._local_ttl(self.ttl))
+        if value is MISSING:
+            self._misses.inc()
+        else:
+            self._hits.inc()
+        return value
+
+    async def get_many(self, keys: List[str]) -> List[Any]:
+        """
+        Читает несколько ключей: промахи памяти процесса запрашиваются
+        у общего уровня одним запросом
+        """
+        values = [self.local.get(key) for key in keys]
+        missed = [i for i, value in enumerate(values) if value is MISSING]
+        if missed and self.shared is not None:
+            shared_values = await self.shared.get_many(
+                [self._shared_key(keys[i]) for i in missed]
+            )
+            for i, value in zip(missed, shared_values):
+                if value is not MISSING:
+                    values[i] = value
+                    self.local.set(
+                        keys[i], value, ttl=self._local_ttl(self.ttl)
+                    )
+        for value in values:
+            if value is MISSING:
+                self._misses.inc()
+            else:
+                self._hits.inc()
+        return values
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, ttl=self._local_ttl(ttl))
+        if self.shared is not None:
+            await self.shared.set(self._shared_key(key), value, ttl=ttl)
+
+    async def add(
+        self, key: str, value: Any, ttl: Optional[float] = None
+    ) -> bool:
+        """
+        Записывает значение, только если ключа еще нет. При общем уровне
+        проверка атомарна для всех воркеров (SET NX)
+
+        :return: bool
+            True, если значение записано
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if self.shared is not None:
+            added = await self.shared.add(self._shared_key(key), value, ttl)
+        else:
+            added = self.local.get(key) is MISSING
+        if added:
+            self.local.set(key, value, ttl=self._local_ttl(ttl))
+        return added
+
+    async def delete(self, key: str):
+        self.local.delete(key)
+        if self.shared is not None:
+            await self.shared.delete(self._shared_key(key))
+
+
+class SingleFlight:
+    """
+    Объединение одновременных запросов: пока выполняется загрузка ключа,
+    остальные запросы того же ключа ждут ее результата. Если запрос,
+    начавший загрузку, отменен (клиент отключился), загрузку своей fn
+    заново начинает один из ожидающих, остальные ждут уже его
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]):
+        future = self._calls.get(key)
+        while future is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Отменена загрузка, а не этот запрос
+                if not future.cancelled():
+                    raise
+            future = self._calls.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие, если они есть
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+def make_entry(body: str) -> dict:
+    return {
+        "body": body,
+        "etag": '"{}"'.format(hashlib.sha1(body.encode()).hexdigest()),
+    }
+
+
+class ResponseCache:
+    """
+    Кеш сериализованных ответов по идентификатору сущности.
+    Запись хранится под текущей версией сущности, инвалидация выдает
+    новую версию, поэтому загрузка, начатая до инвалидации,
+    не может вернуть в кеш устаревший ответ
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        maxsize: int,
+        ttl: float,
+        shared: Optional[RedisBackend] = None,
+    ):
+        self.entries = TwoLevelCache(
+            namespace=namespace, maxsize=maxsize, ttl=ttl, shared=shared
+        )
+        self.versions = TwoLevelCache(
+            namespace=f"{namespace}:version",
+            maxsize=maxsize,
+            ttl=ttl,
+            shared=shared,
+        )
+        self._flight = SingleFlight()
+
+    async def _version(self, entity_id: Hashable) -> str:
+        version = await self.versions.get(str(entity_id))
+        if version is MISSING:
+            version = uuid.uuid4().hex
+            await self.versions.set(str(entity_id), version)
+        return version
+
+    async def get_or_load(
+        self,
+        entity_id: Hashable,
+        loader: Callable[[], Awaitable[str]],
+        variant: str = "",
+    ) -> dict:
+        """
+        Возвращает запись {"body": str, "etag": str} для варианта
+        представления сущности, при промахе загружает ее через loader
+        один раз на ключ
+        """
+        version = await self._version(entity_id)
+        key = f"{entity_id}:{version}:{variant}"
+        entry = await self.entries.get(key)
+        if entry is not MISSING:
+            return entry
+
+        async def load() -> dict:
+            entry = make_entry(await loader())
+            await self.entries.set(key, entry)
+            return entry
+
+        return await self._flight.do(key, load)
+
+    async def get_many_or_load(
+        self,
+        entity_ids: Iterable[Hashable],
+        loader: Callable[[List[Hashable]], Awaitable[Dict[Hashable, str]]],
+        variant: str = "",
+    ) -> Dict[Hashable, dict]:
+        """
+        Возвращает записи для нескольких сущностей, все промахи
+        загружаются одним вызовом loader(ids) -> {id: body}.
+        Сущности, которых loader не вернул, в ответ не попадают
+        """
+        entity_ids = list(entity_ids)
+        version_keys = [str(entity_id) for entity_id in entity_ids]
+        versions = await self.versions.get_many(version_keys)
+        for i, version in enumerate(versions):
+            if version is MISSING:
+                versions[i] = uuid.uuid4().hex
+                await self.versions.set(version_keys[i], versions[i])
+
+        keys = [
+            f"{entity_id}:{version}:{variant}"
+            for entity_id, version in zip(entity_ids, versions)
+        ]
+        entries = dict(zip(entity_ids, await self.entries.get_many(keys)))
+        missing = [
+            entity_id
+            for entity_id, entry in entries.items()
+            if entry is MISSING
+        ]
+        if missing:
+            bodies = await loader(missing)
+            for entity_id, key in zip(entity_ids, keys):
+                if entries[entity_id] is MISSING and entity_id in bodies:
+                    entries[entity_id] = make_entry(bodies[entity_id])
+                    await self.entries.set(key, entries[entity_id])
+        return {
+            entity_id: entry
+            for entity_id, entry in entries.items()
+            if entry is not MISSING
+        }
+
+    async def invalidate(self, *entity_ids: Hashable):
+        for entity_id in entity_ids:
+            await self.versions.set(str(entity_id), uuid.uuid4().hex)
+
+
+shared_backend = (
+    RedisBackend(settings.cache_redis_url)
+    if settings.cache_redis_url
+    else None
+)
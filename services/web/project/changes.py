@@ -0,0 +1,176 @@
+"""
+changes.py
+----------
+Модуль реализует журнал изменений для дельта-синхронизации: сервисы
+записи добавляют в таблицу changes строку на каждый новый или
+удаленный твит, изменение лайков и подписок, а клиент с токеном
+since_version получает только то, что изменилось после него.
+
+Версия строки - номер транзакции (xid), которая ее записала. Токен
+синхронизации - xmin текущего снимка БД: все транзакции с меньшим
+номером уже завершены. Поэтому изменения с version >= токена попадут
+в следующую дельту, даже если транзакции фиксируются не в порядке
+своих номеров. Дельта без изменений стоит одного запроса
+без чтения таблиц.
+
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import (
+    String,
+    delete,
+    func,
+    insert,
+    literal,
+    literal_column,
+    select,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import changes
+
+TWEET_CREATED = "tweet"
+TWEET_DELETED = "delete"
+LIKES_CHANGED = "likes"
+FOLLOWERS_CHANGED = "followers"
+FOLLOWING_CHANGED = "following"
+# Строка-граница: изменения до ее version удалены из журнала.
+HORIZON = "horizon"
+HORIZON_AUTHOR_ID = 0
+
+# Больше изменений в дельте не отдается, клиент перечитывает данные.
+MAX_DELTA_CHANGES = 1000
+
+CURRENT_VERSION = literal_column(
+    "(pg_snapshot_xmin(pg_current_snapshot())::text)::bigint"
+)
+
+
+class SyncState(NamedTuple):
+    # Токен, который клиент пришлет в следующий раз
+    version: int
+    # Изменений до этой версии в журнале уже нет
+    horizon: Optional[int]
+
+
+def log_changes(kind: str, rows):
+    """
+    INSERT в журнал строк выборки rows с колонками (entity_id,
+    author_id), например из RETURNING в CTE
+    """
+    return insert(changes).from_select(
+        ["entity_id", "author_id", "kind"],
+        rows.add_columns(literal(kind, String)),
+    )
+
+
+async def append_changes(
+    session: AsyncSession, rows: Iterable[Tuple[str, int, int]]
+):
+    """
+    Добавляет в журнал строки (kind, entity_id, author_id)
+    одним запросом
+    """
+    values = [
+        {"kind": kind, "entity_id": entity_id, "author_id": author_id}
+        for kind, entity_id, author_id in rows
+    ]
+    if values:
+        await session.execute(insert(changes).values(values))
+
+
+async def get_sync_state(session: AsyncSession) -> SyncState:
+    horizon = (
+        select(func.max(changes.c.version))
+        .where(changes.c.author_id == HORIZON_AUTHOR_ID)
+        .scalar_subquery()
+    )
+    q = await session.execute(select(CURRENT_VERSION, horizon))
+    return SyncState(*q.one())
+
+
+async def get_current_version(session: AsyncSession) -> int:
+    """
+    Токен синхронизации для ответа с полными данными. Его нужно
+    получить до чтения данных, чтобы не пропустить изменения
+    """
+    q = await session.execute(select(CURRENT_VERSION))
+    return q.scalar_one()
+
+
+async def get_changes(
+    session: AsyncSession, since: int, state: SyncState, condition
+) -> Optional[List]:
+    """
+    Изменения, подходящие под condition, из окна [since, state.version)
+    в порядке записи. None - клиенту нужно перечитать данные целиком:
+    токен старше границы журнала или изменений слишком много
+    """
+    if state.horizon is not None and since < state.horizon:
+        return None
+    if since >= state.version:
+        return []
+    q = await session.execute(
+        select(changes.c.kind, changes.c.entity_id, changes.c.author_id)
+        .where(
+            changes.c.version >= since,
+            changes.c.version < state.version,
+            condition,
+        )
+        .order_by(changes.c.version, changes.c.id)
+        .limit(MAX_DELTA_CHANGES + 1)
+    )
+    rows = q.all()
+    if len(rows) > MAX_DELTA_CHANGES:
+        return None
+    return rows
+
+
+async def prune_changes(
+    session: AsyncSession, keep: timedelta, batch_size: int = 10000
+) -> int:
+    """
+    Удаляет из журнала изменения старше keep пачками и записывает
+    границу: клиенты с более старым токеном получат resync
+
+    :return: int
+        Число удаленных строк
+    """
+    cutoff = datetime.now(timezone.utc) - keep
+    q = await session.execute(
+        select(func.min(changes.c.version)).where(
+            changes.c.created_at >= cutoff,
+            changes.c.author_id != HORIZON_AUTHOR_ID,
+        )
+    )
+    horizon = q.scalar()
+    if horizon is None:
+        horizon = await get_current_version(session)
+
+    await session.execute(
+        insert(changes).values(
+            kind=HORIZON,
+            entity_id=HORIZON_AUTHOR_ID,
+            author_id=HORIZON_AUTHOR_ID,
+            version=horizon,
+        )
+    )
+    await session.commit()
+
+    deleted = 0
+    while True:
+        batch = (
+            select(changes.c.id)
+            .where(changes.c.version < horizon)
+            .limit(batch_size)
+            .scalar_subquery()
+        )
+        q = await session.execute(
+            delete(changes).where(changes.c.id.in_(batch))
+        )
+        await session.commit()
+        deleted += q.rowcount
+        if q.rowcount < batch_size:
+            return deleted
@@ -0,0 +1,195 @@
+"""
+config.py
+----------
+Модуль реализует настройки приложения, читаемые из переменных окружения.
+
+"""
+
+from typing import Dict, List, Optional
+
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    """
+    Настройки приложения
+
+    Parameters
+    ----------
+    database_url: str
+        URL основной базы данных
+    db_echo: bool
+        Логирование всех SQL-запросов, только для отладки
+    db_pool_size: int
+        Число постоянно открытых соединений пула
+    db_max_overflow: int
+        Число соединений сверх db_pool_size при пиковой нагрузке
+    db_pool_timeout: float
+        Сколько ждать свободного соединения, секунды
+    db_pool_recycle: int
+        Через сколько секунд переоткрывать соединение
+    db_pool_pre_ping: bool
+        Проверка соединения перед выдачей из пула
+    db_pool_warm_size: int
+        Сколько соединений каждого пула открывается при старте воркера
+    startup_warmup_timeout: float
+        Сколько воркер ждет окончания прогрева перед приемом запросов,
+        секунды
+    db_statement_timeout_ms: int
+        statement_timeout сервера, 0 - без ограничения
+    db_prepared_statement_cache_size: int
+        Размер кеша подготовленных выражений asyncpg на соединение
+    database_replica_urls: List[str]
+        URL реплик для читающих запросов, JSON-список
+    read_your_writes_window: float
+        Сколько секунд после записи чтения пользователя идут в основную БД
+    replica_max_lag: float
+        Допустимое отставание реплики, секунды
+    replica_lag_check_interval: float
+        Период проверки отставания реплики, секунды
+    auth_cache_ttl: float
+        Время жизни записи кеша api-key -> пользователь, секунды
+    auth_cache_negative_ttl: float
+        Время жизни записи о несуществующем api-key, секунды
+    auth_cache_size: int
+        Максимальное число записей кеша в памяти процесса
+    cache_redis_url: str, optional
+        URL общего для всех воркеров Redis. Требует пакет redis.
+        Без него gunicorn с несколькими воркерами отключает кеши
+        ответов и api-key
+    cache_local_ttl: float
+        Время жизни записи в памяти процесса при наличии общего кеша
+    response_cache_ttl: float
+        Время жизни закешированного ответа GET по id, секунды
+    response_cache_size: int
+        Максимальное число закешированных ответов в памяти процесса
+    media_max_bytes: int
+        Максимальный размер загружаемой картинки, байты
+    media_render_workers: int
+        Число процессов подготовки копий картинок
+    idempotency_ttl: float
+        Сколько хранится ответ POST-запроса с заголовком Idempotency-Key,
+        секунды
+    idempotency_pending_ttl: float
+        Сколько ключ занят выполняющимся запросом, секунды. Ключ
+        запроса, прерванного падением воркера, освобождается через
+        это время
+    likes_write_behind: bool
+        Отложенная пакетная запись лайков, см. tweets/write_behind.py
+    likes_flush_size: int
+        Число действий в буфере, при котором лайки сбрасываются в БД
+    likes_flush_interval: float
+        Максимальная задержка записи лайка в БД, секунды
+    stream_backend: str
+        Доставка живых обновлений между воркерами: local или postgres.
+        Без явного значения gunicorn с несколькими воркерами
+        использует postgres
+    stream_buffer_size: int
+        Сколько событий копится для одного соединения
+    stream_heartbeat_interval: float
+        Период heartbeat в соединениях без событий, секунды
+    stream_max_connections: int
+        Максимальное число соединений живых обновлений на воркер
+    api_routers: List[str]
+        Подключаемые группы роутеров: tweets, users, medias, stream
+    web_port: int
+        Порт сервера в production-режиме
+    web_workers: int
+        Число воркеров gunicorn, 0 - по числу доступных ядер
+    web_keepalive: int
+        Сколько держать простаивающее keep-alive соединение, секунды
+    web_max_requests: int
+        Через сколько запросов воркер плавно перезапускается, 0 - никогда
+    web_max_requests_jitter: int
+        Случайная добавка к web_max_requests, чтобы воркеры
+        не перезапускались одновременно
+    web_timeout: int
+        Сколько ждать зависший воркер до его перезапуска, секунды
+    web_graceful_timeout: int
+        Сколько воркер дорабатывает начатые запросы при остановке, секунды
+    """
+
+    database_url: str = (
+        "postgresql+asyncpg://admin:admin@db:5432/diplom_project"
+    )
+    db_echo: bool = False
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    db_pool_warm_size: int = 2
+    startup_warmup_timeout: float = 10.0
+    db_statement_timeout_ms: int = 5000
+    db_prepared_statement_cache_size: int = 100
+    database_replica_urls: List[str] = []
+    read_your_writes_window: float = 5.0
+    replica_max_lag: float = 1.0
+    replica_lag_check_interval: float = 5.0
+
+    auth_cache_ttl: float = 60.0
+    auth_cache_negative_ttl: float = 5.0
+    auth_cache_size: int = 10000
+    cache_redis_url: Optional[str] = None
+    cache_local_ttl: float = 5.0
+    response_cache_ttl: float = 300.0
+    response_cache_size: int = 10000
+    media_max_bytes: int = 10 * 1024 * 1024
+    media_render_workers: int = 2
+    idempotency_ttl: float = 24 * 60 * 60
+    idempotency_pending_ttl: float = 60.0
+    likes_write_behind: bool = False
+    likes_flush_size: int = 500
+    likes_flush_interval: float = 0.05
+    stream_backend: str = "local"
+    stream_buffer_size: int = 256
+    stream_heartbeat_interval: float = 15.0
+    stream_max_connections: int = 20000
+
+    api_routers: List[str] = ["tweets", "users", "medias", "stream"]
+    web_port: int = 1111
+    web_workers: int = 0
+    web_keepalive: int = 5
+    web_max_requests: int = 10000
+    web_max_requests_jitter: int = 1000
+    web_timeout: int = 60
+    web_graceful_timeout: int = 30
+
+
+def stream_backend_for(config: Settings, workers: int) -> str:
+    """
+    Брокер живых обновлений для запуска с workers процессами.
+    local доставляет события только подписчикам своего процесса:
+    без явной настройки для нескольких воркеров выбирается postgres,
+    явный local с несколькими воркерами - ошибка конфигурации
+    """
+    if workers <= 1:
+        return config.stream_backend
+    if "stream_backend" not in config.__fields_set__:
+        return "postgres"
+    if config.stream_backend == "local":
+        raise ValueError(
+            f"STREAM_BACKEND=local with {workers} workers: live updates "
+            "would reach only subscribers of the same worker, "
+            "use STREAM_BACKEND=postgres or WEB_WORKERS=1"
+        )
+    return config.stream_backend
+
+
+def cache_overrides_for(config: Settings, workers: int) -> Dict[str, float]:
+    """
+    Настройки кешей для запуска с workers процессами. Без общего Redis
+    кеши ответов и api-key живут в памяти каждого процесса, и
+    инвалидация в одном воркере не доходит до остальных: для
+    нескольких воркеров такие кеши отключаются нулевым ttl
+    """
+    if workers <= 1 or config.cache_redis_url:
+        return {}
+    return {
+        "response_cache_ttl": 0.0,
+        "auth_cache_ttl": 0.0,
+        "auth_cache_negative_ttl": 0.0,
+    }
+
+
+settings = Settings()
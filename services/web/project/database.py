@@ -1,32 +1,220 @@
-from typing import Any, Dict
+import time
+from typing import Any, Dict, Iterable, Optional
 
 from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Boolean,
     Column,
+    Computed,
+    DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
     UniqueConstraint,
+    any_,
+    cast,
+    func,
+    literal,
+    text,
 )
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    create_async_engine,
+)
+from sqlalchemy.orm import (
+    declarative_base,
+    deferred,
+    relationship,
+    sessionmaker,
+)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from .config import Settings, settings
+
+# SQLSTATE нарушения внешнего ключа в PostgreSQL.
+FOREIGN_KEY_VIOLATION = "23503"
+
+# Конфигурация полнотекстового поиска: русская морфология,
+# латиница разбирается английским стеммером.
+SEARCH_CONFIG = "russian"
+
+
+class PoolMetrics:
+    """
+    Счетчики выдачи соединений пула: число выдач, суммарное
+    и максимальное время ожидания соединения, число таймаутов
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def observe(self, wait_seconds: float, timed_out: bool = False):
+        self.checkouts += 1
+        self.timeouts += timed_out
+        self.wait_seconds_total += wait_seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, замеряющий время ожидания соединения
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def connect(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super().connect()
+        except Exception:
+            timed_out = True
+            raise
+        finally:
+            self.metrics.observe(time.perf_counter() - start, timed_out)
+
+
+def create_engine(
+    url: Optional[str] = None, config: Settings = settings
+) -> AsyncEngine:
+    connect_args: Dict[str, Any] = {
+        "prepared_statement_cache_size": (
+            config.db_prepared_statement_cache_size
+        ),
+    }
+    if config.db_statement_timeout_ms:
+        connect_args["server_settings"] = {
+            "statement_timeout": str(config.db_statement_timeout_ms)
+        }
+
+    return create_async_engine(
+        url or config.database_url,
+        echo=config.db_echo,
+        poolclass=InstrumentedPool,
+        pool_size=config.db_pool_size,
+        max_overflow=config.db_max_overflow,
+        pool_timeout=config.db_pool_timeout,
+        pool_recycle=config.db_pool_recycle,
+        pool_pre_ping=config.db_pool_pre_ping,
+        connect_args=connect_args,
+    )
+
+
+def pool_status(engine: AsyncEngine) -> Dict[str, Any]:
+    pool = engine.sync_engine.pool
+    metrics = pool.metrics
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checkouts": metrics.checkouts,
+        "timeouts": metrics.timeouts,
+        "wait_seconds_total": round(metrics.wait_seconds_total, 6),
+        "wait_seconds_max": round(metrics.wait_seconds_max, 6),
+    }
+
+
+class _DatabaseState:
+    """
+    Движок и фабрика сессий основной БД. Создаются при первом
+    обращении, а не при импорте модуля: импорт моделей не требует
+    драйвера и доступной БД
+    """
+
+    def __init__(self, config: Settings):
+        self.config = config
+        self.engine: Optional[AsyncEngine] = None
+        self.session_maker: Optional[sessionmaker] = None
+
+
+_state = _DatabaseState(settings)
+
+
+def configure_database(config: Settings):
+    """
+    Задает настройки, с которыми будет создан движок
+    """
+    if _state.engine is not None and _state.config is not config:
+        raise RuntimeError("database engine is already created")
+    _state.config = config
+
+
+def get_engine() -> AsyncEngine:
+    if _state.engine is None:
+        _state.engine = create_engine(config=_state.config)
+    return _state.engine
+
+
+def get_session_maker() -> sessionmaker:
+    if _state.session_maker is None:
+        _state.session_maker = sessionmaker(
+            get_engine(), expire_on_commit=False, class_=AsyncSession
+        )
+    return _state.session_maker
+
+
+async def dispose_engine():
+    """
+    Закрывает соединения пула, следующий get_engine создаст движок
+    заново
+    """
+    if _state.engine is not None:
+        await _state.engine.dispose()
+    _state.engine = None
+    _state.session_maker = None
+
+
+def __getattr__(name: str):
+    # engine и async_session остаются доступны как атрибуты модуля
+    if name == "engine":
+        return get_engine()
+    if name == "async_session":
+        return get_session_maker()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-DATABASE_URL = "postgresql+asyncpg://admin:admin@db:5432/diplom_project"
-engine = create_async_engine(DATABASE_URL, echo=True)
 
-async_session = sessionmaker(
-    engine, expire_on_commit=False, class_=AsyncSession
-)
-session = async_session()
 Base = declarative_base()
 
 
 async def get_session():
-    async with async_session() as session:
+    async with get_session_maker()() as session:
         yield session
 
 
+def int_array(values: Iterable[int]):
+    """
+    Параметр-массив integer[], текст запроса не зависит от его длины
+    """
+    return cast(literal(list(values), ARRAY(Integer)), ARRAY(Integer))
+
+
+def text_array(values: Iterable[str]):
+    """
+    Параметр-массив varchar[], аналог int_array для строк
+    """
+    return cast(literal(list(values), ARRAY(String)), ARRAY(String))
+
+
+def in_ids(column, ids: Iterable[int]):
+    """
+    Условие column = ANY(:ids) с одним параметром-массивом
+    """
+    return column == any_(int_array(ids))
+
+
 followers = Table(
     "followers",
     Base.metadata,
@@ -40,6 +228,132 @@ followers = Table(
         ForeignKey("users.id", ondelete="CASCADE"),
         primary_key=True,
     ),
+    # Страницы подписчиков по id подписчика читаются по индексу,
+    # страницы подписок - по первичному ключу
+    Index(
+        "ix_followers_followed_user_id_following_user_id",
+        "followed_user_id",
+        "following_user_id",
+    ),
+)
+
+# Материализованная лента пользователя (fan-out-on-write): строка на каждый
+# твит автора, на которого подписан владелец ленты. likes_count - копия
+# счетчика твита, которую обновляют те же запросы, что и tweets.likes_count:
+# страница ленты читается одним диапазоном индекса по популярности.
+timelines = Table(
+    "timelines",
+    Base.metadata,
+    Column(
+        "user_id",
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "tweet_id",
+        ForeignKey("tweets.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "author_id",
+        ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False,
+    ),
+    Column(
+        "likes_count",
+        Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    ),
+    Index("ix_timelines_user_id_author_id", "user_id", "author_id"),
+    Index("ix_timelines_tweet_id", "tweet_id"),
+)
+Index(
+    "ix_timelines_user_id_popularity",
+    timelines.c.user_id,
+    timelines.c.likes_count.desc(),
+    timelines.c.tweet_id.desc(),
+)
+
+# Инвертированные индексы твитов по хэштегам и упоминаниям. Первичный
+# ключ (хэштег или пользователь, твит) отдает твиты по убыванию id
+# сканированием только индекса, индекс по tweet_id нужен каскадному
+# удалению твита.
+hashtags = Table(
+    "hashtags",
+    Base.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String, nullable=False, unique=True),
+)
+
+tweet_hashtags = Table(
+    "tweet_hashtags",
+    Base.metadata,
+    Column(
+        "hashtag_id",
+        ForeignKey("hashtags.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "tweet_id",
+        ForeignKey("tweets.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Index("ix_tweet_hashtags_tweet_id", "tweet_id"),
+)
+
+mentions = Table(
+    "mentions",
+    Base.metadata,
+    Column(
+        "user_id",
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "tweet_id",
+        ForeignKey("tweets.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Index("ix_mentions_tweet_id", "tweet_id"),
+)
+
+# Журнал изменений для дельта-синхронизации клиентов, см. changes.py.
+# version - номер транзакции (xid), записавшей строку.
+changes = Table(
+    "changes",
+    Base.metadata,
+    Column("id", BigInteger, primary_key=True),
+    Column(
+        "version",
+        BigInteger,
+        nullable=False,
+        server_default=text("(pg_current_xact_id()::text)::bigint"),
+    ),
+    Column("kind", String, nullable=False),
+    Column("entity_id", Integer, nullable=False),
+    Column("author_id", Integer, nullable=False),
+    Column(
+        "created_at",
+        DateTime(timezone=True),
+        nullable=False,
+        server_default=func.now(),
+    ),
+    Index("ix_changes_version", "version"),
+    Index("ix_changes_author_id_version", "author_id", "version"),
+)
+
+# Ответы POST-запросов с заголовком Idempotency-Key, см. idempotency.py.
+# response IS NULL - запрос с этим ключом еще выполняется.
+idempotency_keys = Table(
+    "idempotency_keys",
+    Base.metadata,
+    Column("key", String, primary_key=True),
+    Column("request_hash", String),
+    Column("response", JSON),
+    Column("expires_at", DateTime(timezone=True), nullable=False),
+    Index("ix_idempotency_keys_expires_at", "expires_at"),
 )
 
 
@@ -49,7 +363,16 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True, unique=True)
     name = Column(String, index=True)
     api_key = Column(String, index=True, unique=True)
-    password = Column(String, index=True)
+    password = Column(String)
+    followers_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    following_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    fanout_on_read = Column(
+        Boolean, nullable=False, default=False, server_default="false"
+    )
 
     following = relationship(
         "User",
@@ -84,7 +407,35 @@ class Tweet(Base):
     __tablename__ = "tweets"
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
-    content = Column(String, index=True)
+    content = Column(String)
+    likes_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    # Вычисляется сервером при записи, в ORM-объекты не загружается.
+    search_vector = deferred(
+        Column(
+            TSVECTOR,
+            Computed(
+                f"to_tsvector('{SEARCH_CONFIG}'::regconfig, "
+                "coalesce(content, ''))",
+                persisted=True,
+            ),
+        )
+    )
+
+    __table_args__ = (
+        Index(
+            "ix_tweets_user_id_popularity",
+            user_id,
+            likes_count.desc(),
+            id.desc(),
+        ),
+        Index(
+            "ix_tweets_search_vector",
+            search_vector,
+            postgresql_using="gin",
+        ),
+    )
 
     attachments = association_proxy("media", "name")
 
@@ -114,7 +465,13 @@ class Media(Base):
     __tablename__ = "medias"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
-    tweet_id = Column(Integer, ForeignKey("tweets.id", ondelete="CASCADE"))
+    renditions = Column(JSON, nullable=True)
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True
+    )
+    tweet_id = Column(
+        Integer, ForeignKey("tweets.id", ondelete="CASCADE"), index=True
+    )
     tweet = relationship("Tweet", back_populates="media")
 
     def __repr__(self):
@@ -130,11 +487,12 @@ class Like(Base):
         UniqueConstraint(
             "user_id", "tweet_id", name="_unique_who_tweet_likes"
         ),
+        Index("ix_likes_tweet_id_id", "tweet_id", "id"),
     )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
-    tweet_id = Column(ForeignKey("tweets.id", ondelete="CASCADE"), index=True)
+    tweet_id = Column(ForeignKey("tweets.id", ondelete="CASCADE"))
 
     user = relationship("User", back_populates="likes")
     tweet = relationship("Tweet", back_populates="likes")
@@ -146,3 +504,7 @@ class Like(Base):
 
     def to_json(self) -> Dict[str, Any]:
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+def is_foreign_key_violation(error: IntegrityError) -> bool:
+    return getattr(error.orig, "pgcode", None) == FOREIGN_KEY_VIOLATION
@@ -0,0 +1,325 @@
+"""
+idempotency.py
+----------
+Модуль реализует повтор POST-запросов с заголовком Idempotency-Key:
+ответ первого выполнения сохраняется, и повтор с тем же ключом
+получает его без повторного выполнения. Пока первый запрос
+выполняется, повтор получает 409, а тот же ключ с другим телом
+запроса - 422.
+
+Ключи хранятся в таблице idempotency_keys: первый запрос занимает
+ключ одним INSERT ... ON CONFLICT, поэтому из двух одновременных
+запросов в разные воркеры выполняется только один. Маркер
+выполнения живет idempotency_pending_ttl: ключ воркера, упавшего
+посреди запроса, освобождается без ожидания idempotency_ttl.
+
+"""
+
+import base64
+import hashlib
+import json
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import delete, func, null, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .cache import MISSING
+from .config import settings
+from .database import get_session, idempotency_keys
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+REPLAYED_HEADER = b"idempotent-replayed"
+MAX_KEY_LENGTH = 255
+PENDING = None
+
+
+@asynccontextmanager
+async def _session(scope):
+    # Та же сессия, что получают обработчики, с учетом
+    # dependency_overrides приложения
+    provider = scope["app"].dependency_overrides.get(get_session, get_session)
+    sessions = provider()
+    try:
+        yield await sessions.__anext__()
+    finally:
+        await sessions.aclose()
+
+
+def _expires_at(ttl: float):
+    return func.now() + timedelta(seconds=ttl)
+
+
+async def claim_key(session: AsyncSession, key: str) -> bool:
+    """
+    Занимает ключ маркером выполнения. Ключ с истекшим сроком
+    занимается заново
+
+    :return: bool
+        True, если ключ занят этим запросом
+    """
+    stmt = insert(idempotency_keys).values(
+        key=key, expires_at=_expires_at(settings.idempotency_pending_ttl)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[idempotency_keys.c.key],
+        set_={
+            "request_hash": null(),
+            "response": null(),
+            "expires_at": stmt.excluded.expires_at,
+        },
+        where=idempotency_keys.c.expires_at <= func.now(),
+    ).returning(idempotency_keys.c.key)
+    q = await session.execute(stmt)
+    claimed = q.first() is not None
+    await session.commit()
+    return claimed
+
+
+async def get_stored(session: AsyncSession, key: str) -> Any:
+    """
+    Сохраненный ответ, PENDING для выполняющегося запроса
+    или MISSING
+    """
+    q = await session.execute(
+        select(
+            idempotency_keys.c.request_hash, idempotency_keys.c.response
+        ).where(
+            idempotency_keys.c.key == key,
+            idempotency_keys.c.expires_at > func.now(),
+        )
+    )
+    row = q.first()
+    if row is None:
+        return MISSING
+    if row.response is None:
+        return PENDING
+    return {"request_hash": row.request_hash, **row.response}
+
+
+async def store_response(
+    session: AsyncSession, key: str, request_hash: str, response: dict
+):
+    await session.execute(
+        update(idempotency_keys)
+        .where(idempotency_keys.c.key == key)
+        .values(
+            request_hash=request_hash,
+            response=response,
+            expires_at=_expires_at(settings.idempotency_ttl),
+        )
+    )
+    await session.commit()
+
+
+async def release_key(session: AsyncSession, key: str):
+    """
+    Освобождает ключ запроса, который можно повторить
+    """
+    await session.execute(
+        delete(idempotency_keys).where(
+            idempotency_keys.c.key == key,
+            idempotency_keys.c.response.is_(None),
+        )
+    )
+    await session.commit()
+
+
+async def prune_idempotency_keys(
+    session: AsyncSession, batch_size: int = 10000
+) -> int:
+    """
+    Удаляет ключи с истекшим сроком пачками
+
+    :return: int
+        Число удаленных строк
+    """
+    deleted = 0
+    while True:
+        batch = (
+            select(idempotency_keys.c.key)
+            .where(idempotency_keys.c.expires_at <= func.now())
+            .limit(batch_size)
+            .scalar_subquery()
+        )
+        q = await session.execute(
+            delete(idempotency_keys).where(idempotency_keys.c.key.in_(batch))
+        )
+        await session.commit()
+        deleted += q.rowcount
+        if q.rowcount < batch_size:
+            return deleted
+
+
+def _header(scope, name: bytes) -> Optional[bytes]:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value
+    return None
+
+
+def _cache_key(scope, idempotency_key: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in (
+        _header(scope, b"api-key") or b"",
+        scope["path"].encode(),
+        idempotency_key,
+    ):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _error(status: int, error_type: str, error_message: str):
+    body = json.dumps(
+        {
+            "result": False,
+            "error_type": error_type,
+            "error_message": error_message,
+        }
+    ).encode()
+    return status, [(b"content-type", b"application/json")], body
+
+
+async def _send_response(
+    send, status: int, headers: List[Tuple[bytes, bytes]], body: bytes
+):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers + [(b"content-length", b"%d" % len(body))],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI-middleware, сохраняющая ответы POST-запросов
+    с заголовком Idempotency-Key
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        idempotency_key = None
+        if scope["type"] == "http" and scope["method"] == "POST":
+            idempotency_key = _header(scope, IDEMPOTENCY_HEADER)
+        if not idempotency_key:
+            await self.app(scope, receive, send)
+            return
+
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            await _send_response(
+                send,
+                *_error(
+                    422, "BAD IDEMPOTENCY KEY", "Idempotency-Key is too long"
+                ),
+            )
+            return
+
+        key = _cache_key(scope, idempotency_key)
+        request_hash = hashlib.sha256()
+
+        async def receive_and_hash():
+            message = await receive()
+            if message["type"] == "http.request":
+                request_hash.update(message.get("body", b""))
+            return message
+
+        async with _session(scope) as session:
+            claimed = await claim_key(session, key)
+        if not claimed:
+            await self._replay(
+                scope, key, receive_and_hash, request_hash, send
+            )
+            return
+
+        status_code = 500
+        headers: List[Tuple[bytes, bytes]] = []
+        body = []
+
+        async def send_and_record(message):
+            nonlocal status_code, headers
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = [
+                    (name, value)
+                    for name, value in message.get("headers", [])
+                    if name == b"content-type"
+                ]
+            elif message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_and_hash, send_and_record)
+        except BaseException:
+            async with _session(scope) as session:
+                await release_key(session, key)
+            raise
+
+        async with _session(scope) as session:
+            if status_code >= 500:
+                # Ошибку сервера можно повторить с тем же ключом
+                await release_key(session, key)
+                return
+            await store_response(
+                session,
+                key,
+                request_hash.hexdigest(),
+                {
+                    "status": status_code,
+                    "headers": [
+                        [name.decode(), value.decode()]
+                        for name, value in headers
+                    ],
+                    "body": base64.b64encode(b"".join(body)).decode(),
+                },
+            )
+
+    async def _replay(self, scope, key, receive, request_hash, send):
+        async with _session(scope) as session:
+            stored = await get_stored(session, key)
+        if stored is MISSING or stored is PENDING:
+            await _send_response(
+                send,
+                *_error(
+                    409,
+                    "IDEMPOTENCY CONFLICT",
+                    "Request with this Idempotency-Key is in progress",
+                ),
+            )
+            return
+
+        while True:
+            message = await receive()
+            if message["type"] != "http.request" or not message.get(
+                "more_body", False
+            ):
+                break
+        if request_hash.hexdigest() != stored["request_hash"]:
+            await _send_response(
+                send,
+                *_error(
+                    422,
+                    "IDEMPOTENCY KEY REUSED",
+                    "Idempotency-Key was used with another request body",
+                ),
+            )
+            return
+
+        await _send_response(
+            send,
+            stored["status"],
+            [
+                (name.encode(), value.encode())
+                for name, value in stored["headers"]
+            ]
+            + [(REPLAYED_HEADER, b"true")],
+            base64.b64decode(stored["body"]),
+        )
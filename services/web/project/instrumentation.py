@@ -0,0 +1,155 @@
+"""
+instrumentation.py
+----------
+Модуль реализует подсчет SQL-запросов на HTTP-запрос: число запросов,
+суммарное время в БД и самый медленный запрос попадают в заголовки
+ответа и в структурированный лог. Для тестов есть assert_max_queries,
+который ловит регрессии N+1.
+
+"""
+
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("project.queries")
+
+SLOW_STATEMENT_LOG_LENGTH = 500
+
+
+class QueryStats:
+    def __init__(self, record_statements: bool = False):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement: Optional[str] = None
+        self.statements: Optional[List[str]] = (
+            [] if record_statements else None
+        )
+
+    def add(self, statement: str, elapsed: float):
+        self.count += 1
+        self.total_time += elapsed
+        if elapsed >= self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_statement = statement
+        if self.statements is not None:
+            self.statements.append(statement)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+_request_stats: ContextVar[Optional[QueryStats]] = ContextVar(
+    "request_query_stats", default=None
+)
+_budgets: List[QueryStats] = []
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, *args):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, *args):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.add(statement, elapsed)
+    for budget in _budgets:
+        budget.add(statement, elapsed)
+
+
+@contextmanager
+def assert_max_queries(max_queries: int) -> Iterator[QueryStats]:
+    """
+    Проверяет, что внутри блока выполнено не больше max_queries запросов
+
+    Пример:
+        with assert_max_queries(4):
+            await ac.get("api/tweets/", headers={"api-key": "aaa"})
+    """
+    budget = QueryStats(record_statements=True)
+    _budgets.append(budget)
+    try:
+        yield budget
+    finally:
+        _budgets.remove(budget)
+    if budget.count > max_queries:
+        raise QueryBudgetExceeded(
+            "Expected at most {} queries, got {}:\n{}".format(
+                max_queries, budget.count, "\n".join(budget.statements)
+            )
+        )
+
+
+class QueryStatsMiddleware:
+    """
+    ASGI-middleware, собирающая статистику SQL-запросов HTTP-запроса
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_stats(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-db-query-count", str(stats.count).encode()),
+                    (
+                        b"x-db-time-ms",
+                        f"{stats.total_time * 1000:.2f}".encode(),
+                    ),
+                    (
+                        b"x-db-slowest-ms",
+                        f"{stats.slowest_time * 1000:.2f}".encode(),
+                    ),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _request_stats.reset(token)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    json.dumps(
+                        {
+                            "method": scope["method"],
+                            "path": scope["path"],
+                            "status": status_code,
+                            "duration_ms": round(
+                                (time.perf_counter() - start) * 1000, 2
+                            ),
+                            "db_query_count": stats.count,
+                            "db_time_ms": round(stats.total_time * 1000, 2),
+                            "db_slowest_ms": round(
+                                stats.slowest_time * 1000, 2
+                            ),
+                            "db_slowest_statement": (
+                                stats.slowest_statement or ""
+                            )[:SLOW_STATEMENT_LOG_LENGTH],
+                        },
+                        ensure_ascii=False,
+                    )
+                )
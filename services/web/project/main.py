@@ -1,34 +1,199 @@
-from fastapi import APIRouter, FastAPI
+"""
+main.py
+----------
+Модуль реализует сборку приложения FastApi: create_app(config)
+подключает выбранные в config.api_routers группы роутеров и только
+их импортирует. Движок БД создается при первом обращении. Атрибут
+модуля app собирается при первом обращении к нему, поэтому импорт
+модуля (тесты, alembic, воркеры) не строит приложение заранее.
+
+"""
+
+import importlib
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List
+
+from fastapi import FastAPI, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 
-from .database import engine, session
-from .media import routes as routes_medias
-from .tweets import routes as routes_tweets
-from .users import routes as routes_users
-
-api_router = APIRouter()
-api_router.include_router(routes_tweets.router)
-api_router.include_router(routes_users.router)
-api_router.include_router(routes_medias.router)
-
-app = FastAPI()
-app.include_router(api_router, prefix="/api")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+from .config import Settings, settings
+from .database import (
+    configure_database,
+    dispose_engine,
+    get_engine,
+    pool_status,
 )
+from .exeptions import BackendExeption
+from .idempotency import IdempotencyMiddleware
+from .instrumentation import QueryStatsMiddleware
+from .media.upload_limit import UploadLimitMiddleware
+from .metrics import CONTENT_TYPE, MetricsMiddleware, register_pools, registry
+from .readiness import MAX_READY_WAIT, readiness
+from .replicas import replica_router
+
+
+async def _close_likes():
+    from .tweets.write_behind import like_writer
+
+    if like_writer is not None:
+        await like_writer.close()
+
+
+async def _close_renditions():
+    from .media.renditions import shutdown_executor
+
+    shutdown_executor()
+
+
+async def _close_broker():
+    from .stream.broker import broker
+
+    await broker.close()
+
+
+# Группа роутеров: модуль с router и закрытие ресурсов группы
+# при остановке. Твиты публикуют живые обновления через broker
+ROUTER_GROUPS: Dict[str, str] = {
+    "tweets": ".tweets.routes",
+    "users": ".users.routes",
+    "medias": ".media.routes",
+    "stream": ".stream.routes",
+}
+GROUP_SHUTDOWN: Dict[str, List[Callable[[], Awaitable[None]]]] = {
+    "tweets": [_close_likes, _close_renditions, _close_broker],
+    "medias": [_close_renditions],
+    "stream": [_close_broker],
+}
+
+
+def _pools() -> Dict[str, dict]:
+    return {
+        "primary": pool_status(get_engine()),
+        **{
+            f"replica_{number}": pool_status(replica.engine)
+            for number, replica in enumerate(replica_router.replicas)
+        },
+    }
+
+
+register_pools(_pools)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """
+    Ресурсы воркера на время его работы: прогрев при старте
+    (см. warmup.py), остановка фоновых задач и закрытие пулов
+    при завершении
+    """
+    from .warmup import warmup_phases
+
+    config: Settings = app.state.config
+    readiness.start(
+        warmup_phases(
+            app,
+            engines=[
+                get_engine(),
+                *(replica.engine for replica in replica_router.replicas),
+            ],
+            size=min(config.db_pool_warm_size, config.db_pool_size),
+        )
+    )
+    # Воркер начинает принимать запросы после прогрева, но не ждет
+    # недоступную БД дольше startup_warmup_timeout
+    await readiness.wait(timeout=config.startup_warmup_timeout)
+    try:
+        yield
+    finally:
+        await readiness.close()
+        closers = dict.fromkeys(
+            close
+            for group in config.api_routers
+            for close in GROUP_SHUTDOWN.get(group, ())
+        )
+        for close in closers:
+            await close()
+        await replica_router.dispose()
+        await dispose_engine()
+
+
+def create_app(config: Settings = settings) -> FastAPI:
+    """
+    Собирает приложение с группами роутеров из config.api_routers
+    """
+    unknown = set(config.api_routers) - set(ROUTER_GROUPS)
+    if unknown:
+        raise ValueError(f"unknown router groups: {sorted(unknown)}")
+    configure_database(config)
+
+    app = FastAPI()
+    app.state.config = config
+    # FastAPI 0.89 не принимает lifespan в конструкторе, Starlette - да
+    app.router.lifespan_context = lifespan
+    for group in config.api_routers:
+        module = importlib.import_module(ROUTER_GROUPS[group], __package__)
+        app.include_router(module.router, prefix="/api")
+
+    if "medias" in config.api_routers:
+        app.add_middleware(
+            UploadLimitMiddleware,
+            path_prefix="/api/medias",
+            max_bytes=config.media_max_bytes,
+        )
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(QueryStatsMiddleware)
+    app.add_middleware(IdempotencyMiddleware)
+    app.add_middleware(MetricsMiddleware)
+
+    @app.exception_handler(BackendExeption)
+    async def backend_exception_handler(
+        request: Request, exc: BackendExeption
+    ):
+        # Ошибки из зависимостей (например, неизвестный api-key),
+        # которые не перехватываются внутри эндпоинтов
+        return JSONResponse(status_code=404, content=exc.__repr__())
+
+    @app.get("/api/test")
+    def test1():
+        return {"id": 1, "name": "sasa"}
+
+    @app.get("/api/pool")
+    def pool_status_handler():
+        return pool_status(get_engine())
+
+    @app.get("/api/replicas")
+    def replicas_status_handler():
+        return replica_router.status()
+
+    @app.get("/api/ready")
+    async def readiness_handler(
+        response: Response,
+        wait: float = Query(default=0, ge=0, le=MAX_READY_WAIT),
+    ):
+        # 503, пока пулы не прогреты или воркер останавливается;
+        # wait - сколько секунд ждать окончания прогрева
+        if not await readiness.wait(timeout=wait):
+            response.status_code = 503
+        return readiness.status()
 
+    @app.get("/metrics", include_in_schema=False)
+    def metrics_handler():
+        return Response(content=registry.render(), media_type=CONTENT_TYPE)
 
-@app.get("/api/test")
-def test1():
-    return {"id": 1, "name": "sasa"}
+    return app
 
 
-@app.on_event("shutdown")
-async def shutdown():
-    await session.close()
-    await engine.dispose()
+def __getattr__(name: str):
+    # app собирается при первом обращении: project.main:app
+    # для uvicorn и gunicorn
+    if name == "app":
+        app = globals()["app"] = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
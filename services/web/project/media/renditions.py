@@ -0,0 +1,110 @@
+"""
+renditions.py
+----------
+Модуль реализует фоновую подготовку уменьшенных копий картинок.
+Ресайз выполняется в пуле процессов, чтобы не блокировать event loop.
+Пока копии не готовы, в твитах отдается оригинал.
+
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from sqlalchemy import update
+
+from ..config import settings
+from ..database import Media, get_session_maker
+from ..tweets.services import tweet_cache
+
+logger = logging.getLogger(__name__)
+
+# Наибольшая сторона копии в пикселях
+RENDITION_SIZES = {"thumb": 150, "feed": 600, "full": 1600}
+SAVE_OPTIONS = {
+    "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+    "PNG": {"optimize": True},
+    "WEBP": {"quality": 80, "method": 4},
+}
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def render_image(source: str) -> Dict[str, str]:
+    """
+    Сохраняет рядом с оригиналом копии всех размеров в исходном формате
+    и в WebP без метаданных. Выполняется в отдельном процессе
+
+    :return: Dict[str, str]
+        Имена файлов копий по ключам вида feed и feed_webp
+    """
+    from PIL import Image, ImageOps
+
+    source_path = Path(source)
+    renditions = {}
+    with Image.open(source_path) as original:
+        image_format = original.format
+        image = ImageOps.exif_transpose(original)
+        if image_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        for size_name, size in RENDITION_SIZES.items():
+            rendition = image.copy()
+            rendition.thumbnail((size, size))
+            for key, save_format, suffix in (
+                (size_name, image_format, source_path.suffix),
+                (f"{size_name}_webp", "WEBP", ".webp"),
+            ):
+                name = f"{source_path.stem}_{size_name}{suffix}"
+                path = source_path.with_name(name)
+                if not path.exists():
+                    tmp_path = path.with_name(f".{name}.tmp")
+                    rendition.save(
+                        tmp_path, save_format, **SAVE_OPTIONS[save_format]
+                    )
+                    tmp_path.replace(path)
+                renditions[key] = name
+    return renditions
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.media_render_workers
+        )
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def generate_renditions(media_id: int, source: Path, prefix: str):
+    loop = asyncio.get_running_loop()
+    try:
+        names = await loop.run_in_executor(
+            get_executor(), render_image, str(source)
+        )
+    except Exception:
+        logger.exception("Rendering media %s failed", media_id)
+        return
+
+    renditions = {key: prefix + name for key, name in names.items()}
+    async with get_session_maker()() as session:
+        q = await session.execute(
+            update(Media)
+            .where(Media.id == media_id)
+            .values(renditions=renditions)
+            .returning(Media.tweet_id)
+        )
+        tweet_id = q.scalar_one_or_none()
+        await session.commit()
+
+    if tweet_id is not None:
+        await tweet_cache.invalidate(tweet_id)
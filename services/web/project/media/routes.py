@@ -4,27 +4,22 @@ routes.py
 Модуль реализует эндпоинты FastApi для взамодействия с картинками.
 
 """
-from pathlib import Path
 from typing import Union
 
-import aiofiles
-from fastapi import APIRouter, Depends, Header, Response, UploadFile
+from fastapi import APIRouter, BackgroundTasks, Depends, Response, UploadFile
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..database import get_session
+from ..config import settings
 from ..exeptions import BackendExeption
+from ..media.renditions import generate_renditions
 from ..media.schemas import MediaOutSchema
-from ..media.services import check_file, post_image
-from ..schemas_overal import ErrorSchema
+from ..media.services import OUT_PATH, PREFIX_NAME, post_image, save_upload
+from ..replicas import get_write_session
+from ..schemas_overal import CurrentUser, ErrorSchema
+from ..services_overal import get_current_user
 
 router = APIRouter(prefix="/medias", tags=["Medias"])
 
-OUT_PATH = Path(__file__).parent / "media_files"
-# OUT_PATH.mkdir(exist_ok=True, parents=True)
-OUT_PATH = OUT_PATH.absolute()
-
-PREFIX_NAME = "/static/media_files/"
-
 
 @router.post(
     "/",
@@ -36,18 +31,22 @@ PREFIX_NAME = "/static/media_files/"
 async def post_image_handler(
     response: Response,
     file: UploadFile,
-    api_key: str = Header(),
-    session: AsyncSession = Depends(get_session),
+    background_tasks: BackgroundTasks,
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
 ) -> Union[MediaOutSchema, ErrorSchema]:
     """
-    Эндпоинт загрузки изображений для твита
+    Эндпоинт загрузки изображений для твита. Уменьшенные копии
+    картинки готовятся в фоне после ответа
     \f
     :param response: Response
          Обьект ответа на запрос
     :param file: UploadFile
         Файл с картинкой
-    :param api_key: str
-        api-key пользователя
+    :param background_tasks: BackgroundTasks
+        Фоновые задачи, выполняемые после ответа
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
@@ -55,17 +54,21 @@ async def post_image_handler(
         Pydantic-схема для фронтенда с результатом или ошибкой
     """
     try:
-        check_file(file)
-
-        filename = file.filename
-        file_data = await file.read()
-        path = "{}/{}".format(OUT_PATH, filename)
-        async with aiofiles.open(path, mode="wb") as some_file:
-            await some_file.write(file_data)
-
+        filename = await save_upload(
+            file=file, out_path=OUT_PATH, max_bytes=settings.media_max_bytes
+        )
         name_for_db = PREFIX_NAME + filename
 
-        return await post_image(session=session, image_name=name_for_db)
+        result = await post_image(
+            session=session, user=user, image_name=name_for_db
+        )
+        background_tasks.add_task(
+            generate_renditions,
+            media_id=result["media_id"],
+            source=OUT_PATH / filename,
+            prefix=PREFIX_NAME,
+        )
+        return result
     except BackendExeption as e:
-        response.status_code = 400
+        response.status_code = 413 if e.error_type == "FILE TOO LARGE" else 400
         return e
@@ -1,19 +1,125 @@
+import hashlib
+import uuid
+from pathlib import Path
+
+import aiofiles
+import aiofiles.os
+from fastapi import Query, Request, UploadFile
 from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..database import Media
 from ..exeptions import BackendExeption
+from ..metrics import MEDIA_UPLOAD_BYTES, MEDIA_UPLOADS
+from ..schemas_overal import CurrentUser
+
+OUT_PATH = Path(__file__).parent / "media_files"
+# OUT_PATH.mkdir(exist_ok=True, parents=True)
+OUT_PATH = OUT_PATH.absolute()
+
+PREFIX_NAME = "/static/media_files/"
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Сигнатуры (magic bytes) допустимых форматов и расширения файлов
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": ".jpg",
+    b"\x89PNG\r\n\x1a\n": ".png",
+}
+
+
+class RenditionParams:
+    """
+    Параметры выбора копии картинки: ?media_size= и поддержка WebP
+    клиентом по заголовку Accept
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        media_size: str = Query(
+            default="feed", regex="^(thumb|feed|full|original)$"
+        ),
+    ):
+        self.size = media_size
+        self.webp = "image/webp" in request.headers.get("accept", "")
+
+    @property
+    def key(self) -> str:
+        return self.size + ("_webp" if self.webp else "")
 
 
-async def post_image(session: AsyncSession, image_name: str) -> dict:
-    q = await session.execute(insert(Media).values(name=image_name))
+def pick_rendition(media: Media, key: str) -> str:
+    renditions = media.renditions or {}
+    fallback_key = key.replace("_webp", "")
+    return renditions.get(key) or renditions.get(fallback_key) or media.name
+
+
+async def post_image(
+    session: AsyncSession, user: CurrentUser, image_name: str
+) -> dict:
+    q = await session.execute(
+        insert(Media).values(name=image_name, user_id=user.id)
+    )
     image_id = q.inserted_primary_key[0]
     await session.commit()
     return {"result": True, "media_id": image_id}
 
 
-def check_file(file):
-    if file.content_type not in ("image/jpeg", "image/png"):
-        raise BackendExeption(
-            error_type="BAD FILE", error_message="Bad file type"
-        )
+def sniff_image_type(head: bytes) -> str:
+    for signature, extension in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return extension
+    raise BackendExeption(error_type="BAD FILE", error_message="Bad file type")
+
+
+async def save_upload(file: UploadFile, out_path: Path, max_bytes: int) -> str:
+    """
+    Потоково сохраняет загруженный файл во временный файл, проверяя
+    размер и сигнатуру формата, затем атомарно переименовывает его
+    в имя по sha256 содержимого. Одинаковые картинки хранятся один раз
+
+    :return: str
+        Имя сохраненного файла
+    """
+    tmp_path = out_path / f".upload-{uuid.uuid4().hex}"
+    digest = hashlib.sha256()
+    size = 0
+    extension = None
+
+    try:
+        async with aiofiles.open(tmp_path, mode="wb") as tmp_file:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                if extension is None:
+                    extension = sniff_image_type(chunk)
+                size += len(chunk)
+                if size > max_bytes:
+                    raise BackendExeption(
+                        error_type="FILE TOO LARGE",
+                        error_message=f"File is larger than {max_bytes} bytes",
+                    )
+                digest.update(chunk)
+                await tmp_file.write(chunk)
+
+        if extension is None:
+            raise BackendExeption(
+                error_type="BAD FILE", error_message="Empty file"
+            )
+
+        filename = digest.hexdigest() + extension
+        final_path = out_path / filename
+        if await aiofiles.os.path.exists(final_path):
+            await aiofiles.os.remove(tmp_path)
+            MEDIA_UPLOADS.labels("deduplicated").inc()
+        else:
+            await aiofiles.os.replace(tmp_path, final_path)
+            MEDIA_UPLOADS.labels("stored").inc()
+    except BaseException:
+        MEDIA_UPLOADS.labels("rejected").inc()
+        if await aiofiles.os.path.exists(tmp_path):
+            await aiofiles.os.remove(tmp_path)
+        raise
+    finally:
+        MEDIA_UPLOAD_BYTES.inc(size)
+
+    return filename
@@ -0,0 +1,96 @@
+"""
+upload_limit.py
+----------
+Модуль реализует ограничение размера тела запросов загрузки картинок
+до того, как Starlette разберет multipart-форму и сохранит файл во
+временный: запрос с Content-Length больше лимита отклоняется сразу,
+а тело без Content-Length (chunked) - как только прочитано больше
+лимита. Точный размер самого файла проверяет save_upload.
+
+"""
+
+from typing import Optional
+
+from fastapi.responses import JSONResponse
+
+from ..exeptions import BackendExeption
+
+# Запас на заголовки частей и границы multipart-формы, байты.
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+def _content_length(scope) -> Optional[int]:
+    for key, value in scope["headers"]:
+        if key == b"content-length":
+            return int(value) if value.isdigit() else None
+    return None
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI-middleware, отклоняющая с 413 POST-запросы к path_prefix
+    с телом больше max_bytes + MULTIPART_OVERHEAD
+    """
+
+    def __init__(self, app, path_prefix: str, max_bytes: int):
+        self.app = app
+        self.path_prefix = path_prefix
+        self.max_body = max_bytes + MULTIPART_OVERHEAD
+        self.max_bytes = max_bytes
+
+    async def _reject(self, scope, receive, send):
+        response = JSONResponse(
+            status_code=413,
+            content=BackendExeption(
+                error_type="FILE TOO LARGE",
+                error_message=f"File is larger than {self.max_bytes} bytes",
+            ).__repr__(),
+        )
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(self.path_prefix)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        length = _content_length(scope)
+        if length is not None and length > self.max_body:
+            await self._reject(scope, receive, send)
+            return
+
+        received = 0
+        too_large = False
+        started = False
+
+        async def limited_receive():
+            # Превышение лимита выглядит для приложения как обрыв
+            # соединения: разбор формы прекращается, не дочитав тело
+            nonlocal received, too_large
+            if too_large:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    too_large = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if too_large and not started:
+                return
+            started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not too_large or started:
+                raise
+        if too_large and not started:
+            await self._reject(scope, receive, send)
@@ -0,0 +1,382 @@
+"""
+metrics.py
+----------
+Модуль реализует метрики приложения в текстовом формате Prometheus:
+гистограммы задержек и счетчики статусов по шаблонам маршрутов,
+состояние пулов соединений, попадания в кеши и объем загрузок.
+Запись метрики на горячем пути - это поиск в словаре и сложение,
+поэтому метрики можно держать включенными в продакшене.
+
+"""
+
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+UNMATCHED_ROUTE = "unmatched"
+HTTP_METHODS = frozenset(
+    ("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS")
+)
+
+# (суффикс имени, значения меток, значение)
+Sample = Tuple[str, Tuple[Tuple[str, str], ...], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    """
+    Набор метрик, отдаваемых эндпоинтом /metrics
+    """
+
+    def __init__(self):
+        self._metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric") -> "Metric":
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(
+                        f'{name}="{_escape(str(label))}"'
+                        for name, label in labels
+                    )
+                    lines.append(
+                        f"{metric.name}{suffix}{{{label_text}}} "
+                        f"{_format_value(value)}"
+                    )
+                else:
+                    lines.append(
+                        f"{metric.name}{suffix} {_format_value(value)}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Registry = registry,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """
+        Возвращает дочернюю метрику для значений меток. Ссылку на нее
+        стоит сохранить, чтобы не искать ее на каждое событие
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    f"{self.name} expects labels {self.labelnames}"
+                )
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _labels(self, values: Tuple[str, ...], *extra: Tuple[str, str]):
+        return tuple(zip(self.labelnames, values)) + extra
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def samples(self) -> Iterable[Sample]:
+        for values, child in list(self._children.items()):
+            yield "", self._labels(values), child.value
+
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Registry = registry,
+    ):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self) -> Iterable[Sample]:
+        bounds = self.upper_bounds + (float("inf"),)
+        for values, child in list(self._children.items()):
+            total = 0
+            for bound, count in zip(bounds, child.counts):
+                total += count
+                yield "_bucket", self._labels(
+                    values, ("le", _format_value(bound))
+                ), total
+            yield "_sum", self._labels(values), child.sum
+            yield "_count", self._labels(values), total
+
+
+class FunctionMetric(Metric):
+    """
+    Метрика, значения которой вычисляются при чтении /metrics.
+    Функция возвращает пары (значения меток, значение)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        function: Callable[[], Iterable[Tuple[Tuple[str, ...], float]]],
+        type: str = "gauge",
+        registry: Registry = registry,
+    ):
+        self.type = type
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def samples(self) -> Iterable[Sample]:
+        for values, value in self.function():
+            yield "", self._labels(tuple(values)), value
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ("method", "route"),
+)
+HTTP_REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP responses by route template and status code",
+    ("method", "route", "status"),
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by cache namespace and result",
+    ("cache", "result"),
+)
+MEDIA_UPLOAD_BYTES = Counter(
+    "media_upload_bytes_total",
+    "Bytes received in media uploads",
+)
+MEDIA_UPLOADS = Counter(
+    "media_uploads_total",
+    "Media uploads by result",
+    ("result",),
+)
+
+
+def _cache_hit_ratios():
+    totals: Dict[str, List[float]] = {}
+    for (cache, result), child in list(CACHE_REQUESTS._children.items()):
+        hits_and_total = totals.setdefault(cache, [0.0, 0.0])
+        hits_and_total[1] += child.value
+        if result == "hit":
+            hits_and_total[0] += child.value
+    for cache, (hits, total) in totals.items():
+        if total:
+            yield (cache,), hits / total
+
+
+FunctionMetric(
+    "cache_hit_ratio",
+    "Share of cache lookups served from cache since process start",
+    ("cache",),
+    _cache_hit_ratios,
+)
+
+
+POOL_GAUGES = {
+    "size": ("db_pool_size", "gauge", "Configured pool size"),
+    "checked_out": (
+        "db_pool_checked_out",
+        "gauge",
+        "Connections currently in use",
+    ),
+    "checked_in": (
+        "db_pool_checked_in",
+        "gauge",
+        "Idle connections in the pool",
+    ),
+    "overflow": (
+        "db_pool_overflow",
+        "gauge",
+        "Overflow connections above pool size",
+    ),
+    "checkouts": (
+        "db_pool_checkouts_total",
+        "counter",
+        "Connection checkouts",
+    ),
+    "timeouts": (
+        "db_pool_timeouts_total",
+        "counter",
+        "Connection checkouts that failed or timed out",
+    ),
+    "wait_seconds_total": (
+        "db_pool_wait_seconds_total",
+        "counter",
+        "Total time spent waiting for a connection",
+    ),
+    "wait_seconds_max": (
+        "db_pool_wait_seconds_max",
+        "gauge",
+        "Longest wait for a connection since process start",
+    ),
+}
+
+
+def register_pools(
+    statuses: Callable[[], Dict[str, Dict[str, float]]],
+    registry: Registry = registry,
+):
+    """
+    Регистрирует метрики пулов соединений. statuses возвращает
+    словарь {имя пула: pool_status(engine)} и вызывается при чтении
+    """
+
+    def field(key: str):
+        def collect():
+            for pool, status in statuses().items():
+                yield (pool,), status[key]
+
+        return collect
+
+    for key, (name, type, documentation) in POOL_GAUGES.items():
+        FunctionMetric(
+            name, documentation, ("pool",), field(key), type, registry
+        )
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware, записывающая задержку и статус ответа.
+    Метка route - шаблон пути маршрута (/api/tweets/{id}),
+    а не сам путь, чтобы число рядов не зависело от данных
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Dict[object, str] = {}
+
+    def _route_template(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+        template = self._routes.get(endpoint)
+        if template is None:
+            for route in getattr(scope.get("app"), "routes", ()):
+                if getattr(route, "endpoint", None) is endpoint:
+                    template = route.path_format
+                    break
+            else:
+                template = UNMATCHED_ROUTE
+            self._routes[endpoint] = template
+        return template
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            method = scope["method"]
+            if method not in HTTP_METHODS:
+                method = "OTHER"
+            route = self._route_template(scope)
+            HTTP_REQUEST_DURATION.labels(method, route).observe(
+                time.perf_counter() - start
+            )
+            HTTP_REQUESTS.labels(method, route, str(status_code)).inc()
@@ -0,0 +1,92 @@
+"""
+pagination.py
+----------
+Модуль реализует keyset-пагинацию списков с непрозрачным курсором.
+Курсор хранит значения ключа сортировки последнего элемента страницы,
+поэтому стоимость любой страницы равна стоимости первой.
+
+"""
+
+import base64
+import binascii
+import json
+import math
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+from fastapi import Query
+
+from .exeptions import BackendExeption
+
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 200
+# Диапазон integer в БД: целые значения ключа вне его отклоняются.
+INT4_MIN = -(2**31)
+INT4_MAX = 2**31 - 1
+
+
+class PageParams:
+    """
+    Параметры запроса страницы: ?cursor=&limit=
+    """
+
+    def __init__(
+        self,
+        cursor: Optional[str] = None,
+        limit: int = Query(
+            default=DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT
+        ),
+    ):
+        self.cursor = cursor
+        self.limit = limit
+
+
+def encode_cursor(key: Sequence[Any]) -> str:
+    raw = json.dumps(list(key), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _valid_key_value(value: Any, kind: type) -> bool:
+    if kind is float:
+        return type(value) in (int, float) and math.isfinite(value)
+    return type(value) is int and INT4_MIN <= value <= INT4_MAX
+
+
+def decode_cursor(
+    cursor: str, size: int, types: Sequence[type] = ()
+) -> Tuple[Any, ...]:
+    """
+    Значения ключа из курсора. types - тип каждого значения (int или
+    float), по умолчанию int: целые вне диапазона integer БД, дробные
+    и bool вместо целых отклоняются здесь, а не ошибкой драйвера
+    """
+    types = tuple(types) or (int,) * size
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded))
+    except (binascii.Error, ValueError):
+        key = None
+
+    if (
+        not isinstance(key, list)
+        or len(key) != size
+        or not all(
+            _valid_key_value(value, kind) for value, kind in zip(key, types)
+        )
+    ):
+        raise BackendExeption(
+            error_type="BAD CURSOR", error_message="Invalid page cursor"
+        )
+    return tuple(key)
+
+
+def make_page(
+    items: List[Any], limit: int, key: Callable[[Any], Sequence[Any]]
+) -> Tuple[List[Any], Optional[str]]:
+    """
+    Отрезает от выборки из limit + 1 элементов лишний
+    и формирует курсор следующей страницы, если она есть
+    """
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor(key(items[-1]))
@@ -0,0 +1,143 @@
+"""
+readiness.py
+----------
+Модуль реализует проверку готовности воркера принимать трафик.
+При старте воркер в фоне выполняет фазы прогрева (см. warmup.py)
+и только после этого считается готовым: первые запросы не ждут
+установки соединений и компиляции запросов. Время каждой фазы
+пишется в лог и отдается в статусе. Если БД недоступна, фаза
+повторяется до успеха. При остановке воркер снова становится
+неготовым, чтобы балансировщик снял с него трафик.
+
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+logger = logging.getLogger("project.readiness")
+
+# Дольше эндпоинт готовности не ждет окончания прогрева, секунды.
+MAX_READY_WAIT = 30.0
+
+# Фаза прогрева: имя и корутина без аргументов
+Phase = Tuple[str, Callable[[], Awaitable[Any]]]
+
+
+async def warm_pool(
+    engine: AsyncEngine,
+    size: int,
+    warm: Optional[Callable[[AsyncSession], Awaitable[Any]]] = None,
+) -> int:
+    """
+    Одновременно занимает size соединений пула и выполняет на каждом
+    warm(session) (по умолчанию SELECT 1), после чего соединения
+    остаются в пуле. Транзакция откатывается
+
+    :return: int
+        Число прогретых соединений
+    """
+
+    async def check():
+        async with engine.connect() as connection:
+            if warm is None:
+                await connection.execute(text("SELECT 1"))
+            else:
+                async with AsyncSession(bind=connection) as session:
+                    await warm(session)
+            await connection.rollback()
+
+    await asyncio.gather(*(check() for _ in range(size)))
+    return size
+
+
+class Readiness:
+    """
+    Состояние готовности воркера и фоновый прогрев
+    """
+
+    def __init__(self, retry_interval: float = 1.0):
+        self.retry_interval = retry_interval
+        self.phases: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.draining = False
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set() and not self.draining
+
+    def start(self, phases: Sequence[Phase]):
+        """
+        Запускает прогрев в фоне, не задерживая старт сервера
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.warm(phases))
+
+    async def warm(self, phases: Sequence[Phase]):
+        """
+        Выполняет фазы по порядку, упавшая фаза повторяется
+        """
+        for name, phase in phases:
+            while True:
+                if self.draining:
+                    return
+                started = time.perf_counter()
+                try:
+                    await phase()
+                except (OSError, SQLAlchemyError) as e:
+                    self.error = repr(e)
+                    logger.warning(
+                        "warm-up %s failed, will retry: %r", name, e
+                    )
+                    await asyncio.sleep(self.retry_interval)
+                    continue
+                self.phases[name] = time.perf_counter() - started
+                break
+        self.error = None
+        self._ready.set()
+        logger.info(
+            "warm-up done: %s",
+            ", ".join(
+                f"{name} {took:.3f}s" for name, took in self.phases.items()
+            ),
+        )
+
+    async def wait(self, timeout: float = 0) -> bool:
+        """
+        Ждет готовности не дольше timeout секунд
+        """
+        if not self.ready and timeout > 0 and not self.draining:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.ready
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "draining": self.draining,
+            "phases": {
+                name: round(took, 6) for name, took in self.phases.items()
+            },
+            "error": self.error,
+        }
+
+    async def close(self):
+        """
+        Снимает готовность и останавливает незаконченный прогрев
+        """
+        self.draining = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+readiness = Readiness()
@@ -0,0 +1,151 @@
+"""
+replicas.py
+----------
+Модуль реализует маршрутизацию читающих запросов на реплики БД.
+После записи чтения пользователя идут в основную БД в течение
+read_your_writes_window, реплики с отставанием больше replica_max_lag
+исключаются до следующей проверки.
+
+"""
+
+import hashlib
+import itertools
+import math
+import time
+from typing import List, Optional
+
+from fastapi import Depends, Header
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+
+from .cache import SingleFlight, TwoLevelCache, shared_backend
+from .config import settings
+from .database import create_engine, get_session
+
+REPLICA_LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class Replica:
+    def __init__(self, url: str):
+        self.engine = create_engine(url)
+        self.session_maker = sessionmaker(
+            self.engine, expire_on_commit=False, class_=AsyncSession
+        )
+        self.lag: float = math.inf
+        self.checked_at: float = -math.inf
+
+    @property
+    def available(self) -> bool:
+        return self.lag <= settings.replica_max_lag
+
+    async def check_lag(self):
+        try:
+            async with self.engine.connect() as connection:
+                lag = await connection.scalar(REPLICA_LAG_QUERY)
+            self.lag = float(lag or 0)
+        except Exception:
+            self.lag = math.inf
+        self.checked_at = time.monotonic()
+
+
+class ReplicaRouter:
+    def __init__(self, urls: List[str]):
+        self.replicas = [Replica(url) for url in urls]
+        self._next = itertools.cycle(range(len(self.replicas) or 1))
+        self._flight = SingleFlight()
+        self.recent_writers = TwoLevelCache(
+            namespace="ryw",
+            maxsize=settings.auth_cache_size,
+            ttl=settings.read_your_writes_window,
+            shared=shared_backend,
+        )
+
+    @staticmethod
+    def _writer_key(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    async def mark_write(self, api_key: str):
+        await self.recent_writers.set(self._writer_key(api_key), True)
+
+    async def recently_wrote(self, api_key: str) -> bool:
+        return await self.recent_writers.get(self._writer_key(api_key)) is True
+
+    async def _refresh(self, replica: Replica):
+        if (
+            time.monotonic() - replica.checked_at
+            > settings.replica_lag_check_interval
+        ):
+            await self._flight.do(id(replica), replica.check_lag)
+
+    async def choose(self) -> Optional[Replica]:
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._next)]
+            await self._refresh(replica)
+            if replica.available:
+                return replica
+        return None
+
+    def status(self) -> List[dict]:
+        return [
+            {
+                "url": replica.engine.url.render_as_string(hide_password=True),
+                "lag_seconds": (
+                    None if math.isinf(replica.lag) else replica.lag
+                ),
+                "available": replica.available,
+            }
+            for replica in self.replicas
+        ]
+
+    async def dispose(self):
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+
+replica_router = ReplicaRouter(settings.database_replica_urls)
+
+
+@event.listens_for(Session, "after_commit")
+def _remember_commit(session: Session):
+    session.info["committed"] = True
+
+
+async def get_read_session(
+    api_key: str = Header(default="test"),
+    primary_session: AsyncSession = Depends(get_session),
+):
+    replica = None
+    if replica_router.replicas and not await replica_router.recently_wrote(
+        api_key
+    ):
+        replica = await replica_router.choose()
+
+    if replica is None:
+        yield primary_session
+        return
+    async with replica.session_maker() as session:
+        session.info["primary"] = primary_session
+        yield session
+
+
+def primary_of(session: AsyncSession) -> AsyncSession:
+    """
+    Сессия основной БД для сессии чтения. Через нее загружаются
+    записи кешей ответов: ответ отстающей реплики, сохраненный под
+    новой версией сущности, отдавался бы до истечения ttl
+    """
+    return session.info.get("primary", session)
+
+
+async def get_write_session(
+    api_key: str = Header(default="test"),
+    session: AsyncSession = Depends(get_session),
+):
+    yield session
+    if session.info.pop("committed", False):
+        await replica_router.mark_write(api_key)
@@ -0,0 +1,61 @@
+"""
+responses.py
+----------
+Модуль реализует формирование HTTP-ответов из закешированных данных
+и быструю сериализацию JSON через orjson. Ответы, собранные сервисами,
+отдаются как Response, поэтому FastAPI не валидирует их повторно
+по response_model.
+
+"""
+
+from typing import Any, Union
+
+import orjson
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content)
+
+
+def dumps_str(content: Any) -> str:
+    return orjson.dumps(content).decode()
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON-ответ, сериализуемый orjson. Содержимое типа bytes считается
+    уже закодированным JSON и отдается как есть
+    """
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return orjson.dumps(content)
+
+
+def with_fields(body: Union[str, bytes], **fields) -> bytes:
+    """
+    Добавляет поля в начало готового JSON-объекта без его разбора
+    """
+    if isinstance(body, str):
+        body = body.encode()
+    prefix = b",".join(
+        dumps(name) + b":" + dumps(value) for name, value in fields.items()
+    )
+    return b"{" + prefix + (b"," if body[1:2] != b"}" else b"") + body[1:]
+
+
+def cached_json_response(request: Request, entry: dict) -> Response:
+    """
+    Отдает закешированный JSON с ETag, либо 304 без тела,
+    если у клиента уже есть эта версия
+    """
+    headers = {"ETag": entry["etag"], "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if entry["etag"] in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return Response(
+        content=entry["body"], media_type="application/json", headers=headers
+    )
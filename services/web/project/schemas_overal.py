@@ -6,7 +6,12 @@ schemas.py
 
 """
 
-from pydantic import BaseModel
+from typing import List
+
+from pydantic import BaseModel, root_validator
+
+# Наибольшее число id в одном пакетном запросе.
+MAX_BATCH_SIZE = 500
 
 
 class ErrorSchema(BaseModel):
@@ -42,3 +47,72 @@ class OnlyResult(BaseModel):
     """
 
     result: bool
+
+
+class CurrentUser(BaseModel):
+    """
+    Pydantic-схема пользователя, выполняющего запрос.
+    Хранится в кеше аутентификации
+
+    Parameters
+    ----------
+    id: int
+        Идентификатор пользователя в СУБД
+    name: str
+        Имя пользователя
+    """
+
+    id: int
+    name: str
+
+    class Config:
+        orm_mode = True
+
+
+def disjoint_lists(first: str, second: str):
+    """
+    Валидатор пакетной схемы: один id не может быть в обоих списках
+    """
+
+    def check(cls, values):
+        both = set(values[first]) & set(values[second])
+        if both:
+            raise ValueError(f"ids in both lists: {sorted(both)}")
+        return values
+
+    return root_validator(skip_on_failure=True, allow_reuse=True)(check)
+
+
+class BatchItemSchema(BaseModel):
+    """
+    Pydantic-схема результата одного элемента пакетной операции
+
+    Parameters
+    ----------
+    id: int
+        Идентификатор сущности
+    action: str
+        Выполненное действие
+    status: str
+        applied, unchanged, not_found или forbidden
+    """
+
+    id: int
+    action: str
+    status: str
+
+
+class BatchOutSchema(BaseModel):
+    """
+    Pydantic-схема ответа пакетной операции
+
+    Parameters
+    ----------
+    result: bool = True
+        Флаг успешного выполнения
+    items: List[BatchItemSchema]
+        Результаты по каждому id в порядке запроса
+    """
+
+    result: bool = True
+    items: List[BatchItemSchema]
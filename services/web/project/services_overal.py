@@ -1,17 +1,74 @@
+import hashlib
+
+from fastapi import Depends, Header
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .database import User
+from .cache import MISSING, TwoLevelCache, shared_backend
+from .config import settings
+from .database import User, get_session
 from .exeptions import BackendExeption
+from .schemas_overal import CurrentUser
+
+auth_cache = TwoLevelCache(
+    namespace="auth",
+    maxsize=settings.auth_cache_size,
+    ttl=settings.auth_cache_ttl,
+    shared=shared_backend,
+)
+
 
+def _auth_cache_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
 
-async def get_user_by_api_key(session: AsyncSession, api_key: str) -> User:
-    q = await session.execute(select(User).where(User.api_key == api_key))
-    user = q.scalars().one_or_none()
 
-    if not user:
+async def get_user_by_api_key(
+    session: AsyncSession, api_key: str
+) -> CurrentUser:
+    key = _auth_cache_key(api_key)
+    cached = await auth_cache.get(key)
+
+    if cached is MISSING:
+        q = await session.execute(select(User).where(User.api_key == api_key))
+        user = q.scalars().one_or_none()
+        if user:
+            cached = CurrentUser.from_orm(user).dict()
+            await auth_cache.set(key, cached)
+        else:
+            cached = None
+            await auth_cache.set(
+                key, cached, ttl=settings.auth_cache_negative_ttl
+            )
+
+    if not cached:
         raise BackendExeption(
             error_type="NO USER", error_message="No user with such api-key"
         )
 
-    return user
+    return CurrentUser(**cached)
+
+
+async def invalidate_user_cache(api_key: str):
+    await auth_cache.delete(_auth_cache_key(api_key))
+
+
+async def get_current_user(
+    api_key: str = Header(default="test"),
+    session: AsyncSession = Depends(get_session),
+) -> CurrentUser:
+    return await get_user_by_api_key(session=session, api_key=api_key)
+
+
+def batch_item(entity_id: int, action: str, applied: bool, exists: bool):
+    """
+    Результат одного элемента пакетной операции: applied - изменение
+    внесено, unchanged - уже было в нужном состоянии, not_found - нет
+    такой сущности
+    """
+    if applied:
+        status = "applied"
+    elif exists:
+        status = "unchanged"
+    else:
+        status = "not_found"
+    return {"id": entity_id, "action": action, "status": status}
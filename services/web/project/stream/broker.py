@@ -0,0 +1,375 @@
+"""
+broker.py
+----------
+Модуль реализует pub/sub живых обновлений ленты. Сервисы публикуют
+события о новых твитах и изменении числа лайков, брокер раскладывает
+их по подпискам открытых соединений: новые твиты - подписчикам автора,
+лайки - соединениям, которые показывают этот твит.
+
+У каждой подписки ограниченный буфер. События лайков одного твита
+в буфере складываются, при переполнении новые события отбрасываются,
+и клиент получает событие resync - перечитать ленту. Публикация никогда
+не ждет медленных клиентов. Heartbeat всех соединений рассылает один
+общий таймер, а не таймер на каждое соединение.
+
+Доставка между воркерами - через бэкенд: local - только внутри
+процесса, postgres - через LISTEN/NOTIFY основной базы. Пока
+соединение LISTEN не работает или отправка NOTIFY не удалась,
+события теряются, поэтому все подписки процесса получают resync.
+
+"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set
+
+import asyncpg
+import orjson
+from sqlalchemy.engine import make_url
+
+from ..config import Settings, settings
+from ..exeptions import BackendExeption
+from ..metrics import Counter, FunctionMetric
+
+logger = logging.getLogger("project.stream")
+
+# Ограничение размера payload в NOTIFY - 8000 байт.
+MAX_NOTIFY_BYTES = 7500
+# Сколько событий ждет отправки в NOTIFY, более старые отбрасываются.
+MAX_OUTBOX_EVENTS = 10000
+# Событие для всех подписок: перечитать ленту.
+RESYNC = {"type": "resync"}
+
+STREAM_EVENTS_DROPPED = Counter(
+    "stream_events_dropped_total",
+    "Stream events dropped because a buffer was full",
+    ("buffer",),
+)
+
+
+class Subscription:
+    """
+    Подписка одного соединения: авторы, чьи твиты нужны, твиты,
+    чьи лайки нужны, и буфер событий, ожидающих отправки
+    """
+
+    def __init__(
+        self,
+        user_id: int,
+        authors: Set[int],
+        tweets: Set[int],
+        buffer_size: int,
+    ):
+        self.user_id = user_id
+        self.authors = authors
+        self.tweets = tweets
+        self.buffer_size = buffer_size
+        self.events: Dict[tuple, dict] = {}
+        self.overflowed = False
+        self.idle = True
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._dropped = STREAM_EVENTS_DROPPED.labels("connection")
+
+    def push(self, event: dict):
+        key = (event["type"], event["id"])
+        pending = self.events.get(key)
+        if pending is not None:
+            if event["type"] == "likes":
+                pending["delta"] += event["delta"]
+        elif len(self.events) >= self.buffer_size:
+            self.overflowed = True
+            self._dropped.inc()
+        else:
+            self.events[key] = dict(event)
+        self._wakeup.set()
+
+    def resync(self):
+        # События, которые подписка должна была получить, потеряны
+        self.overflowed = True
+        self._wakeup.set()
+
+    def heartbeat(self):
+        if self.idle:
+            self._wakeup.set()
+        self.idle = True
+
+    def close(self):
+        self.closed = True
+        self._wakeup.set()
+
+    async def next_events(self) -> Optional[List[dict]]:
+        """
+        Ждет событий. Пустой список - пора отправить heartbeat,
+        None - подписка закрыта
+        """
+        await self._wakeup.wait()
+        self._wakeup.clear()
+        if self.closed:
+            return None
+
+        events = [
+            event
+            for event in self.events.values()
+            if event["type"] != "likes" or event["delta"]
+        ]
+        self.events = {}
+        if self.overflowed:
+            events.append({"type": "resync"})
+            self.overflowed = False
+        if events:
+            self.idle = False
+        return events
+
+
+class LocalBackend:
+    """
+    Доставка событий только внутри процесса
+    """
+
+    def attach(self, deliver: Callable[[dict], None]):
+        self.deliver = deliver
+
+    def publish(self, event: dict):
+        self.deliver(event)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class PostgresBackend:
+    """
+    Доставка событий всем воркерам через LISTEN/NOTIFY. События
+    копятся в очереди и отправляются пачками по одному NOTIFY,
+    лайки одного твита в пачке складываются. Свои события воркер
+    тоже получает через NOTIFY, поэтому доставка одна для всех
+    """
+
+    def __init__(self, dsn: str, channel: str = "stream_events"):
+        self.dsn = dsn
+        self.channel = channel
+        self._outbox: Deque[dict] = deque(maxlen=MAX_OUTBOX_EVENTS)
+        self._wakeup = asyncio.Event()
+        self._connection: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._listened = False
+        self._dropped = STREAM_EVENTS_DROPPED.labels("outbox")
+
+    def attach(self, deliver: Callable[[dict], None]):
+        self.deliver = deliver
+
+    def publish(self, event: dict):
+        if self._closed:
+            return
+        if len(self._outbox) == self._outbox.maxlen:
+            self._dropped.inc()
+        self._outbox.append(event)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def start(self):
+        """
+        Открывает соединение LISTEN, если его еще нет. После
+        переподключения подписки процесса получают resync: события
+        других воркеров, пока LISTEN не работал, потеряны
+        """
+        if self._connection is None or self._connection.is_closed():
+            self._connection = await asyncpg.connect(self.dsn)
+            # Потерянное соединение переоткрывается циклом отправки
+            self._connection.add_termination_listener(
+                lambda connection: self._wakeup.set()
+            )
+            await self._connection.add_listener(self.channel, self._receive)
+            if self._listened:
+                self.deliver(RESYNC)
+            self._listened = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _receive(self, connection, pid, channel, payload):
+        for event in orjson.loads(payload):
+            self.deliver(event)
+
+    async def _run(self):
+        while not self._closed:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await self.start()
+                await self._send()
+            except (OSError, asyncpg.PostgresError):
+                logger.exception("stream NOTIFY failed, will reconnect")
+                # Вынутые из очереди события не отправлены: подписки
+                # этого процесса получают resync сразу, остальных
+                # воркеров - первым NOTIFY после переподключения
+                self.deliver(RESYNC)
+                if not self._outbox or self._outbox[0] != RESYNC:
+                    self._outbox.appendleft(RESYNC)
+                if self._connection is not None:
+                    self._connection.terminate()
+                    self._connection = None
+                await asyncio.sleep(1)
+                self._wakeup.set()
+
+    async def _send(self):
+        while self._outbox:
+            events: List[dict] = []
+            likes: Dict[int, dict] = {}
+            while self._outbox:
+                event = self._outbox.popleft()
+                if event["type"] == "likes":
+                    pending = likes.get(event["id"])
+                    if pending is not None:
+                        pending["delta"] += event["delta"]
+                        continue
+                    event = likes[event["id"]] = dict(event)
+                events.append(event)
+            for payload in _chunks(events):
+                await self._connection.execute(
+                    "SELECT pg_notify($1, $2)", self.channel, payload
+                )
+
+    async def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._connection is not None:
+            await self._connection.close()
+
+
+def _chunks(events: Iterable[dict]) -> Iterable[str]:
+    chunk: List[bytes] = []
+    size = 2
+    for event in events:
+        encoded = orjson.dumps(event)
+        if chunk and size + len(encoded) + 1 > MAX_NOTIFY_BYTES:
+            yield "[" + b",".join(chunk).decode() + "]"
+            chunk, size = [], 2
+        chunk.append(encoded)
+        size += len(encoded) + 1
+    if chunk:
+        yield "[" + b",".join(chunk).decode() + "]"
+
+
+class Broker:
+    """
+    Реестр подписок процесса и маршрутизация событий по ним
+    """
+
+    def __init__(
+        self,
+        backend,
+        buffer_size: int = settings.stream_buffer_size,
+        heartbeat_interval: float = settings.stream_heartbeat_interval,
+        max_connections: int = settings.stream_max_connections,
+    ):
+        self.backend = backend
+        self.buffer_size = buffer_size
+        self.heartbeat_interval = heartbeat_interval
+        self.max_connections = max_connections
+        self.subscriptions: Set[Subscription] = set()
+        self._by_author: Dict[int, Set[Subscription]] = {}
+        self._by_tweet: Dict[int, Set[Subscription]] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        backend.attach(self.deliver)
+
+    def subscribe(
+        self, user_id: int, authors: Set[int], tweets: Set[int]
+    ) -> Subscription:
+        if len(self.subscriptions) >= self.max_connections:
+            raise BackendExeption(
+                error_type="TOO MANY CONNECTIONS",
+                error_message="Stream connection limit reached",
+            )
+        subscription = Subscription(
+            user_id=user_id,
+            authors=authors,
+            tweets=tweets,
+            buffer_size=self.buffer_size,
+        )
+        self.subscriptions.add(subscription)
+        for author_id in authors:
+            self._by_author.setdefault(author_id, set()).add(subscription)
+        for tweet_id in tweets:
+            self._by_tweet.setdefault(tweet_id, set()).add(subscription)
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+        for index, keys in (
+            (self._by_author, subscription.authors),
+            (self._by_tweet, subscription.tweets),
+        ):
+            for key in keys:
+                subscribers = index.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del index[key]
+
+    def publish(self, event: dict):
+        """
+        Публикует событие без ожидания: {"type": "tweet", "id",
+        "author_id"} или {"type": "likes", "id", "delta"}
+        """
+        self.backend.publish(event)
+
+    def publish_likes(self, deltas: Dict[int, int]):
+        for tweet_id, delta in deltas.items():
+            if delta:
+                self.publish({"type": "likes", "id": tweet_id, "delta": delta})
+
+    async def start(self):
+        await self.backend.start()
+
+    def deliver(self, event: dict):
+        if event["type"] == "resync":
+            for subscription in tuple(self.subscriptions):
+                subscription.resync()
+            return
+        if event["type"] == "tweet":
+            subscribers = self._by_author.get(event["author_id"], ())
+        else:
+            subscribers = self._by_tweet.get(event["id"], ())
+        for subscription in tuple(subscribers):
+            subscription.push(event)
+
+    async def _heartbeat(self):
+        while self.subscriptions:
+            await asyncio.sleep(self.heartbeat_interval)
+            for subscription in tuple(self.subscriptions):
+                subscription.heartbeat()
+
+    async def close(self):
+        for subscription in tuple(self.subscriptions):
+            subscription.close()
+            self.unsubscribe(subscription)
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        await self.backend.close()
+
+
+def make_backend(config: Settings = settings):
+    if config.stream_backend == "postgres":
+        dsn = make_url(config.database_url).set(drivername="postgresql")
+        return PostgresBackend(dsn.render_as_string(hide_password=False))
+    return LocalBackend()
+
+
+broker = Broker(make_backend())
+
+FunctionMetric(
+    "stream_connections",
+    "Open live update connections",
+    (),
+    lambda: [((), len(broker.subscriptions))],
+)
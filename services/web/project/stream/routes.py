@@ -0,0 +1,127 @@
+"""
+routes.py
+----------
+Модуль реализует эндпоинт FastApi живых обновлений ленты
+в формате server-sent events.
+
+"""
+
+from typing import AsyncIterator, Set, Union
+
+from fastapi import APIRouter, Depends, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database import followers, get_session
+from ..exeptions import BackendExeption
+from ..pagination import MAX_PAGE_LIMIT
+from ..replicas import get_read_session
+from ..responses import dumps
+from ..schemas_overal import CurrentUser, ErrorSchema
+from ..services_overal import get_current_user
+from .broker import Broker, Subscription, broker
+
+router = APIRouter(prefix="/stream", tags=["Stream"])
+
+# Клиент переподключается через 5 секунд после обрыва.
+RETRY_MS = 5000
+
+
+def parse_watch(watch: str) -> Set[int]:
+    tweets = {int(tweet_id) for tweet_id in watch.split(",") if tweet_id}
+    if len(tweets) > MAX_PAGE_LIMIT:
+        raise BackendExeption(
+            error_type="BAD WATCH",
+            error_message=f"At most {MAX_PAGE_LIMIT} tweets can be watched",
+        )
+    return tweets
+
+
+async def sse_events(
+    broker: Broker, subscription: Subscription
+) -> AsyncIterator[bytes]:
+    try:
+        yield b"retry: %d\n\n" % RETRY_MS
+        while True:
+            events = await subscription.next_events()
+            if events is None:
+                return
+            if not events:
+                yield b": ping\n\n"
+                continue
+            yield b"".join(
+                b"event: %s\ndata: %s\n\n"
+                % (event["type"].encode(), dumps(event))
+                for event in events
+            )
+    finally:
+        broker.unsubscribe(subscription)
+
+
+@router.get(
+    "",
+    summary="Живые обновления ленты (server-sent events)",
+    response_description="Поток событий text/event-stream",
+    response_model=ErrorSchema,
+    status_code=200,
+)
+async def stream_handler(
+    response: Response,
+    watch: str = Query(default="", regex=r"^(\d+(,\d+)*)?$"),
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_read_session),
+    primary_session: AsyncSession = Depends(get_session),
+) -> Union[Response, ErrorSchema]:
+    """
+    Эндпоинт открывает поток событий для пользователя по api-key:
+    tweet - новый твит автора, на которого он подписан,
+    likes - изменение числа лайков твита из списка watch,
+    resync - события потеряны, ленту нужно перечитать.
+    Без событий раз в stream_heartbeat_interval приходит комментарий
+    \f
+    :param response: Response
+         Обьект ответа на запрос
+    :param watch: str
+        Id показанных твитов через запятую, не больше MAX_PAGE_LIMIT
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+    :param primary_session: Asyncsession
+        Сессия основной БД, через которую проверен api-key
+
+    :return: Union[Response, ErrorSchema]
+        Поток событий или pydantic-схема ошибки
+    """
+    try:
+        tweets = parse_watch(watch)
+    except BackendExeption as e:
+        response.status_code = 422
+        return e
+
+    q = await session.execute(
+        select(followers.c.followed_user_id).where(
+            followers.c.following_user_id == user.id
+        )
+    )
+    authors = set(q.scalars().all())
+    authors.add(user.id)
+    # Соединения с БД не должны жить все время потока
+    await session.close()
+    await primary_session.close()
+
+    try:
+        await broker.start()
+        subscription = broker.subscribe(
+            user_id=user.id, authors=authors, tweets=tweets
+        )
+    except BackendExeption as e:
+        response.status_code = 503
+        return e
+
+    return StreamingResponse(
+        sse_events(broker, subscription),
+        media_type="text/event-stream",
+        headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+    )
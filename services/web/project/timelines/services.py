@@ -0,0 +1,224 @@
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import (
+    delete,
+    insert,
+    literal,
+    or_,
+    select,
+    true,
+    tuple_,
+    union,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database import Tweet, User, followers, in_ids, timelines
+from ..schemas_overal import CurrentUser
+
+# Число подписчиков, начиная с которого твиты автора не раскладываются
+# по лентам подписчиков при публикации, а подмешиваются при чтении ленты.
+FANOUT_ON_READ_THRESHOLD = 10000
+# Сколько последних твитов автора добавляется в ленту при подписке.
+TIMELINE_BACKFILL_LIMIT = 200
+
+
+async def fan_out_tweet(
+    session: AsyncSession, author: CurrentUser, tweet_id: int
+):
+    """
+    Раскладывает твит по лентам подписчиков автора. Флаг
+    fanout_on_read меняется при подписках, поэтому читается
+    из users в том же запросе, а не из кеша аутентификации
+    """
+    await session.execute(
+        insert(timelines).from_select(
+            ["user_id", "tweet_id", "author_id"],
+            select(
+                followers.c.following_user_id,
+                literal(tweet_id),
+                literal(author.id),
+            )
+            .join(User, User.id == followers.c.followed_user_id)
+            .where(
+                followers.c.followed_user_id == author.id,
+                User.fanout_on_read.is_(False),
+            ),
+        )
+    )
+
+
+async def change_followers_counts(
+    session: AsyncSession, user_ids: List[int], delta: int
+) -> Dict[int, bool]:
+    """
+    Меняет счетчики подписчиков пользователей одним запросом
+
+    :return: Dict[int, bool]
+        Флаг fanout_on_read по id пользователя
+    """
+    users = User.__table__
+    q = await session.execute(
+        update(users)
+        .where(in_ids(users.c.id, user_ids))
+        .values(**followers_count_values(delta))
+        .returning(users.c.id, users.c.fanout_on_read)
+    )
+    return dict(q.all())
+
+
+def followers_count_values(delta: int) -> dict:
+    """
+    Значения UPDATE users для изменения счетчика подписчиков.
+    Флаг fanout_on_read липкий: однажды включенный, он не снимается
+    """
+    users = User.__table__
+    new_count = users.c.followers_count + delta
+    return {
+        "followers_count": new_count,
+        "fanout_on_read": or_(
+            users.c.fanout_on_read,
+            new_count >= FANOUT_ON_READ_THRESHOLD,
+        ),
+    }
+
+
+def timeline_backfill(user_id: int, authors):
+    """
+    INSERT в ленту user_id последних твитов авторов из выборки
+    authors с колонкой id
+    """
+    recent_tweets = (
+        select(Tweet.id, Tweet.likes_count)
+        .where(Tweet.user_id == authors.c.id)
+        .order_by(Tweet.id.desc())
+        .limit(TIMELINE_BACKFILL_LIMIT)
+        .lateral()
+    )
+    return (
+        pg_insert(timelines)
+        .from_select(
+            ["user_id", "tweet_id", "author_id", "likes_count"],
+            select(
+                literal(user_id),
+                recent_tweets.c.id,
+                authors.c.id,
+                recent_tweets.c.likes_count,
+            ).join(recent_tweets, true()),
+        )
+        .on_conflict_do_nothing()
+    )
+
+
+def timeline_likes_update(changed):
+    """
+    UPDATE копий счетчика лайков в лентах по выборке changed
+    с колонками id и likes_count, например из RETURNING в CTE
+    """
+    return (
+        update(timelines)
+        .where(timelines.c.tweet_id == changed.c.id)
+        .values(likes_count=changed.c.likes_count)
+    )
+
+
+async def add_authors_to_timeline(
+    session: AsyncSession, user_id: int, author_ids: List[int]
+):
+    if not author_ids:
+        return
+
+    authors = select(User.id).where(in_ids(User.id, author_ids)).subquery()
+    await session.execute(timeline_backfill(user_id=user_id, authors=authors))
+
+
+async def remove_authors_from_timeline(
+    session: AsyncSession, user_id: int, author_ids: List[int]
+):
+    if not author_ids:
+        return
+
+    await session.execute(
+        delete(timelines).where(
+            timelines.c.user_id == user_id,
+            in_ids(timelines.c.author_id, author_ids),
+        )
+    )
+
+
+def feed_branches(
+    user_id: int,
+    limit: int,
+    after: Optional[Tuple[int, int]] = None,
+    since_id: Optional[int] = None,
+) -> List:
+    """
+    Ветви страницы ленты (id, likes_count) по убыванию популярности:
+    материализованная лента по ix_timelines_user_id_popularity, свои
+    твиты и твиты авторов с fanout_on_read по
+    ix_tweets_user_id_popularity. Каждая ветвь - диапазон своего
+    индекса с ключом after = (likes_count, id) и своим LIMIT
+    """
+
+    def branch(query, likes_count, tweet_id):
+        if after is not None:
+            query = query.where(tuple_(likes_count, tweet_id) < tuple_(*after))
+        if since_id is not None:
+            query = query.where(tweet_id > since_id)
+        return query.order_by(likes_count.desc(), tweet_id.desc()).limit(limit)
+
+    materialized = branch(
+        select(
+            timelines.c.tweet_id.label("id"), timelines.c.likes_count
+        ).where(timelines.c.user_id == user_id),
+        timelines.c.likes_count,
+        timelines.c.tweet_id,
+    )
+    own = branch(
+        select(Tweet.id, Tweet.likes_count).where(Tweet.user_id == user_id),
+        Tweet.likes_count,
+        Tweet.id,
+    )
+    authors = (
+        select(followers.c.followed_user_id.label("id"))
+        .join(User, User.id == followers.c.followed_user_id)
+        .where(
+            followers.c.following_user_id == user_id,
+            User.fanout_on_read.is_(True),
+        )
+        .subquery("pull_authors")
+    )
+    pulled = branch(
+        select(Tweet.id, Tweet.likes_count).where(
+            Tweet.user_id == authors.c.id
+        ),
+        Tweet.likes_count,
+        Tweet.id,
+    ).lateral("pulled")
+
+    return [
+        materialized,
+        own,
+        select(pulled.c.id, pulled.c.likes_count)
+        .select_from(authors)
+        .join(pulled, true()),
+    ]
+
+
+def feed_page(
+    user_id: int,
+    limit: int,
+    after: Optional[Tuple[int, int]] = None,
+    since_id: Optional[int] = None,
+):
+    """
+    Подзапрос (id, likes_count) страницы ленты: UNION ветвей
+    feed_branches, отсортированный повторно. Твит, попавший в ленту
+    и как твит автора с fanout_on_read, UNION оставляет один раз
+    """
+    return union(
+        *feed_branches(
+            user_id=user_id, limit=limit, after=after, since_id=since_id
+        )
+    ).subquery("feed")
@@ -0,0 +1,154 @@
+"""
+entities.py
+----------
+Модуль реализует разбор хэштегов и упоминаний в тексте твитов
+и их запись в таблицы tweet_hashtags и mentions. Хэштег приводится
+к нижнему регистру, упоминание @name связывается со всеми
+пользователями с таким именем. Запись идет пачкой для любого числа
+твитов: тремя запросами с параметрами-массивами.
+
+"""
+
+import re
+from typing import Iterable, List, Set, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..database import (
+    Tweet,
+    User,
+    hashtags,
+    int_array,
+    mentions,
+    text_array,
+    tweet_hashtags,
+)
+
+# Длиннее этого хэштеги и упоминания не распознаются.
+MAX_ENTITY_LENGTH = 100
+
+HASHTAG_RE = re.compile(r"(?<!\w)#(\w{1,%d})(?!\w)" % MAX_ENTITY_LENGTH)
+MENTION_RE = re.compile(r"(?<!\w)@(\w{1,%d})(?!\w)" % MAX_ENTITY_LENGTH)
+
+
+def normalize_hashtag(tag: str) -> str:
+    return tag.lstrip("#").casefold()
+
+
+def extract_hashtags(content: str) -> Set[str]:
+    return {normalize_hashtag(tag) for tag in HASHTAG_RE.findall(content)}
+
+
+def extract_mentions(content: str) -> Set[str]:
+    return set(MENTION_RE.findall(content))
+
+
+def _pairs(tweet_ids: List[int], names: List[str], alias: str):
+    return (
+        func.unnest(int_array(tweet_ids), text_array(names))
+        .table_valued("tweet_id", "name")
+        .render_derived(alias)
+    )
+
+
+async def index_tweet_entities(
+    session: AsyncSession, tweets: Iterable[Tuple[int, str]]
+) -> Tuple[int, int]:
+    """
+    Записывает хэштеги и упоминания твитов (id, текст). Повторный
+    вызов для тех же твитов ничего не меняет. Транзакцию не фиксирует
+
+    :return: Tuple[int, int]
+        Число найденных пар (твит, хэштег) и (твит, упоминание)
+    """
+    tags: List[Tuple[int, str]] = []
+    names: List[Tuple[int, str]] = []
+    for tweet_id, content in tweets:
+        content = content or ""
+        tags.extend((tweet_id, tag) for tag in extract_hashtags(content))
+        names.extend((tweet_id, name) for name in extract_mentions(content))
+
+    if tags:
+        # Сортировка задает порядок блокировок уникального индекса
+        # и исключает взаимные блокировки параллельных публикаций
+        await session.execute(
+            pg_insert(hashtags)
+            .from_select(
+                ["name"],
+                select(
+                    func.unnest(text_array(sorted({tag for _, tag in tags})))
+                ),
+            )
+            .on_conflict_do_nothing()
+        )
+        pairs = _pairs(
+            [tweet_id for tweet_id, _ in tags],
+            [tag for _, tag in tags],
+            "tags",
+        )
+        await session.execute(
+            pg_insert(tweet_hashtags)
+            .from_select(
+                ["hashtag_id", "tweet_id"],
+                select(hashtags.c.id, pairs.c.tweet_id)
+                .select_from(pairs)
+                .join(hashtags, hashtags.c.name == pairs.c.name),
+            )
+            .on_conflict_do_nothing()
+        )
+
+    if names:
+        users = User.__table__
+        pairs = _pairs(
+            [tweet_id for tweet_id, _ in names],
+            [name for _, name in names],
+            "names",
+        )
+        await session.execute(
+            pg_insert(mentions)
+            .from_select(
+                ["user_id", "tweet_id"],
+                select(users.c.id, pairs.c.tweet_id)
+                .select_from(pairs)
+                .join(users, users.c.name == pairs.c.name),
+            )
+            .on_conflict_do_nothing()
+        )
+
+    return len(tags), len(names)
+
+
+async def backfill_tweet_entities(
+    session: AsyncSession, batch_size: int = 1000
+) -> Tuple[int, int]:
+    """
+    Разбирает уже опубликованные твиты пачками по возрастанию id,
+    фиксируя каждую пачку отдельно. В памяти держится одна пачка,
+    прерванный запуск можно повторить
+
+    :return: Tuple[int, int]
+        Число найденных пар (твит, хэштег) и (твит, упоминание)
+    """
+    last_id = 0
+    total_tags = total_mentions = 0
+    while True:
+        q = await session.execute(
+            select(Tweet.id, Tweet.content)
+            .where(Tweet.id > last_id)
+            .order_by(Tweet.id)
+            .limit(batch_size)
+        )
+        batch = q.all()
+        if not batch:
+            break
+        found_tags, found_mentions = await index_tweet_entities(
+            session=session, tweets=batch
+        )
+        await session.commit()
+        total_tags += found_tags
+        total_mentions += found_mentions
+        last_id = batch[-1].id
+
+    return total_tags, total_mentions
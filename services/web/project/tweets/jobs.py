@@ -0,0 +1,98 @@
+"""
+jobs.py
+----------
+Модуль реализует служебные задачи обслуживания данных твитов.
+Запуск: python -m project.tweets.jobs <задача>
+
+"""
+
+import argparse
+import asyncio
+from datetime import timedelta
+
+from ..changes import prune_changes
+from ..database import async_session
+from ..idempotency import prune_idempotency_keys
+from ..tweets.entities import backfill_tweet_entities
+from ..tweets.services import reconcile_likes_count
+
+
+async def run_reconcile_likes(batch_size: int):
+    async with async_session() as session:
+        repaired = await reconcile_likes_count(
+            session=session, batch_size=batch_size
+        )
+    print(f"Исправлено счетчиков лайков: {repaired}")
+
+
+async def run_backfill_entities(batch_size: int):
+    async with async_session() as session:
+        found_tags, found_mentions = await backfill_tweet_entities(
+            session=session, batch_size=batch_size
+        )
+    print(f"Найдено хэштегов: {found_tags}, упоминаний: {found_mentions}")
+
+
+async def run_prune_changes(keep_hours: float, batch_size: int):
+    async with async_session() as session:
+        deleted = await prune_changes(
+            session=session,
+            keep=timedelta(hours=keep_hours),
+            batch_size=batch_size,
+        )
+    print(f"Удалено записей журнала изменений: {deleted}")
+
+
+async def run_prune_idempotency_keys(batch_size: int):
+    async with async_session() as session:
+        deleted = await prune_idempotency_keys(
+            session=session, batch_size=batch_size
+        )
+    print(f"Удалено истекших ключей идемпотентности: {deleted}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="job", required=True)
+
+    reconcile = subparsers.add_parser(
+        "reconcile-likes", help="Пересчет счетчиков лайков твитов"
+    )
+    reconcile.add_argument("--batch-size", type=int, default=1000)
+
+    backfill = subparsers.add_parser(
+        "backfill-entities",
+        help="Разбор хэштегов и упоминаний опубликованных твитов",
+    )
+    backfill.add_argument("--batch-size", type=int, default=1000)
+
+    prune = subparsers.add_parser(
+        "prune-changes",
+        help="Очистка журнала изменений для дельта-синхронизации",
+    )
+    prune.add_argument("--keep-hours", type=float, default=24)
+    prune.add_argument("--batch-size", type=int, default=10000)
+
+    prune_keys = subparsers.add_parser(
+        "prune-idempotency-keys",
+        help="Очистка истекших ключей Idempotency-Key",
+    )
+    prune_keys.add_argument("--batch-size", type=int, default=10000)
+
+    args = parser.parse_args()
+    if args.job == "reconcile-likes":
+        asyncio.run(run_reconcile_likes(batch_size=args.batch_size))
+    elif args.job == "backfill-entities":
+        asyncio.run(run_backfill_entities(batch_size=args.batch_size))
+    elif args.job == "prune-changes":
+        asyncio.run(
+            run_prune_changes(
+                keep_hours=args.keep_hours, batch_size=args.batch_size
+            )
+        )
+    elif args.job == "prune-idempotency-keys":
+        asyncio.run(run_prune_idempotency_keys(batch_size=args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,32 +5,213 @@ routes.py
 
 """
 
-from typing import Union
+from typing import Optional, Union
 
-from fastapi import APIRouter, Depends, Header, Response
+from fastapi import APIRouter, Depends, Query, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..database import get_session
 from ..exeptions import BackendExeption
-from ..schemas_overal import ErrorSchema, OnlyResult
+from ..media.services import RenditionParams
+from ..pagination import PageParams
+from ..replicas import get_read_session, get_write_session, primary_of
+from ..responses import FastJSONResponse, cached_json_response, dumps_str
+from ..schemas_overal import (
+    BatchOutSchema,
+    CurrentUser,
+    ErrorSchema,
+    OnlyResult,
+)
+from ..services_overal import get_current_user
 from ..tweets.schemas import (
     BaseAnsTweet,
+    LikeBatchIn,
+    LikeListOutSchema,
+    TweetDeltaOutSchema,
     TweetIn,
     TweetListOutSchema,
     TweetSchema,
 )
 from ..tweets.services import (
+    batch_likes,
     delete_like_to_tweet,
     delete_tweet,
+    get_feed_delta_json,
+    get_hashtag_tweets_json,
+    get_mention_tweets_json,
     get_tweet,
-    get_tweets,
-    insert_media_to_tweet,
+    get_tweet_likes,
+    get_tweets_json,
     post_like_to_tweet,
     post_tweet,
+    search_tweets_json,
+    tweet_cache,
 )
+from .write_behind import like_writer
 
 router = APIRouter(prefix="/tweets", tags=["Tweets"])
 
+# Ограничение длины поискового запроса, символы.
+MAX_SEARCH_QUERY_LENGTH = 256
+
+
+def entity_order(
+    order: str = Query(default="recent", regex="^(recent|popular)$")
+) -> str:
+    return order
+
+
+@router.get(
+    "/search",
+    summary="Полнотекстовый поиск твитов",
+    response_description="Сообщение о результате со списком твитов",
+    response_model=Union[TweetListOutSchema, TweetDeltaOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def search_tweets_handler(
+    response: Response,
+    q: str = Query(min_length=1, max_length=MAX_SEARCH_QUERY_LENGTH),
+    page: PageParams = Depends(),
+    rendition: RenditionParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
+    """
+    Эндпоинт возвращает твиты, подходящие под поисковый запрос,
+    по убыванию релевантности, или сообщение об ошибке. Запрос
+    поддерживает синтаксис websearch: "фраза", or, -исключение
+    \f
+    :param response: Response
+         Обьект ответа на запрос
+    :param q: str
+        Поисковый запрос
+    :param page: PageParams
+        Курсор и размер страницы
+    :param rendition: RenditionParams
+        Размер и формат копий картинок
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+
+    :return: Union[Response, ErrorSchema]
+        JSON со списком твитов для фронтенда или pydantic-схема ошибки
+    """
+
+    try:
+        body = await search_tweets_json(
+            session=session,
+            text=q,
+            cursor=page.cursor,
+            limit=page.limit,
+            media_key=rendition.key,
+        )
+    except BackendExeption as e:
+        response.status_code = 404
+        return e
+
+    return FastJSONResponse(content=body)
+
+
+@router.get(
+    "/tags/{tag}",
+    summary="Получение твитов с хэштегом",
+    response_description="Сообщение о результате со списком твитов",
+    response_model=Union[TweetListOutSchema, TweetDeltaOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_hashtag_tweets_handler(
+    response: Response,
+    tag: str,
+    order: str = Depends(entity_order),
+    page: PageParams = Depends(),
+    rendition: RenditionParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
+    """
+    Эндпоинт возвращает твиты с хэштегом по свежести (order=recent)
+    или популярности (order=popular), или сообщение об ошибке
+    \f
+    :param response: Response
+         Обьект ответа на запрос
+    :param tag: str
+        Хэштег, с символом # или без
+    :param order: str
+        Порядок твитов: recent или popular
+    :param page: PageParams
+        Курсор и размер страницы
+    :param rendition: RenditionParams
+        Размер и формат копий картинок
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+
+    :return: Union[Response, ErrorSchema]
+        JSON со списком твитов для фронтенда или pydantic-схема ошибки
+    """
+
+    try:
+        body = await get_hashtag_tweets_json(
+            session=session,
+            tag=tag,
+            order=order,
+            cursor=page.cursor,
+            limit=page.limit,
+            media_key=rendition.key,
+        )
+    except BackendExeption as e:
+        response.status_code = 404
+        return e
+
+    return FastJSONResponse(content=body)
+
+
+@router.get(
+    "/mentions",
+    summary="Получение твитов, упоминающих пользователя",
+    response_description="Сообщение о результате со списком твитов",
+    response_model=Union[TweetListOutSchema, TweetDeltaOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_mention_tweets_handler(
+    response: Response,
+    user: CurrentUser = Depends(get_current_user),
+    order: str = Depends(entity_order),
+    page: PageParams = Depends(),
+    rendition: RenditionParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
+    """
+    Эндпоинт возвращает твиты с упоминанием @имя пользователя
+    по api-key, по свежести или популярности, или сообщение об ошибке
+    \f
+    :param response: Response
+         Обьект ответа на запрос
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
+    :param order: str
+        Порядок твитов: recent или popular
+    :param page: PageParams
+        Курсор и размер страницы
+    :param rendition: RenditionParams
+        Размер и формат копий картинок
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+
+    :return: Union[Response, ErrorSchema]
+        JSON со списком твитов для фронтенда или pydantic-схема ошибки
+    """
+
+    try:
+        body = await get_mention_tweets_json(
+            session=session,
+            user=user,
+            order=order,
+            cursor=page.cursor,
+            limit=page.limit,
+            media_key=rendition.key,
+        )
+    except BackendExeption as e:
+        response.status_code = 404
+        return e
+
+    return FastJSONResponse(content=body)
+
 
 @router.get(
     "/{id}",
@@ -40,64 +221,115 @@ router = APIRouter(prefix="/tweets", tags=["Tweets"])
     status_code=200,
 )
 async def get_tweet_handler(
-    response: Response, id: int, session: AsyncSession = Depends(get_session)
-) -> Union[TweetSchema, ErrorSchema]:
+    request: Request,
+    response: Response,
+    id: int,
+    rendition: RenditionParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
     """
-    Эндпоинт возвращает твит по идентификатору или сообщение об ошибке
+    Эндпоинт возвращает твит по идентификатору или сообщение об ошибке.
+    Ответ кешируется и поддерживает If-None-Match
     \f
+    :param request: Request
+         Обьект запроса
     :param response: Response
          Обьект ответа на запрос
     :param id: int
         Идентификатор твита в БД
+    :param rendition: RenditionParams
+        Размер и формат копий картинок
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
-    :return: Union[TweetSchema, ErrorSchema]
-        Pydantic-схема для фронтенда с твитом или ошибкой
+    :return: Union[Response, ErrorSchema]
+        JSON твита для фронтенда или pydantic-схема ошибки
     """
 
+    async def load_tweet() -> str:
+        tweet = await get_tweet(
+            session=primary_of(session), tweet_id=id, media_key=rendition.key
+        )
+        return dumps_str(tweet)
+
     try:
-        result = await get_tweet(session=session, tweet_id=id)
+        entry = await tweet_cache.get_or_load(
+            id, load_tweet, variant=rendition.key
+        )
     except BackendExeption as e:
         response.status_code = 404
-        result = e
+        return e
 
-    return result
+    return cached_json_response(request=request, entry=entry)
 
 
 @router.get(
     "/",
-    summary="Получение твитов юзера по api-key",
+    summary="Получение ленты пользователя по api-key",
     response_description="Сообщение о результате со списком твитов",
-    response_model=Union[TweetListOutSchema, ErrorSchema],
+    response_model=Union[TweetListOutSchema, TweetDeltaOutSchema, ErrorSchema],
     status_code=200,
 )
 async def get_tweets_handler(
     response: Response,
-    api_key: str = Header(default="test"),
-    session: AsyncSession = Depends(get_session),
-) -> Union[TweetListOutSchema, ErrorSchema]:
+    user: CurrentUser = Depends(get_current_user),
+    page: PageParams = Depends(),
+    rendition: RenditionParams = Depends(),
+    since_version: Optional[int] = Query(default=None, ge=0),
+    since_id: Optional[int] = Query(default=None, ge=0),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
     """
-    Эндпоинт возвращает твиты пользователя по api-key или сообщение об ошибке
+    Эндпоинт возвращает ленту пользователя по api-key: его твиты и твиты
+    пользователей, на которых он подписан, по убыванию популярности,
+    или сообщение об ошибке. Лента собирается из закодированных
+    фрагментов твитов.
+    since_version=0 добавляет к странице токен version, с ним
+    since_version возвращает только изменения ленты после токена.
+    since_id оставляет в ленте только твиты новее него
     \f
     :param response: Response
          Обьект ответа на запрос
-    :param api_key: str
-        api-key пользователя
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
+    :param page: PageParams
+        Курсор и размер страницы
+    :param rendition: RenditionParams
+        Размер и формат копий картинок
+    :param since_version: int, optional
+        Токен синхронизации из прошлого ответа
+    :param since_id: int, optional
+        Id самого нового уже показанного твита
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
-    :return: Union[TweetListOutSchema, ErrorSchema]
-        Pydantic-схема для фронтенда с твитами пользователя или ошибкой
+    :return: Union[Response, ErrorSchema]
+        JSON с лентой пользователя для фронтенда или pydantic-схема ошибки
     """
 
     try:
-        result = await get_tweets(session=session, api_key=api_key)
+        if since_version:
+            body = await get_feed_delta_json(
+                session=session,
+                user=user,
+                since_version=since_version,
+                media_key=rendition.key,
+            )
+        else:
+            body = await get_tweets_json(
+                session=session,
+                user=user,
+                cursor=page.cursor,
+                limit=page.limit,
+                media_key=rendition.key,
+                since_id=since_id,
+                with_version=since_version is not None,
+            )
     except BackendExeption as e:
         response.status_code = 404
-        result = e
+        return e
 
-    return result
+    return FastJSONResponse(content=body)
 
 
 @router.post(
@@ -110,8 +342,8 @@ async def get_tweets_handler(
 async def post_tweets_handler(
     response: Response,
     tweet: TweetIn,
-    api_key: str = Header(default="test"),
-    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
 ) -> Union[BaseAnsTweet, ErrorSchema]:
     """
     Эндпоинт публикации твита пользователя по его api-key
@@ -120,8 +352,8 @@ async def post_tweets_handler(
          Обьект ответа на запрос
     :param tweet: TweetIn
         данные твита из pedantic-схемы ввода данных
-    :param api_key: str
-        api-key пользователя
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
@@ -130,14 +362,11 @@ async def post_tweets_handler(
     """
     try:
         new_tweet_id = await post_tweet(
-            session=session, api_key=api_key, tweet_data=tweet.tweet_data
+            session=session,
+            user=user,
+            tweet_data=tweet.tweet_data,
+            media_ids=tweet.tweet_media_ids,
         )
-        if tweet.tweet_media_ids:
-            await insert_media_to_tweet(
-                session=session,
-                tweet_id=new_tweet_id,
-                tweet_medias=tweet.tweet_media_ids,
-            )
         return {"result": True, "tweet_id": new_tweet_id}
 
     except BackendExeption as e:
@@ -155,8 +384,8 @@ async def post_tweets_handler(
 async def delete_tweets_handler(
     response: Response,
     id: int,
-    api_key: str = Header(default="test"),
-    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
 ) -> Union[OnlyResult, ErrorSchema]:
     """
     Эндпоинт удаления твита пользователя по его api-key и id твита
@@ -165,8 +394,8 @@ async def delete_tweets_handler(
          Обьект ответа на запрос
     :param id: int
         Идентификатор твита в СУБД
-    :param api_key: str
-        api-key пользователя
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
@@ -174,7 +403,7 @@ async def delete_tweets_handler(
         Pydantic-схема для фронтенда с флагом об удачной операции или ошибкой
     """
     try:
-        await delete_tweet(session=session, api_key=api_key, tweet_id=id)
+        await delete_tweet(session=session, user=user, tweet_id=id)
         return {"result": True}
     except BackendExeption as e:
         response.status_code = 404
@@ -191,18 +420,19 @@ async def delete_tweets_handler(
 async def post_like_to_tweet_handler(
     response: Response,
     id: int,
-    api_key: str = Header(default="test"),
-    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
 ) -> Union[OnlyResult, ErrorSchema]:
     """
-    Эндпоинт регистрации лайка к твиту по api-key и id твита
+    Эндпоинт регистрации лайка к твиту по api-key и id твита.
+    При likes_write_behind лайк записывается в БД отложенно
     \f
     :param response: Response
          Обьект ответа на запрос
     :param id: int
         Идентификатор твита в СУБД
-    :param api_key: str
-        api-key пользователя
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
@@ -210,7 +440,12 @@ async def post_like_to_tweet_handler(
         Pydantic-схема для фронтенда с флагом об удачной операции или ошибкой
     """
     try:
-        await post_like_to_tweet(session=session, api_key=api_key, tweet_id=id)
+        if like_writer is not None:
+            await like_writer.submit(
+                session=session, user=user, tweet_id=id, liked=True
+            )
+        else:
+            await post_like_to_tweet(session=session, user=user, tweet_id=id)
         return {"result": True}
     except BackendExeption as e:
         response.status_code = 404
@@ -227,18 +462,19 @@ async def post_like_to_tweet_handler(
 async def delete_like_to_tweet_handler(
     response: Response,
     id: int,
-    api_key: str = Header(default="test"),
-    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
 ) -> Union[OnlyResult, ErrorSchema]:
     """
-    Эндпоинт удаления лайка к твиту по api-key и id твита
+    Эндпоинт удаления лайка к твиту по api-key и id твита.
+    При likes_write_behind лайк удаляется из БД отложенно
     \f
     :param response: Response
          Обьект ответа на запрос
     :param id: int
         Идентификатор твита в СУБД
-    :param api_key: str
-        api-key пользователя
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
@@ -246,10 +482,99 @@ async def delete_like_to_tweet_handler(
         Pydantic-схема для фронтенда с флагом об удачной операции или ошибкой
     """
     try:
-        await delete_like_to_tweet(
-            session=session, api_key=api_key, tweet_id=id
-        )
+        if like_writer is not None:
+            await like_writer.submit(
+                session=session, user=user, tweet_id=id, liked=False
+            )
+        else:
+            await delete_like_to_tweet(session=session, user=user, tweet_id=id)
         return {"result": True}
     except BackendExeption as e:
         response.status_code = 404
         return e
+
+
+@router.get(
+    "/{id}/likes",
+    summary="Получение лайков твита постранично",
+    response_description="Сообщение о результате со страницей лайков",
+    response_model=Union[LikeListOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_tweet_likes_handler(
+    response: Response,
+    id: int,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[LikeListOutSchema, ErrorSchema]:
+    """
+    Эндпоинт возвращает страницу лайков твита, начиная с последних
+    \f
+    :param response: Response
+         Обьект ответа на запрос
+    :param id: int
+        Идентификатор твита в СУБД
+    :param page: PageParams
+        Курсор и размер страницы
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+
+    :return: Union[LikeListOutSchema, ErrorSchema]
+        Pydantic-схема для фронтенда со страницей лайков или ошибкой
+    """
+    try:
+        return await get_tweet_likes(
+            session=session,
+            tweet_id=id,
+            cursor=page.cursor,
+            limit=page.limit,
+        )
+    except BackendExeption as e:
+        response.status_code = 404
+        return e
+
+
+@router.post(
+    "/likes:batch",
+    summary="Пакетная установка и снятие лайков",
+    response_description="Сообщение о результате по каждому твиту",
+    response_model=Union[BatchOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def batch_likes_handler(
+    response: Response,
+    batch: LikeBatchIn,
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
+) -> Union[BatchOutSchema, ErrorSchema]:
+    """
+    Эндпоинт ставит и снимает лайки пользователя по списку id твитов
+    в одной транзакции и возвращает результат по каждому id.
+    При likes_write_behind отложенные лайки пользователя к этим твитам
+    отменяются: пакет записывается сразу и задает их итоговое состояние
+    \f
+    :param response: Response
+         Обьект ответа на запрос
+    :param batch: LikeBatchIn
+        Списки id твитов для лайка и снятия лайка
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+
+    :return: Union[BatchOutSchema, ErrorSchema]
+        Pydantic-схема для фронтенда с результатами или ошибкой
+    """
+    try:
+        if like_writer is not None:
+            await like_writer.discard(user.id, [*batch.like, *batch.unlike])
+        items = await batch_likes(
+            session=session,
+            user=user,
+            like_ids=batch.like,
+            unlike_ids=batch.unlike,
+        )
+        return {"result": True, "items": items}
+    except BackendExeption as e:
+        response.status_code = 404
+        return e
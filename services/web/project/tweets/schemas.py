@@ -8,10 +8,11 @@ schemas.py
 
 from typing import List, Optional
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, conlist, validator
 from pydantic.schema import Sequence
 from sqlalchemy.ext.associationproxy import _AssociationList
 
+from ..schemas_overal import MAX_BATCH_SIZE, disjoint_lists
 from ..users.schemas import AuthorBaseSchema, AuthorLikeSchema
 
 
@@ -68,7 +69,9 @@ class TweetSchema(BaseModel):
     author: AuthorBaseSchema
         Автор твита
     likes: List[AuthorLikeSchema], optional
-        Список пользователей, отлайкавших твит
+        Последние пользователи, отлайкавшие твит
+    likes_count: int
+        Общее число лайков твита
     """
 
     id: int
@@ -76,11 +79,12 @@ class TweetSchema(BaseModel):
     attachments: Optional[Sequence[str]]
     author: AuthorBaseSchema
     likes: Optional[List[AuthorLikeSchema]]
+    likes_count: int = 0
 
-    @validator("attachments", pre=True, whole=True)
+    @validator("attachments", pre=True)
     def check_roles(cls, v):
-        if type(v) is _AssociationList or issubclass(cls, Sequence):
-            return set(v)
+        if isinstance(v, (list, tuple, _AssociationList)):
+            return list(dict.fromkeys(v))
         raise ValueError("not a valid sequence")
 
     class Config:
@@ -97,7 +101,97 @@ class TweetListOutSchema(BaseModel):
         Флаг успешного выполнения
     tweets: List[TweetSchema], optional
         Список твитов
+    next_cursor: str, optional
+        Курсор следующей страницы, если она есть
+    version: int, optional
+        Токен синхронизации, если запрошен since_version=0
     """
 
     result: bool = True
     tweets: Optional[List[TweetSchema]]
+    next_cursor: Optional[str]
+    version: Optional[int]
+
+
+class TweetLikesCountSchema(BaseModel):
+    """
+    Pydantic-схема нового числа лайков твита
+
+    Parameters
+    ----------
+    id: int
+        Id твита
+    likes_count: int
+        Число лайков
+    """
+
+    id: int
+    likes_count: int
+
+
+class TweetDeltaOutSchema(BaseModel):
+    """
+    Pydantic-схема изменений ленты с токена since_version
+
+    Parameters
+    ----------
+    result: bool = True
+        Флаг успешного выполнения
+    version: int
+        Токен для следующего запроса изменений
+    resync: bool
+        Изменения не восстановить, ленту нужно перечитать
+    tweets: List[TweetSchema]
+        Новые твиты, сначала самые новые
+    likes: List[TweetLikesCountSchema]
+        Твиты, у которых изменилось число лайков
+    deleted: List[int]
+        Id удаленных твитов
+    """
+
+    result: bool = True
+    version: int
+    resync: bool
+    tweets: List[TweetSchema]
+    likes: List[TweetLikesCountSchema]
+    deleted: List[int]
+
+
+class LikeListOutSchema(BaseModel):
+    """
+    Pydantic-схема страницы лайков твита
+
+    Parameters
+    ----------
+    result: bool = True
+        Флаг успешного выполнения
+    likes: List[AuthorLikeSchema]
+        Пользователи, отлайкавшие твит, на странице
+    likes_count: int
+        Общее число лайков твита
+    next_cursor: str, optional
+        Курсор следующей страницы, если она есть
+    """
+
+    result: bool = True
+    likes: List[AuthorLikeSchema]
+    likes_count: int
+    next_cursor: Optional[str]
+
+
+class LikeBatchIn(BaseModel):
+    """
+    Pydantic-схема пакетной установки и снятия лайков
+
+    Parameters
+    ----------
+    like: List[int]
+        id твитов, которым ставится лайк
+    unlike: List[int]
+        id твитов, с которых снимается лайк
+    """
+
+    like: conlist(int, max_items=MAX_BATCH_SIZE) = []
+    unlike: conlist(int, max_items=MAX_BATCH_SIZE) = []
+
+    _disjoint = disjoint_lists("like", "unlike")
@@ -1,133 +1,1034 @@
-from sqlalchemy import delete, insert, select, update
+from typing import Dict, List, Optional
+
+from sqlalchemy import (
+    JSON,
+    Float,
+    String,
+    and_,
+    delete,
+    func,
+    insert,
+    literal,
+    literal_column,
+    or_,
+    select,
+    true,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
-from ..database import Like, Media, Tweet, User
+from ..cache import ResponseCache, shared_backend
+from ..changes import (
+    FOLLOWING_CHANGED,
+    LIKES_CHANGED,
+    TWEET_CREATED,
+    TWEET_DELETED,
+    get_changes,
+    get_current_version,
+    get_sync_state,
+    log_changes,
+)
+from ..config import settings
+from ..database import (
+    SEARCH_CONFIG,
+    Like,
+    Media,
+    Tweet,
+    User,
+    changes,
+    followers,
+    hashtags,
+    in_ids,
+    is_foreign_key_violation,
+    mentions,
+    tweet_hashtags,
+)
 from ..exeptions import BackendExeption
-from ..services_overal import get_user_by_api_key
+from ..media.services import pick_rendition
+from ..pagination import DEFAULT_PAGE_LIMIT, decode_cursor, make_page
+from ..replicas import primary_of
+from ..responses import dumps, dumps_str, with_fields
+from ..schemas_overal import CurrentUser
+from ..services_overal import batch_item
+from ..stream.broker import broker
+from ..timelines.services import (
+    fan_out_tweet,
+    feed_page,
+    timeline_likes_update,
+)
+from .entities import index_tweet_entities, normalize_hashtag
 
+# Сколько лайков встраивается в твит, остальные доступны постранично.
+EMBEDDED_LIKES_LIMIT = 20
 
-async def get_tweet(session: AsyncSession, tweet_id: int):
-    q = await session.execute(
+tweet_cache = ResponseCache(
+    namespace="tweet",
+    maxsize=settings.response_cache_size,
+    ttl=settings.response_cache_ttl,
+    shared=shared_backend,
+)
+
+
+def select_tweets():
+    return (
         select(Tweet)
         .options(selectinload(Tweet.author))
-        .options(selectinload(Tweet.likes).options(selectinload(Like.user)))
         .options(selectinload(Tweet.media))
-        .where(Tweet.id == tweet_id)
     )
-    tweet = q.scalars().one_or_none()
-    if not tweet:
+
+
+def select_tweet_rows(media_key: str = "feed"):
+    """
+    Запрос твитов на уровне Core: только нужные колонки, вложения
+    и последние лайки собираются в самом запросе через array_agg
+    и json_agg, поэтому ORM-объекты не создаются
+    """
+    attachments = (
+        select(
+            func.coalesce(
+                func.array_agg(
+                    aggregate_order_by(
+                        func.coalesce(
+                            Media.renditions[media_key].as_string(),
+                            Media.renditions[
+                                media_key.replace("_webp", "")
+                            ].as_string(),
+                            Media.name,
+                        ),
+                        Media.id,
+                    )
+                ),
+                literal_column("'{}'"),
+                type_=ARRAY(String),
+            )
+        )
+        .where(Media.tweet_id == Tweet.id)
+        .scalar_subquery()
+    )
+    last_likes = (
+        select(Like.id, Like.user_id, User.name)
+        .join(User, User.id == Like.user_id)
+        .where(Like.tweet_id == Tweet.id)
+        .order_by(Like.id.desc())
+        .limit(EMBEDDED_LIKES_LIMIT)
+        .correlate(Tweet)
+        .subquery()
+    )
+    likes = select(
+        func.coalesce(
+            func.json_agg(
+                aggregate_order_by(
+                    func.json_build_object(
+                        "user_id",
+                        last_likes.c.user_id,
+                        "name",
+                        last_likes.c.name,
+                    ),
+                    last_likes.c.id.desc(),
+                )
+            ),
+            literal_column("'[]'::json"),
+            type_=JSON,
+        )
+    ).scalar_subquery()
+    return select(
+        Tweet.id,
+        Tweet.content,
+        Tweet.likes_count,
+        User.id.label("author_id"),
+        User.name.label("author_name"),
+        attachments.label("attachments"),
+        likes.label("likes"),
+    ).join(User, User.id == Tweet.user_id)
+
+
+def tweet_row_to_out(row) -> dict:
+    return {
+        "id": row.id,
+        "content": row.content,
+        "attachments": list(dict.fromkeys(row.attachments)),
+        "author": {"id": row.author_id, "name": row.author_name},
+        "likes": row.likes,
+        "likes_count": row.likes_count,
+    }
+
+
+async def get_likes_preview(
+    session: AsyncSession, tweet_ids: List[int]
+) -> Dict[int, List[dict]]:
+    if not tweet_ids:
+        return {}
+
+    tweet_ids_query = (
+        select(Tweet.id.label("tweet_id"))
+        .where(Tweet.id.in_(tweet_ids))
+        .subquery()
+    )
+    last_likes = (
+        select(Like.user_id, User.name)
+        .join(User, User.id == Like.user_id)
+        .where(Like.tweet_id == tweet_ids_query.c.tweet_id)
+        .order_by(Like.id.desc())
+        .limit(EMBEDDED_LIKES_LIMIT)
+        .lateral()
+    )
+    q = await session.execute(
+        select(
+            tweet_ids_query.c.tweet_id, last_likes.c.user_id, last_likes.c.name
+        ).join(last_likes, true())
+    )
+
+    likes: Dict[int, List[dict]] = {}
+    for tweet_id, user_id, name in q:
+        likes.setdefault(tweet_id, []).append(
+            {"user_id": user_id, "name": name}
+        )
+    return likes
+
+
+def tweet_to_out(
+    tweet: Tweet, likes: List[dict], media_key: str = "feed"
+) -> dict:
+    return {
+        "id": tweet.id,
+        "content": tweet.content,
+        "attachments": [
+            pick_rendition(media=media, key=media_key) for media in tweet.media
+        ],
+        "author": tweet.author,
+        "likes": likes,
+        "likes_count": tweet.likes_count,
+    }
+
+
+async def get_tweet(
+    session: AsyncSession, tweet_id: int, media_key: str = "feed"
+):
+    q = await session.execute(
+        select_tweet_rows(media_key=media_key).where(Tweet.id == tweet_id)
+    )
+    row = q.one_or_none()
+    if not row:
         raise BackendExeption(
             error_type="NO TWEET", error_message="No tweet with such id"
         )
-    return tweet
+    return tweet_row_to_out(row)
+
 
+def _feed_page_query(
+    query,
+    user: CurrentUser,
+    cursor: Optional[str],
+    limit: int,
+    since_id: Optional[int] = None,
+):
+    page = feed_page(
+        user_id=user.id,
+        limit=limit + 1,
+        after=decode_cursor(cursor, size=2) if cursor else None,
+        since_id=since_id,
+    )
+    return query.join(page, page.c.id == Tweet.id).order_by(
+        page.c.likes_count.desc(), page.c.id.desc()
+    )
 
-async def get_tweets(session: AsyncSession, api_key: str):
-    await get_user_by_api_key(session=session, api_key=api_key)
 
+async def get_tweets(
+    session: AsyncSession,
+    user: CurrentUser,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+    media_key: str = "feed",
+):
     q = await session.execute(
-        select(Tweet)
-        .options(selectinload(Tweet.author))
-        .options(selectinload(Tweet.likes).options(selectinload(Like.user)))
-        .options(selectinload(Tweet.media))
-        .where(Tweet.author.has(User.api_key == api_key))
+        _feed_page_query(
+            select_tweet_rows(media_key=media_key),
+            user=user,
+            cursor=cursor,
+            limit=limit,
+        )
+    )
+    rows, next_cursor = make_page(
+        q.all(), limit=limit, key=lambda row: (row.likes_count, row.id)
+    )
+
+    return {
+        "result": True,
+        "tweets": [tweet_row_to_out(row) for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+async def load_tweet_bodies(
+    session: AsyncSession, tweet_ids: List[int], media_key: str = "feed"
+) -> Dict[int, str]:
+    q = await session.execute(
+        select_tweet_rows(media_key=media_key).where(Tweet.id.in_(tweet_ids))
+    )
+    return {row.id: dumps_str(tweet_row_to_out(row)) for row in q}
+
+
+async def get_tweets_json(
+    session: AsyncSession,
+    user: CurrentUser,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+    media_key: str = "feed",
+    since_id: Optional[int] = None,
+    with_version: bool = False,
+) -> bytes:
+    """
+    Лента в виде готового JSON: запрос выбирает только id страницы,
+    твиты берутся из tweet_cache уже закодированными, недостающие
+    загружаются одним запросом, и фрагменты склеиваются в ответ
+    без повторной сериализации и валидации. since_id оставляет
+    только твиты новее него, with_version добавляет в ответ токен
+    синхронизации для get_feed_delta_json
+    """
+    version = await get_current_version(session) if with_version else None
+    q = await session.execute(
+        _feed_page_query(
+            select(Tweet.id, Tweet.likes_count),
+            user=user,
+            cursor=cursor,
+            limit=limit,
+            since_id=since_id,
+        )
+    )
+    rows, next_cursor = make_page(
+        q.all(), limit=limit, key=lambda row: (row.likes_count, row.id)
+    )
+
+    body = await _compose_page(
+        session=session,
+        tweet_ids=[row.id for row in rows],
+        next_cursor=next_cursor,
+        media_key=media_key,
+    )
+    if version is not None:
+        body = with_fields(body, version=version)
+    return body
+
+
+def _feed_changes_condition(user: CurrentUser):
+    authors = select(followers.c.followed_user_id).where(
+        followers.c.following_user_id == user.id
+    )
+    return or_(
+        and_(
+            changes.c.kind.in_((TWEET_CREATED, TWEET_DELETED, LIKES_CHANGED)),
+            or_(
+                changes.c.author_id == user.id,
+                changes.c.author_id.in_(authors),
+            ),
+        ),
+        and_(
+            changes.c.kind == FOLLOWING_CHANGED,
+            changes.c.author_id == user.id,
+        ),
+    )
+
+
+async def get_feed_delta_json(
+    session: AsyncSession,
+    user: CurrentUser,
+    since_version: int,
+    media_key: str = "feed",
+) -> bytes:
+    """
+    Изменения ленты с токена since_version по журналу changes:
+    новые твиты целиком, текущие счетчики лайков изменившихся
+    твитов и id удаленных. resync - дельту построить нельзя
+    (журнал очищен, изменений слишком много или изменились подписки),
+    ленту нужно перечитать. Без изменений - один запрос
+    """
+    state = await get_sync_state(session)
+    rows = await get_changes(
+        session=session,
+        since=since_version,
+        state=state,
+        condition=_feed_changes_condition(user),
+    )
+    if rows is None or any(row.kind == FOLLOWING_CHANGED for row in rows):
+        return dumps(
+            {
+                "result": True,
+                "version": state.version,
+                "resync": True,
+                "tweets": [],
+                "likes": [],
+                "deleted": [],
+            }
+        )
+
+    created, liked, deleted = {}, {}, {}
+    for row in rows:
+        if row.kind == TWEET_CREATED:
+            created[row.entity_id] = True
+        elif row.kind == TWEET_DELETED:
+            deleted[row.entity_id] = True
+        else:
+            liked[row.entity_id] = True
+    new_ids = [tweet_id for tweet_id in created if tweet_id not in deleted]
+    new_ids.reverse()
+    liked_ids = [
+        tweet_id
+        for tweet_id in liked
+        if tweet_id not in created and tweet_id not in deleted
+    ]
+
+    likes = []
+    if liked_ids:
+        q = await session.execute(
+            select(Tweet.id, Tweet.likes_count)
+            .where(in_ids(Tweet.id, liked_ids))
+            .order_by(Tweet.id.desc())
+        )
+        likes = [{"id": row.id, "likes_count": row.likes_count} for row in q]
+
+    return b"".join(
+        (
+            b'{"result":true,"version":',
+            dumps(state.version),
+            b',"resync":false,"tweets":[',
+            await _tweet_fragments(session, new_ids, media_key),
+            b'],"likes":',
+            dumps(likes),
+            b',"deleted":',
+            dumps(list(deleted)),
+            b"}",
+        )
+    )
+
+
+async def _tweet_fragments(
+    session: AsyncSession, tweet_ids: List[int], media_key: str
+) -> bytes:
+    """
+    Закодированные твиты через запятую в порядке tweet_ids,
+    промахи кеша загружаются из основной БД
+    """
+
+    async def load(tweet_ids: List[int]) -> Dict[int, str]:
+        return await load_tweet_bodies(
+            session=primary_of(session),
+            tweet_ids=tweet_ids,
+            media_key=media_key,
+        )
+
+    entries = await tweet_cache.get_many_or_load(
+        tweet_ids, load, variant=media_key
     )
+    return ",".join(
+        entries[tweet_id]["body"]
+        for tweet_id in tweet_ids
+        if tweet_id in entries
+    ).encode()
 
-    tweets = q.scalars().all()
 
-    return {"result": True, "tweets": tweets}
+async def _compose_page(
+    session: AsyncSession,
+    tweet_ids: List[int],
+    next_cursor: Optional[str],
+    media_key: str,
+) -> bytes:
+    return b"".join(
+        (
+            b'{"result":true,"tweets":[',
+            await _tweet_fragments(session, tweet_ids, media_key),
+            b'],"next_cursor":',
+            dumps(next_cursor),
+            b"}",
+        )
+    )
+
+
+def _search_page_query(text: str, cursor: Optional[str], limit: int):
+    query = func.websearch_to_tsquery(
+        literal_column(f"'{SEARCH_CONFIG}'::regconfig"), text
+    )
+    matches = (
+        select(
+            Tweet.id,
+            func.ts_rank_cd(Tweet.search_vector, query, type_=Float).label(
+                "rank"
+            ),
+        )
+        .where(Tweet.search_vector.bool_op("@@")(query))
+        .subquery()
+    )
+    page = (
+        select(matches.c.id, matches.c.rank)
+        .order_by(matches.c.rank.desc(), matches.c.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        rank, tweet_id = decode_cursor(cursor, size=2, types=(float, int))
+        page = page.where(
+            tuple_(matches.c.rank, matches.c.id) < tuple_(rank, tweet_id)
+        )
+    return page
+
+
+async def search_tweets_json(
+    session: AsyncSession,
+    text: str,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+    media_key: str = "feed",
+) -> bytes:
+    """
+    Полнотекстовый поиск по твитам: совпадения ищутся по GIN-индексу
+    на tweets.search_vector и сортируются по релевантности, затем
+    по убыванию id. Курсор хранит пару (релевантность, id)
+    """
+    q = await session.execute(
+        _search_page_query(text=text, cursor=cursor, limit=limit)
+    )
+    rows, next_cursor = make_page(
+        q.all(), limit=limit, key=lambda row: (row.rank, row.id)
+    )
+    return await _compose_page(
+        session=session,
+        tweet_ids=[row.id for row in rows],
+        next_cursor=next_cursor,
+        media_key=media_key,
+    )
+
+
+def _entity_page_query(
+    entity_table, condition, order: str, cursor: Optional[str], limit: int
+):
+    """
+    Страница id твитов из инвертированного индекса: свежие
+    по первичному ключу индекса, популярные через join с tweets
+    """
+    tweet_id = entity_table.c.tweet_id
+    if order == "popular":
+        query = (
+            select(Tweet.id, Tweet.likes_count)
+            .join(entity_table, tweet_id == Tweet.id)
+            .where(condition)
+            .order_by(Tweet.likes_count.desc(), Tweet.id.desc())
+        )
+        if cursor:
+            likes_count, last_id = decode_cursor(cursor, size=2)
+            query = query.where(
+                tuple_(Tweet.likes_count, Tweet.id)
+                < tuple_(likes_count, last_id)
+            )
+    else:
+        query = (
+            select(tweet_id.label("id"))
+            .where(condition)
+            .order_by(tweet_id.desc())
+        )
+        if cursor:
+            (last_id,) = decode_cursor(cursor, size=1)
+            query = query.where(tweet_id < last_id)
+    return query.limit(limit + 1)
+
+
+async def _get_entity_tweets_json(
+    session: AsyncSession,
+    entity_table,
+    condition,
+    order: str,
+    cursor: Optional[str],
+    limit: int,
+    media_key: str,
+) -> bytes:
+    q = await session.execute(
+        _entity_page_query(
+            entity_table,
+            condition,
+            order=order,
+            cursor=cursor,
+            limit=limit,
+        )
+    )
+    if order == "popular":
+        rows, next_cursor = make_page(
+            q.all(), limit=limit, key=lambda row: (row.likes_count, row.id)
+        )
+    else:
+        rows, next_cursor = make_page(
+            q.all(), limit=limit, key=lambda row: (row.id,)
+        )
+    return await _compose_page(
+        session=session,
+        tweet_ids=[row.id for row in rows],
+        next_cursor=next_cursor,
+        media_key=media_key,
+    )
+
+
+async def get_hashtag_tweets_json(
+    session: AsyncSession,
+    tag: str,
+    order: str = "recent",
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+    media_key: str = "feed",
+) -> bytes:
+    """
+    Твиты с хэштегом по свежести (recent) или популярности (popular)
+    """
+    hashtag_id = (
+        select(hashtags.c.id)
+        .where(hashtags.c.name == normalize_hashtag(tag))
+        .scalar_subquery()
+    )
+    return await _get_entity_tweets_json(
+        session=session,
+        entity_table=tweet_hashtags,
+        condition=tweet_hashtags.c.hashtag_id == hashtag_id,
+        order=order,
+        cursor=cursor,
+        limit=limit,
+        media_key=media_key,
+    )
+
+
+async def get_mention_tweets_json(
+    session: AsyncSession,
+    user: CurrentUser,
+    order: str = "recent",
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+    media_key: str = "feed",
+) -> bytes:
+    """
+    Твиты, упоминающие пользователя, по свежести или популярности
+    """
+    return await _get_entity_tweets_json(
+        session=session,
+        entity_table=mentions,
+        condition=mentions.c.user_id == user.id,
+        order=order,
+        cursor=cursor,
+        limit=limit,
+        media_key=media_key,
+    )
+
+
+async def get_tweets_orm(
+    session: AsyncSession,
+    user: CurrentUser,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+    media_key: str = "feed",
+):
+    """
+    Прежний путь чтения ленты через ORM-объекты, оставлен
+    для сравнения с get_tweets в benchmarks.read_path
+    """
+    q = await session.execute(
+        _feed_page_query(
+            select_tweets(), user=user, cursor=cursor, limit=limit
+        )
+    )
+    tweets, next_cursor = make_page(
+        q.scalars().all(),
+        limit=limit,
+        key=lambda tweet: (tweet.likes_count, tweet.id),
+    )
+    likes = await get_likes_preview(
+        session=session, tweet_ids=[tweet.id for tweet in tweets]
+    )
+
+    return {
+        "result": True,
+        "tweets": [
+            tweet_to_out(
+                tweet=tweet,
+                likes=likes.get(tweet.id, []),
+                media_key=media_key,
+            )
+            for tweet in tweets
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+async def get_tweet_likes(
+    session: AsyncSession,
+    tweet_id: int,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+):
+    q = await session.execute(
+        select(Tweet.likes_count).where(Tweet.id == tweet_id)
+    )
+    likes_count = q.scalar_one_or_none()
+    if likes_count is None:
+        raise BackendExeption(
+            error_type="NO TWEET", error_message="No tweet with such id"
+        )
+
+    query = (
+        select(Like.id, Like.user_id, User.name)
+        .join(User, User.id == Like.user_id)
+        .where(Like.tweet_id == tweet_id)
+        .order_by(Like.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        (like_id,) = decode_cursor(cursor, size=1)
+        query = query.where(Like.id < like_id)
+    q = await session.execute(query)
+
+    likes, next_cursor = make_page(
+        q.all(), limit=limit, key=lambda like: (like.id,)
+    )
+
+    return {
+        "result": True,
+        "likes": [
+            {"user_id": like.user_id, "name": like.name} for like in likes
+        ],
+        "likes_count": likes_count,
+        "next_cursor": next_cursor,
+    }
 
 
 async def post_tweet(
-    session: AsyncSession, api_key: str, tweet_data: str
+    session: AsyncSession,
+    user: CurrentUser,
+    tweet_data: str,
+    media_ids: Optional[List[int]] = None,
 ) -> int:
-    user = await get_user_by_api_key(session=session, api_key=api_key)
-
+    tweets = Tweet.__table__
+    new_tweet = (
+        insert(tweets)
+        .values(content=tweet_data, user_id=user.id)
+        .returning(tweets.c.id, tweets.c.user_id)
+        .cte("new_tweet")
+    )
+    logged = log_changes(
+        TWEET_CREATED, select(new_tweet.c.id, new_tweet.c.user_id)
+    ).cte("logged")
     insert_tweet_query = await session.execute(
-        insert(Tweet).values(
-            content=tweet_data,
-            user_id=user.id,
-        )
+        select(new_tweet.c.id).add_cte(logged)
+    )
+    new_tweet_id = insert_tweet_query.scalar_one()
+    await index_tweet_entities(
+        session=session, tweets=[(new_tweet_id, tweet_data)]
     )
-    new_tweet_id = insert_tweet_query.inserted_primary_key[0]
+
+    if media_ids:
+        await attach_media_to_tweet(
+            session=session,
+            user=user,
+            tweet_id=new_tweet_id,
+            media_ids=set(media_ids),
+        )
+    await fan_out_tweet(session=session, author=user, tweet_id=new_tweet_id)
     await session.commit()
+    broker.publish({"type": "tweet", "id": new_tweet_id, "author_id": user.id})
 
     return new_tweet_id
 
 
-async def insert_media_to_tweet(
-    session: AsyncSession, tweet_id: int, tweet_medias: list
+async def attach_media_to_tweet(
+    session: AsyncSession, user: CurrentUser, tweet_id: int, media_ids: set
 ):
-    for media_id in tweet_medias:
-        await session.execute(
-            update(Media).where(Media.id == media_id).values(tweet_id=tweet_id)
+    q = await session.execute(
+        update(Media)
+        .where(
+            Media.id.in_(media_ids),
+            Media.user_id == user.id,
+            Media.tweet_id.is_(None),
+        )
+        .values(tweet_id=tweet_id)
+        .returning(Media.id)
+        .execution_options(synchronize_session=False)
+    )
+    bad_media_ids = media_ids - set(q.scalars().all())
+    if bad_media_ids:
+        await session.rollback()
+        raise BackendExeption(
+            error_type="BAD MEDIA",
+            error_message="Media {} not found or already attached".format(
+                sorted(bad_media_ids)
+            ),
         )
-        await session.commit()
-
 
-async def delete_tweet(session: AsyncSession, api_key: str, tweet_id: int):
-    user = await get_user_by_api_key(session=session, api_key=api_key)
-    await get_tweet(session=session, tweet_id=tweet_id)
 
+async def delete_tweet(
+    session: AsyncSession, user: CurrentUser, tweet_id: int
+):
     q1 = await session.execute(
         select(Tweet.user_id).where(Tweet.id == tweet_id)
     )
     author_id = q1.scalars().one_or_none()
+    if author_id is None:
+        raise BackendExeption(
+            error_type="NO TWEET", error_message="No tweet with such id"
+        )
     if author_id != user.id:
         raise BackendExeption(
             error_type="NO ACCSESS",
             error_message="Tweet belongs to other user",
         )
 
-    await session.execute(
-        delete(Tweet).where(Tweet.id == tweet_id, Tweet.user_id == user.id)
+    tweets = Tweet.__table__
+    deleted = (
+        delete(tweets)
+        .where(tweets.c.id == tweet_id, tweets.c.user_id == user.id)
+        .returning(tweets.c.id, tweets.c.user_id)
+        .cte("deleted")
     )
+    logged = log_changes(
+        TWEET_DELETED, select(deleted.c.id, deleted.c.user_id)
+    ).cte("logged")
+    await session.execute(select(deleted.c.id).add_cte(logged))
     await session.commit()
+    await tweet_cache.invalidate(tweet_id)
 
 
 async def post_like_to_tweet(
-    session: AsyncSession, api_key: str, tweet_id: int
+    session: AsyncSession, user: CurrentUser, tweet_id: int
 ):
-    user = await get_user_by_api_key(session=session, api_key=api_key)
-    await get_tweet(session=session, tweet_id=tweet_id)
-
+    """
+    Ставит лайк одним запросом: вставка с ON CONFLICT DO NOTHING
+    и увеличение счетчика в CTE. Нарушение внешнего ключа означает,
+    что твита нет, пустой RETURNING - что лайк уже стоит
+    """
+    likes = Like.__table__
+    tweets = Tweet.__table__
+    new_like = (
+        pg_insert(likes)
+        .values(tweet_id=tweet_id, user_id=user.id)
+        .on_conflict_do_nothing()
+        .returning(likes.c.id, likes.c.tweet_id)
+        .cte("new_like")
+    )
+    liked = (
+        update(tweets)
+        .where(tweets.c.id == new_like.c.tweet_id)
+        .values(likes_count=tweets.c.likes_count + 1)
+        .returning(
+            new_like.c.id.label("like_id"),
+            tweets.c.id,
+            tweets.c.user_id,
+            tweets.c.likes_count,
+        )
+        .cte("liked")
+    )
+    logged = log_changes(
+        LIKES_CHANGED, select(liked.c.id, liked.c.user_id)
+    ).cte("logged")
+    synced = timeline_likes_update(liked).cte("synced")
     try:
-        insert_like_query = await session.execute(
-            insert(Like).values(
-                tweet_id=tweet_id,
-                user_id=user.id,
-            )
+        q = await session.execute(
+            select(liked.c.like_id).add_cte(logged, synced)
         )
-        new_like_id = insert_like_query.inserted_primary_key[0]
-        await session.commit()
-    except IntegrityError:
+        new_like_id = q.scalar_one_or_none()
+    except IntegrityError as e:
+        await session.rollback()
+        if is_foreign_key_violation(e):
+            raise BackendExeption(
+                error_type="NO TWEET", error_message="No tweet with such id"
+            )
+        raise
+    if new_like_id is None:
+        await session.rollback()
         raise BackendExeption(
             error_type="BAD LIKE", error_message="Such like already exists"
         )
+    await session.commit()
+    await tweet_cache.invalidate(tweet_id)
+    broker.publish_likes({tweet_id: 1})
 
     return new_like_id
 
 
 async def delete_like_to_tweet(
-    session: AsyncSession, api_key: str, tweet_id: int
+    session: AsyncSession, user: CurrentUser, tweet_id: int
 ):
-    user = await get_user_by_api_key(session=session, api_key=api_key)
-    tweet = await get_tweet(session=session, tweet_id=tweet_id)
-    q = await session.execute(
-        select(Like)
-        .where(Like.user_id == user.id)
-        .where(Like.tweet_id == tweet.id)
+    """
+    Снимает лайк одним запросом: удаление и уменьшение счетчика в CTE
+    """
+    likes = Like.__table__
+    tweets = Tweet.__table__
+    deleted_like = (
+        delete(likes)
+        .where(likes.c.tweet_id == tweet_id, likes.c.user_id == user.id)
+        .returning(likes.c.tweet_id)
+        .cte("deleted_like")
+    )
+    unliked = (
+        update(tweets)
+        .where(tweets.c.id == deleted_like.c.tweet_id)
+        .values(likes_count=tweets.c.likes_count - 1)
+        .returning(tweets.c.id, tweets.c.user_id, tweets.c.likes_count)
+        .cte("unliked")
     )
-    like = q.scalars().one_or_none()
-    if not like:
+    logged = log_changes(
+        LIKES_CHANGED, select(unliked.c.id, unliked.c.user_id)
+    ).cte("logged")
+    synced = timeline_likes_update(unliked).cte("synced")
+    q = await session.execute(select(unliked.c.id).add_cte(logged, synced))
+    if q.scalar_one_or_none() is None:
+        await session.rollback()
         raise BackendExeption(
             error_type="BAD LIKE DELETE",
             error_message="No like for tweet from user",
         )
+    await session.commit()
+    await tweet_cache.invalidate(tweet_id)
+    broker.publish_likes({tweet_id: -1})
+
 
+async def change_likes_counts(
+    session: AsyncSession, tweet_ids: List[int], delta: int
+):
+    tweets = Tweet.__table__
+    changed = (
+        update(tweets)
+        .where(in_ids(tweets.c.id, tweet_ids))
+        .values(likes_count=tweets.c.likes_count + delta)
+        .returning(tweets.c.id, tweets.c.user_id, tweets.c.likes_count)
+        .cte("changed")
+    )
     await session.execute(
-        delete(Like).where(Like.tweet_id == tweet_id, Like.user_id == user.id)
+        log_changes(
+            LIKES_CHANGED, select(changed.c.id, changed.c.user_id)
+        ).add_cte(timeline_likes_update(changed).cte("synced"))
     )
+
+
+async def batch_likes(
+    session: AsyncSession,
+    user: CurrentUser,
+    like_ids: List[int],
+    unlike_ids: List[int],
+) -> List[dict]:
+    """
+    Ставит и снимает лайки пачкой в одной транзакции: вставка
+    INSERT ... SELECT ... ON CONFLICT DO NOTHING, удаление
+    DELETE ... WHERE tweet_id = ANY(...), счетчики обновляются
+    одним запросом на каждое направление
+
+    :return: List[dict]
+        Результат по каждому id в порядке запроса
+    """
+    like_ids = list(dict.fromkeys(like_ids))
+    unlike_ids = list(dict.fromkeys(unlike_ids))
+    liked, unliked = set(), set()
+
+    if like_ids:
+        q = await session.execute(
+            pg_insert(Like)
+            .from_select(
+                ["tweet_id", "user_id"],
+                select(Tweet.id, literal(user.id)).where(
+                    in_ids(Tweet.id, like_ids)
+                ),
+            )
+            .on_conflict_do_nothing()
+            .returning(Like.tweet_id)
+        )
+        liked = set(q.scalars().all())
+    if unlike_ids:
+        q = await session.execute(
+            delete(Like)
+            .where(Like.user_id == user.id, in_ids(Like.tweet_id, unlike_ids))
+            .returning(Like.tweet_id)
+            .execution_options(synchronize_session=False)
+        )
+        unliked = set(q.scalars().all())
+
+    unchanged = [
+        tweet_id for tweet_id in like_ids if tweet_id not in liked
+    ] + [tweet_id for tweet_id in unlike_ids if tweet_id not in unliked]
+    existing = set()
+    if unchanged:
+        q = await session.execute(
+            select(Tweet.id).where(in_ids(Tweet.id, unchanged))
+        )
+        existing = set(q.scalars().all())
+
+    if liked:
+        await change_likes_counts(
+            session=session, tweet_ids=list(liked), delta=1
+        )
+    if unliked:
+        await change_likes_counts(
+            session=session, tweet_ids=list(unliked), delta=-1
+        )
     await session.commit()
+    await tweet_cache.invalidate(*liked, *unliked)
+    broker.publish_likes(
+        {**dict.fromkeys(liked, 1), **dict.fromkeys(unliked, -1)}
+    )
+
+    return [
+        batch_item(tweet_id, action, tweet_id in changed, tweet_id in existing)
+        for action, tweet_ids, changed in (
+            ("like", like_ids, liked),
+            ("unlike", unlike_ids, unliked),
+        )
+        for tweet_id in tweet_ids
+    ]
+
+
+async def reconcile_likes_count(
+    session: AsyncSession, batch_size: int = 1000
+) -> int:
+    """
+    Пересчитывает счетчики лайков твитов по таблице likes
+    пачками по диапазонам id, фиксируя каждую пачку отдельно.
+    Твиты пачки сначала блокируются FOR NO KEY UPDATE: лайки,
+    зафиксированные до блокировки, попадают в подсчет, а более
+    поздние ждут ее снятия и прибавляются к исправленному счетчику.
+    Копии счетчика в лентах исправляются тем же запросом
+
+    :return: int
+        Число исправленных твитов
+    """
+    q = await session.execute(select(func.max(Tweet.id)))
+    max_id = q.scalar() or 0
+    repaired = 0
+
+    for start_id in range(0, max_id, batch_size):
+        in_batch = and_(Tweet.id > start_id, Tweet.id <= start_id + batch_size)
+        await session.execute(
+            select(Tweet.id)
+            .where(in_batch)
+            .order_by(Tweet.id)
+            .with_for_update(key_share=True)
+        )
+        actual = (
+            select(Tweet.id, func.count(Like.id).label("likes_count"))
+            .outerjoin(Like, Like.tweet_id == Tweet.id)
+            .where(in_batch)
+            .group_by(Tweet.id)
+            .subquery()
+        )
+        tweets = Tweet.__table__
+        fixed = (
+            update(tweets)
+            .where(
+                tweets.c.id == actual.c.id,
+                tweets.c.likes_count != actual.c.likes_count,
+            )
+            .values(likes_count=actual.c.likes_count)
+            .returning(tweets.c.id, tweets.c.likes_count)
+            .cte("fixed")
+        )
+        q = await session.execute(
+            select(func.count())
+            .select_from(fixed)
+            .add_cte(timeline_likes_update(fixed).cte("synced"))
+        )
+        repaired += q.scalar_one()
+        await session.commit()
+
+    return repaired
@@ -0,0 +1,286 @@
+"""
+write_behind.py
+----------
+Модуль реализует отложенную запись лайков (write-behind). Лайк
+подтверждается клиенту после проверки, а сама запись копится
+в буфере процесса и сбрасывается в БД пачкой по размеру буфера
+или по таймеру: вставка и удаление - многострочными запросами
+через unnest, счетчики одного твита складываются в одно изменение.
+При остановке приложения буфер сбрасывается полностью.
+
+Включается настройкой likes_write_behind. Буфер живет в памяти
+процесса: при аварийном завершении несброшенные лайки теряются,
+поэтому режим предназначен для пиков нагрузки на популярные твиты.
+Повторный лайк и снятие несуществующего лайка получают те же ошибки,
+что и при синхронной записи; отложенные действия других воркеров
+при этой проверке не видны.
+
+"""
+
+import asyncio
+import logging
+from collections import Counter as Deltas
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..changes import LIKES_CHANGED, log_changes
+from ..config import settings
+from ..database import Like, Tweet, get_session_maker, in_ids, int_array
+from ..exeptions import BackendExeption
+from ..metrics import Counter, FunctionMetric
+from ..schemas_overal import CurrentUser
+from ..stream.broker import broker
+from ..timelines.services import timeline_likes_update
+from .services import tweet_cache
+
+logger = logging.getLogger("project.likes")
+
+LIKES_FLUSHED = Counter(
+    "likes_write_behind_flushed_total",
+    "Like and unlike actions written by write-behind flushes",
+    ("result",),
+)
+
+
+class LikeWriteBehind:
+    """
+    Буфер лайков: ключ (user_id, tweet_id), значение - последнее
+    действие пользователя (True - лайк, False - снятие лайка).
+    Без session_maker используются сессии основной БД
+    """
+
+    def __init__(
+        self,
+        session_maker=None,
+        flush_size: int = settings.likes_flush_size,
+        flush_interval: float = settings.likes_flush_interval,
+    ):
+        self.session_maker = session_maker
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending: Dict[Tuple[int, int], bool] = {}
+        self._flushing: Dict[Tuple[int, int], bool] = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    async def submit(
+        self,
+        session: AsyncSession,
+        user: CurrentUser,
+        tweet_id: int,
+        liked: bool,
+    ):
+        """
+        Проверяет действие так же, как синхронная запись: твит должен
+        существовать, лайк - отсутствовать, снимаемый лайк - быть.
+        Состояние лайка - последнее действие в буфере или в начатом
+        сбросе, а без них - строка в БД. Ставит действие в буфер
+        """
+        if self._closed:
+            raise RuntimeError("like write-behind queue is closed")
+        key = (user.id, tweet_id)
+        # Действие, которое сброс может записать во время запроса
+        buffered = self.pending.get(key, self._flushing.get(key))
+        q = await session.execute(
+            select(
+                Tweet.id,
+                select(Like.tweet_id)
+                .where(Like.user_id == user.id, Like.tweet_id == tweet_id)
+                .exists(),
+            ).where(Tweet.id == tweet_id)
+        )
+        row = q.one_or_none()
+        if row is None:
+            raise BackendExeption(
+                error_type="NO TWEET", error_message="No tweet with such id"
+            )
+
+        state = self.pending.get(key, row[1] if buffered is None else buffered)
+        if state is liked:
+            if liked:
+                raise BackendExeption(
+                    error_type="BAD LIKE",
+                    error_message="Such like already exists",
+                )
+            raise BackendExeption(
+                error_type="BAD LIKE DELETE",
+                error_message="No like for tweet from user",
+            )
+        self.pending[key] = liked
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        if len(self.pending) >= self.flush_size:
+            self._wakeup.set()
+
+    async def discard(self, user_id: int, tweet_ids: Iterable[int]):
+        """
+        Убирает из буфера действия пользователя по твитам tweet_ids.
+        Пакет лайков записывает итоговое состояние этих твитов сразу
+        в БД, и более ранние отложенные действия не должны его
+        перезаписать. Ждет уже начатый сброс, который мог забрать
+        эти действия из буфера
+        """
+        async with self._flush_lock:
+            for tweet_id in tweet_ids:
+                self.pending.pop((user_id, tweet_id), None)
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("like write-behind flush failed, will retry")
+
+    async def flush(self) -> int:
+        """
+        Сбрасывает буфер одной транзакцией. При ошибке действия
+        возвращаются в буфер, более новые действия не затираются
+
+        :return: int
+            Число сброшенных действий
+        """
+        async with self._flush_lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            self._flushing = batch
+            try:
+                deltas = await self._write(batch)
+            except BaseException:
+                for key, liked in batch.items():
+                    self.pending.setdefault(key, liked)
+                raise
+            finally:
+                self._flushing = {}
+
+        await tweet_cache.invalidate(*deltas)
+        broker.publish_likes(deltas)
+        return len(batch)
+
+    async def _write(self, batch: Dict[Tuple[int, int], bool]) -> Deltas:
+        likes = Like.__table__
+        tweets = Tweet.__table__
+        deltas: Deltas = Deltas()
+
+        session_maker = self.session_maker or get_session_maker()
+        async with session_maker() as session:
+            # Твиты пакета блокируются в порядке id до записи лайков:
+            # сбросы из разных воркеров не блокируют друг друга
+            # взаимно. FOR NO KEY UPDATE совместим с FOR KEY SHARE
+            # проверки внешнего ключа, поэтому обычные лайки этих
+            # твитов не ждут сброса
+            await session.execute(
+                select(tweets.c.id)
+                .where(in_ids(tweets.c.id, sorted({t for _, t in batch})))
+                .order_by(tweets.c.id)
+                .with_for_update(key_share=True)
+            )
+            for liked in (True, False):
+                pairs = [key for key, value in batch.items() if value is liked]
+                if not pairs:
+                    continue
+                rows = (
+                    func.unnest(
+                        int_array(user_id for user_id, _ in pairs),
+                        int_array(tweet_id for _, tweet_id in pairs),
+                    )
+                    .table_valued("user_id", "tweet_id")
+                    .render_derived("pairs")
+                )
+                if liked:
+                    statement = (
+                        pg_insert(likes)
+                        .from_select(
+                            ["user_id", "tweet_id"],
+                            select(rows.c.user_id, rows.c.tweet_id).join(
+                                tweets, tweets.c.id == rows.c.tweet_id
+                            ),
+                        )
+                        .on_conflict_do_nothing()
+                        .returning(likes.c.tweet_id)
+                    )
+                else:
+                    statement = (
+                        delete(likes)
+                        .where(
+                            likes.c.user_id == rows.c.user_id,
+                            likes.c.tweet_id == rows.c.tweet_id,
+                        )
+                        .returning(likes.c.tweet_id)
+                    )
+                q = await session.execute(statement)
+                changed = q.scalars().all()
+                for tweet_id in changed:
+                    deltas[tweet_id] += 1 if liked else -1
+                LIKES_FLUSHED.labels("applied").inc(len(changed))
+                LIKES_FLUSHED.labels("unchanged").inc(
+                    len(pairs) - len(changed)
+                )
+
+            deltas = Deltas(
+                {tweet_id: d for tweet_id, d in deltas.items() if d}
+            )
+            if deltas:
+                tweet_ids = sorted(deltas)
+                increments = (
+                    func.unnest(
+                        int_array(tweet_ids),
+                        int_array(deltas[tweet_id] for tweet_id in tweet_ids),
+                    )
+                    .table_valued("id", "delta")
+                    .render_derived("increments")
+                )
+                changed = (
+                    update(tweets)
+                    .where(tweets.c.id == increments.c.id)
+                    .values(
+                        likes_count=tweets.c.likes_count + increments.c.delta
+                    )
+                    .returning(
+                        tweets.c.id, tweets.c.user_id, tweets.c.likes_count
+                    )
+                    .cte("changed")
+                )
+                await session.execute(
+                    log_changes(
+                        LIKES_CHANGED,
+                        select(changed.c.id, changed.c.user_id),
+                    ).add_cte(timeline_likes_update(changed).cte("synced"))
+                )
+            await session.commit()
+        return deltas
+
+    async def close(self):
+        """
+        Останавливает фоновый сброс и записывает остаток буфера
+        """
+        self._closed = True
+        if self._task is not None:
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+
+like_writer = LikeWriteBehind() if settings.likes_write_behind else None
+
+FunctionMetric(
+    "likes_write_behind_pending",
+    "Like actions buffered and not yet written",
+    (),
+    lambda: [((), len(like_writer))] if like_writer is not None else [],
+)
@@ -4,26 +4,77 @@ routes.py
 Модуль реализует эндпоинты FastApi для взамодействия с пользователями.
 
 """
-from typing import Union
+from typing import Awaitable, Callable, Optional, Union
 
-from fastapi import APIRouter, Depends, Header, Response
+from fastapi import APIRouter, Depends, Query, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..database import get_session
 from ..exeptions import BackendExeption
-from ..schemas_overal import ErrorSchema, OnlyResult
-from ..users.schemas import UserIn, UserOut, UserResultOutSchema
+from ..pagination import PageParams
+from ..replicas import get_read_session, get_write_session, primary_of
+from ..responses import (
+    FastJSONResponse,
+    cached_json_response,
+    dumps,
+    dumps_str,
+    with_fields,
+)
+from ..schemas_overal import (
+    BatchOutSchema,
+    CurrentUser,
+    ErrorSchema,
+    OnlyResult,
+)
+from ..services_overal import get_current_user
+from ..users.schemas import (
+    FollowBatchIn,
+    UserDeltaOutSchema,
+    UserIn,
+    UserListOutSchema,
+    UserOut,
+    UserResultOutSchema,
+)
 from ..users.services import (
+    batch_follows,
     delete_follow_to_user,
     get_user,
+    get_user_follows,
     get_user_me,
     post_follow_to_user,
     post_user,
+    user_cache,
+    user_changed_since,
 )
 
 router = APIRouter(prefix="/users", tags=["Users"])
 
 
+async def _profile_response(
+    request: Request,
+    session: AsyncSession,
+    user_id: int,
+    load_user: Callable[[], Awaitable[str]],
+    since_version: Optional[int],
+) -> Response:
+    if since_version is None:
+        entry = await user_cache.get_or_load(user_id, load_user)
+        return cached_json_response(request=request, entry=entry)
+
+    changed, version = await user_changed_since(
+        session=session, user_id=user_id, since_version=since_version
+    )
+    if not changed:
+        return FastJSONResponse(
+            content=dumps(
+                {"result": True, "changed": False, "version": version}
+            )
+        )
+    entry = await user_cache.get_or_load(user_id, load_user)
+    return FastJSONResponse(
+        content=with_fields(entry["body"], changed=True, version=version)
+    )
+
+
 @router.post(
     "/{id}/follow",
     summary="Отметка следит за другим пользователем",
@@ -34,8 +85,8 @@ router = APIRouter(prefix="/users", tags=["Users"])
 async def post_follow_to_user_handler(
     response: Response,
     id: int,
-    api_key: str = Header(default="test"),
-    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
 ) -> Union[OnlyResult, ErrorSchema]:
     """
     Эндпоинт публикации отметки 'следит' за другим пользователем
@@ -44,8 +95,8 @@ async def post_follow_to_user_handler(
          Обьект ответа на запрос
     :param id: int
         Идентификатор пользователя в СУБД
-    :param api_key: str
-        api-key пользователя
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
@@ -53,7 +104,9 @@ async def post_follow_to_user_handler(
         Pydantic-схема для фронтенда с результатом или ошибкой
     """
     try:
-        await post_follow_to_user(session=session, api_key=api_key, user_id=id)
+        await post_follow_to_user(
+            session=session, following_user=user, user_id=id
+        )
         return {"result": True}
     except BackendExeption as e:
         response.status_code = 404
@@ -70,8 +123,8 @@ async def post_follow_to_user_handler(
 async def delete_follow_to_user_handler(
     response: Response,
     id: int,
-    api_key: str = Header(default="test"),
-    session: AsyncSession = Depends(get_session),
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
 ) -> Union[OnlyResult, ErrorSchema]:
     """
     Эндпоинт удаления отметки 'следит' за другим пользователем
@@ -80,8 +133,8 @@ async def delete_follow_to_user_handler(
          Обьект ответа на запрос
     :param id: int
         Идентификатор пользователя в СУБД
-    :param api_key: str
-        api-key пользователя
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
@@ -90,7 +143,7 @@ async def delete_follow_to_user_handler(
     """
     try:
         await delete_follow_to_user(
-            session=session, api_key=api_key, user_id=id
+            session=session, following_user=user, user_id=id
         )
         return {"result": True}
     except BackendExeption as e:
@@ -102,29 +155,50 @@ async def delete_follow_to_user_handler(
     "/me",
     summary="Получение информации о пользователе по api-key",
     response_description="Сообщение о результате с данными пользователя",
-    response_model=Union[UserResultOutSchema, ErrorSchema],
+    response_model=Union[UserResultOutSchema, UserDeltaOutSchema, ErrorSchema],
     status_code=200,
 )
 async def get_user_me_handler(
+    request: Request,
     response: Response,
-    api_key: str = Header(),
-    session: AsyncSession = Depends(get_session),
-) -> Union[UserResultOutSchema, ErrorSchema]:
+    user: CurrentUser = Depends(get_current_user),
+    since_version: Optional[int] = Query(default=None, ge=0),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
     """
-    Эндпоинт получения информации о пльзователе по api-key
+    Эндпоинт получения информации о пльзователе по api-key.
+    Профиль берется из того же кеша, что и профиль по id.
+    С since_version к профилю добавляется токен version, а если
+    профиль с токена не менялся - возвращается только changed=false
     \f
+    :param request: Request
+         Обьект запроса
     :param response: Response
          Обьект ответа на запрос
-    :param api_key: str
-        api-key пользователя
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
+    :param since_version: int, optional
+        Токен синхронизации из прошлого ответа
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
-    :return: Union[UserResultOutSchema, ErrorSchema]
-        Pydantic-схема для фронтенда с данными пользователя или ошибкой
+    :return: Union[Response, ErrorSchema]
+        JSON с данными пользователя для фронтенда или pydantic-схема ошибки
     """
+
+    async def load_user() -> str:
+        return dumps_str(
+            await get_user_me(session=primary_of(session), user=user)
+        )
+
     try:
-        return await get_user_me(session=session, api_key=api_key)
+        return await _profile_response(
+            request=request,
+            session=session,
+            user_id=user.id,
+            load_user=load_user,
+            since_version=since_version,
+        )
     except BackendExeption as e:
         response.status_code = 404
         return e
@@ -134,31 +208,140 @@ async def get_user_me_handler(
     "/{id}",
     summary="Получение информации о пользователе по id",
     response_description="Сообщение о результате с данными пользователя",
-    response_model=Union[UserResultOutSchema, ErrorSchema],
+    response_model=Union[UserResultOutSchema, UserDeltaOutSchema, ErrorSchema],
     status_code=200,
 )
 async def get_user_by_id_handler(
-    response: Response, id: int, session: AsyncSession = Depends(get_session)
-) -> Union[UserResultOutSchema, ErrorSchema]:
+    request: Request,
+    response: Response,
+    id: int,
+    since_version: Optional[int] = Query(default=None, ge=0),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
+    """
+    Эндпоинт получения информации о пльзователе по его id.
+    Ответ кешируется и поддерживает If-None-Match, since_version
+    работает как в /users/me
+    \f
+    :param request: Request
+         Обьект запроса
+    :param response: Response
+         Обьект ответа на запрос
+    :param id: int
+        id пользователя в СУБД
+    :param since_version: int, optional
+        Токен синхронизации из прошлого ответа
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+
+    :return: Union[Response, ErrorSchema]
+        JSON с данными пользователя для фронтенда или pydantic-схема ошибки
     """
-    Эндпоинт получения информации о пльзователе по его id
+
+    async def load_user() -> str:
+        return dumps_str(
+            await get_user(session=primary_of(session), user_id=id)
+        )
+
+    try:
+        return await _profile_response(
+            request=request,
+            session=session,
+            user_id=id,
+            load_user=load_user,
+            since_version=since_version,
+        )
+    except BackendExeption as e:
+        response.status_code = 404
+        return e
+
+
+@router.get(
+    "/{id}/followers",
+    summary="Получение подписчиков пользователя постранично",
+    response_description="Сообщение о результате со страницей подписчиков",
+    response_model=Union[UserListOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_user_followers_handler(
+    response: Response,
+    id: int,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
+    """
+    Эндпоинт возвращает страницу подписчиков пользователя
     \f
     :param response: Response
          Обьект ответа на запрос
     :param id: int
         id пользователя в СУБД
+    :param page: PageParams
+        Курсор и размер страницы
     :param session: Asyncsession
         Экземпляр сессии из sqlalchemy
 
-    :return: Union[UserResultOutSchema, ErrorSchema]
-        Pydantic-схема для фронтенда с данными пользователя или ошибкой
+    :return: Union[Response, ErrorSchema]
+        JSON для фронтенда со страницей подписчиков или pydantic-схема ошибки
     """
     try:
-        return await get_user(session=session, user_id=id)
+        result = await get_user_follows(
+            session=session,
+            user_id=id,
+            direction="followers",
+            cursor=page.cursor,
+            limit=page.limit,
+        )
     except BackendExeption as e:
         response.status_code = 404
         return e
 
+    return FastJSONResponse(content=result)
+
+
+@router.get(
+    "/{id}/following",
+    summary="Получение подписок пользователя постранично",
+    response_description="Сообщение о результате со страницей подписок",
+    response_model=Union[UserListOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_user_following_handler(
+    response: Response,
+    id: int,
+    page: PageParams = Depends(),
+    session: AsyncSession = Depends(get_read_session),
+) -> Union[Response, ErrorSchema]:
+    """
+    Эндпоинт возвращает страницу пользователей, на которых подписан
+    пользователь
+    \f
+    :param response: Response
+         Обьект ответа на запрос
+    :param id: int
+        id пользователя в СУБД
+    :param page: PageParams
+        Курсор и размер страницы
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+
+    :return: Union[Response, ErrorSchema]
+        JSON для фронтенда со страницей подписок или pydantic-схема ошибки
+    """
+    try:
+        result = await get_user_follows(
+            session=session,
+            user_id=id,
+            direction="following",
+            cursor=page.cursor,
+            limit=page.limit,
+        )
+    except BackendExeption as e:
+        response.status_code = 404
+        return e
+
+    return FastJSONResponse(content=result)
+
 
 @router.post(
     "/",
@@ -167,7 +350,7 @@ async def get_user_by_id_handler(
     response_model=UserOut,
 )
 async def post_users_handler(
-    user: UserIn, session: AsyncSession = Depends(get_session)
+    user: UserIn, session: AsyncSession = Depends(get_write_session)
 ) -> UserOut:
     """
     Эндпоинт регистрации нового пользователя
@@ -182,3 +365,45 @@ async def post_users_handler(
     """
 
     return await post_user(session=session, user=user)
+
+
+@router.post(
+    "/follow:batch",
+    summary="Пакетная подписка и отписка",
+    response_description="Сообщение о результате по каждому пользователю",
+    response_model=Union[BatchOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def batch_follows_handler(
+    response: Response,
+    batch: FollowBatchIn,
+    user: CurrentUser = Depends(get_current_user),
+    session: AsyncSession = Depends(get_write_session),
+) -> Union[BatchOutSchema, ErrorSchema]:
+    """
+    Эндпоинт подписывает и отписывает пользователя по списку id
+    в одной транзакции и возвращает результат по каждому id
+    \f
+    :param response: Response
+         Обьект ответа на запрос
+    :param batch: FollowBatchIn
+        Списки id пользователей для подписки и отписки
+    :param user: CurrentUser
+        Пользователь, найденный по api-key
+    :param session: Asyncsession
+        Экземпляр сессии из sqlalchemy
+
+    :return: Union[BatchOutSchema, ErrorSchema]
+        Pydantic-схема для фронтенда с результатами или ошибкой
+    """
+    try:
+        items = await batch_follows(
+            session=session,
+            following_user=user,
+            follow_ids=batch.follow,
+            unfollow_ids=batch.unfollow,
+        )
+        return {"result": True, "items": items}
+    except BackendExeption as e:
+        response.status_code = 404
+        return e
@@ -8,7 +8,9 @@ schemas.py
 
 from typing import List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
+
+from ..schemas_overal import MAX_BATCH_SIZE, disjoint_lists
 
 
 class BaseUser(BaseModel):
@@ -103,15 +105,21 @@ class UserOutSchema(BaseModel):
     name: str
         Имя пользователя
     followers: List[AuthorBaseSchema], optional
-        Список пользователей, которые следят за автором
+        Последние пользователи, которые следят за автором
     following: List[AuthorBaseSchema], optional
-        Список пользователей, за которыми следит автор
+        Последние пользователи, за которыми следит автор
+    followers_count: int
+        Общее число подписчиков
+    following_count: int
+        Общее число подписок
     """
 
     id: int
     name: str
     followers: Optional[List[AuthorBaseSchema]]
     following: Optional[List[AuthorBaseSchema]]
+    followers_count: int = 0
+    following_count: int = 0
 
     class Config:
         orm_mode = True
@@ -134,3 +142,60 @@ class UserResultOutSchema(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class UserDeltaOutSchema(BaseModel):
+    """
+    Pydantic-схема ответа на запрос профиля с since_version,
+    если профиль не изменился
+
+    Parameters
+    ----------
+    result: bool = True
+        Флаг успешного выполнения
+    changed: bool = False
+        Профиль изменился после токена
+    version: int
+        Токен для следующей проверки
+    """
+
+    result: bool = True
+    changed: bool = False
+    version: int
+
+
+class UserListOutSchema(BaseModel):
+    """
+    Pydantic-схема страницы списка пользователей
+
+    Parameters
+    ----------
+    result: bool = True
+        Флаг о корректном завершении запроса
+    users: List[AuthorBaseSchema]
+        Пользователи на странице
+    next_cursor: str, optional
+        Курсор следующей страницы, если она есть
+    """
+
+    result: bool = True
+    users: List[AuthorBaseSchema]
+    next_cursor: Optional[str]
+
+
+class FollowBatchIn(BaseModel):
+    """
+    Pydantic-схема пакетной подписки и отписки
+
+    Parameters
+    ----------
+    follow: List[int]
+        id пользователей, на которых оформляется подписка
+    unfollow: List[int]
+        id пользователей, от которых выполняется отписка
+    """
+
+    follow: conlist(int, max_items=MAX_BATCH_SIZE) = []
+    unfollow: conlist(int, max_items=MAX_BATCH_SIZE) = []
+
+    _disjoint = disjoint_lists("follow", "unfollow")
@@ -1,102 +1,441 @@
-from sqlalchemy import delete, insert, select
+from typing import List, Optional, Tuple
+
+from sqlalchemy import and_, delete, literal, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
-from ..database import User, followers
+from ..cache import ResponseCache, shared_backend
+from ..changes import (
+    FOLLOWERS_CHANGED,
+    FOLLOWING_CHANGED,
+    append_changes,
+    get_changes,
+    get_current_version,
+    get_sync_state,
+    log_changes,
+)
+from ..config import settings
+from ..database import (
+    User,
+    changes,
+    followers,
+    in_ids,
+    is_foreign_key_violation,
+    timelines,
+)
 from ..exeptions import BackendExeption
-from ..services_overal import get_user_by_api_key
+from ..pagination import DEFAULT_PAGE_LIMIT, decode_cursor, make_page
+from ..schemas_overal import CurrentUser
+from ..services_overal import batch_item, invalidate_user_cache
+from ..timelines.services import (
+    add_authors_to_timeline,
+    change_followers_counts,
+    followers_count_values,
+    remove_authors_from_timeline,
+    timeline_backfill,
+)
+
+# Сколько подписчиков и подписок встраивается в профиль пользователя.
+EMBEDDED_FOLLOWS_LIMIT = 20
+
+user_cache = ResponseCache(
+    namespace="user",
+    maxsize=settings.response_cache_size,
+    ttl=settings.response_cache_ttl,
+    shared=shared_backend,
+)
+
+# Направление связи: (колонка с пользователями списка, колонка владельца)
+FOLLOW_DIRECTIONS = {
+    "followers": (
+        followers.c.following_user_id,
+        followers.c.followed_user_id,
+    ),
+    "following": (
+        followers.c.followed_user_id,
+        followers.c.following_user_id,
+    ),
+}
+
+
+def _log_follow_changes(following_user_id: int, changed_users):
+    """
+    CTE записи в журнал изменений: у пользователей из changed_users
+    (RETURNING users.id) изменились подписчики, у following_user_id -
+    подписки
+    """
+    return (
+        log_changes(
+            FOLLOWERS_CHANGED,
+            select(changed_users.c.id, changed_users.c.id.label("author")),
+        ).cte("logged_followers"),
+        log_changes(
+            FOLLOWING_CHANGED,
+            select(
+                literal(following_user_id), literal(following_user_id)
+            ).select_from(changed_users),
+        ).cte("logged_following"),
+    )
+
+
+def _change_following_count(user_id: int, changed, delta: int):
+    """
+    UPDATE счетчика подписок user_id на delta, если changed
+    (RETURNING изменившей подписки) не пуст
+    """
+    users = User.__table__
+    return (
+        update(users)
+        .where(users.c.id == user_id, select(changed).exists())
+        .values(following_count=users.c.following_count + delta)
+    )
 
 
 async def post_follow_to_user(
-    session: AsyncSession, api_key: str, user_id: int
+    session: AsyncSession, following_user: CurrentUser, user_id: int
 ):
-    following_user = await get_user_by_api_key(
-        session=session, api_key=api_key
-    )
+    """
+    Подписка одним запросом: вставка с ON CONFLICT DO NOTHING,
+    счетчик подписчиков и дозаполнение ленты выполняются в CTE.
+    Нарушение внешнего ключа означает, что пользователя нет,
+    пустой RETURNING - что подписка уже есть
+    """
     if following_user.id == user_id:
         raise BackendExeption(
             error_type="BAD FOLLOW", error_message="User can't follow himself"
         )
 
-    q = await session.execute(select(User).where(User.id == user_id))
-    user_followed = q.scalars().one_or_none()
-    if not user_followed:
-        raise BackendExeption(
-            error_type="NO USER",
-            error_message="No user with user_id to follow",
-        )
+    users = User.__table__
+    new_follow = (
+        pg_insert(followers)
+        .values(following_user_id=following_user.id, followed_user_id=user_id)
+        .on_conflict_do_nothing()
+        .returning(followers.c.followed_user_id)
+        .cte("new_follow")
+    )
+    followed = (
+        update(users)
+        .where(users.c.id == new_follow.c.followed_user_id)
+        .values(**followers_count_values(delta=1))
+        .returning(users.c.id, users.c.fanout_on_read)
+        .cte("followed")
+    )
+    authors = select(followed.c.id).where(followed.c.fanout_on_read.is_(False))
+    backfill = timeline_backfill(
+        user_id=following_user.id, authors=authors.subquery()
+    ).cte("backfill")
+    following = _change_following_count(
+        following_user.id, new_follow, delta=1
+    ).cte("following")
+    logged = _log_follow_changes(following_user.id, followed)
     try:
-        await session.execute(
-            insert(followers).values(
-                following_user_id=following_user.id,
-                followed_user_id=user_id,
-            )
+        q = await session.execute(
+            select(followed.c.id).add_cte(backfill, following, *logged)
         )
-    except IntegrityError:
+        followed_id = q.scalar_one_or_none()
+    except IntegrityError as e:
+        await session.rollback()
+        if is_foreign_key_violation(e):
+            raise BackendExeption(
+                error_type="NO USER",
+                error_message="No user with user_id to follow",
+            )
+        raise
+    if followed_id is None:
+        await session.rollback()
         raise BackendExeption(
             error_type="BAD FOLLOW", error_message="Such follow already exists"
         )
     await session.commit()
+    await user_cache.invalidate(following_user.id, user_id)
 
 
 async def delete_follow_to_user(
-    session: AsyncSession, api_key: str, user_id: int
+    session: AsyncSession, following_user: CurrentUser, user_id: int
 ):
-    following_user = await get_user_by_api_key(
-        session=session, api_key=api_key
-    )
-    q = await session.execute(
-        select(followers).where(
+    """
+    Отписка одним запросом: удаление подписки, счетчика
+    и твитов автора из ленты выполняются в CTE
+    """
+    users = User.__table__
+    deleted_follow = (
+        delete(followers)
+        .where(
             followers.c.following_user_id == following_user.id,
             followers.c.followed_user_id == user_id,
         )
+        .returning(followers.c.followed_user_id)
+        .cte("deleted_follow")
     )
-    follower = q.scalars().one_or_none()
-    if not follower:
+    unfollowed = (
+        update(users)
+        .where(users.c.id == deleted_follow.c.followed_user_id)
+        .values(**followers_count_values(delta=-1))
+        .returning(users.c.id)
+        .cte("unfollowed")
+    )
+    cleanup = (
+        delete(timelines)
+        .where(
+            timelines.c.user_id == following_user.id,
+            timelines.c.author_id.in_(
+                select(deleted_follow.c.followed_user_id)
+            ),
+        )
+        .cte("cleanup")
+    )
+    following = _change_following_count(
+        following_user.id, deleted_follow, delta=-1
+    ).cte("following")
+    logged = _log_follow_changes(following_user.id, unfollowed)
+    q = await session.execute(
+        select(unfollowed.c.id).add_cte(cleanup, following, *logged)
+    )
+    if q.scalar_one_or_none() is None:
+        await session.rollback()
         raise BackendExeption(
             error_type="BAD FOLLOW DELETE", error_message="No such follow"
         )
+    await session.commit()
+    await user_cache.invalidate(following_user.id, user_id)
 
-    await session.execute(
-        delete(followers).where(
-            followers.c.following_user_id == following_user.id,
-            followers.c.followed_user_id == user_id,
+
+async def batch_follows(
+    session: AsyncSession,
+    following_user: CurrentUser,
+    follow_ids: List[int],
+    unfollow_ids: List[int],
+) -> List[dict]:
+    """
+    Подписывает и отписывает пользователя пачкой в одной транзакции:
+    INSERT ... SELECT ... ON CONFLICT DO NOTHING для подписок,
+    DELETE ... WHERE followed_user_id = ANY(...) для отписок,
+    затем счетчики подписчиков и ленты обновляются пачкой
+
+    :return: List[dict]
+        Результат по каждому id в порядке запроса
+    """
+    me = following_user.id
+    follow_ids = list(dict.fromkeys(follow_ids))
+    unfollow_ids = list(dict.fromkeys(unfollow_ids))
+    followed, unfollowed = set(), set()
+
+    if follow_ids:
+        q = await session.execute(
+            pg_insert(followers)
+            .from_select(
+                ["following_user_id", "followed_user_id"],
+                select(literal(me), User.id).where(
+                    in_ids(User.id, follow_ids), User.id != me
+                ),
+            )
+            .on_conflict_do_nothing()
+            .returning(followers.c.followed_user_id)
+        )
+        followed = set(q.scalars().all())
+    if unfollow_ids:
+        q = await session.execute(
+            delete(followers)
+            .where(
+                followers.c.following_user_id == me,
+                in_ids(followers.c.followed_user_id, unfollow_ids),
+            )
+            .returning(followers.c.followed_user_id)
+        )
+        unfollowed = set(q.scalars().all())
+
+    unchanged = [
+        user_id for user_id in follow_ids if user_id not in followed
+    ] + [user_id for user_id in unfollow_ids if user_id not in unfollowed]
+    existing = set()
+    if unchanged:
+        q = await session.execute(
+            select(User.id).where(in_ids(User.id, unchanged))
+        )
+        existing = set(q.scalars().all())
+
+    if followed:
+        flags = await change_followers_counts(
+            session=session, user_ids=list(followed), delta=1
+        )
+        await add_authors_to_timeline(
+            session=session,
+            user_id=me,
+            author_ids=[
+                user_id
+                for user_id, fanout_on_read in flags.items()
+                if not fanout_on_read
+            ],
+        )
+    if unfollowed:
+        await change_followers_counts(
+            session=session, user_ids=list(unfollowed), delta=-1
+        )
+        await remove_authors_from_timeline(
+            session=session, user_id=me, author_ids=list(unfollowed)
+        )
+    if followed or unfollowed:
+        await session.execute(
+            update(User)
+            .where(User.id == me)
+            .values(
+                following_count=User.following_count
+                + len(followed)
+                - len(unfollowed)
+            )
+        )
+        await append_changes(
+            session=session,
+            rows=[(FOLLOWING_CHANGED, me, me)]
+            + [
+                (FOLLOWERS_CHANGED, user_id, user_id)
+                for user_id in followed | unfollowed
+            ],
         )
-    )
     await session.commit()
+    if followed or unfollowed:
+        await user_cache.invalidate(me, *followed, *unfollowed)
 
+    items = []
+    for action, user_ids, changed in (
+        ("follow", follow_ids, followed),
+        ("unfollow", unfollow_ids, unfollowed),
+    ):
+        for user_id in user_ids:
+            item = batch_item(
+                user_id, action, user_id in changed, user_id in existing
+            )
+            if user_id == me:
+                item["status"] = "forbidden"
+            items.append(item)
+    return items
 
-async def get_user_me(session: AsyncSession, api_key: str):
-    user = await get_user_by_api_key(session=session, api_key=api_key)
 
-    q = await session.execute(
-        select(User)
-        .options(selectinload(User.following))
-        .options(selectinload(User.followers))
-        .where(User.api_key == api_key)
+async def get_follows_page(
+    session: AsyncSession,
+    user_id: int,
+    direction: str,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+) -> Tuple[List[dict], Optional[str]]:
+    listed_column, owner_column = FOLLOW_DIRECTIONS[direction]
+    # Порядок и ключ страницы - по колонке followers: страница
+    # читается по индексу (owner, listed) без сортировки
+    query = (
+        select(listed_column.label("id"), User.name)
+        .join(User, User.id == listed_column)
+        .where(owner_column == user_id)
+        .order_by(listed_column.desc())
+        .limit(limit + 1)
     )
+    if cursor:
+        (last_user_id,) = decode_cursor(cursor, size=1)
+        query = query.where(listed_column < last_user_id)
+    q = await session.execute(query)
 
-    user = q.scalars().one_or_none()
+    users, next_cursor = make_page(
+        q.all(), limit=limit, key=lambda user: (user.id,)
+    )
+    return [{"id": user.id, "name": user.name} for user in users], next_cursor
 
-    return {"result": True, "user": user}
 
+async def user_to_out(session: AsyncSession, user: User) -> dict:
+    user_followers, _ = await get_follows_page(
+        session=session,
+        user_id=user.id,
+        direction="followers",
+        limit=EMBEDDED_FOLLOWS_LIMIT,
+    )
+    user_following, _ = await get_follows_page(
+        session=session,
+        user_id=user.id,
+        direction="following",
+        limit=EMBEDDED_FOLLOWS_LIMIT,
+    )
 
-async def get_user(session: AsyncSession, user_id: int):
-    q = await session.execute(
-        select(User)
-        .options(selectinload(User.following))
-        .options(selectinload(User.followers))
-        .where(User.id == user_id)
+    return {
+        "id": user.id,
+        "name": user.name,
+        "followers": user_followers,
+        "following": user_following,
+        "followers_count": user.followers_count,
+        "following_count": user.following_count,
+    }
+
+
+async def get_user_me(session: AsyncSession, user: CurrentUser):
+    user = await get_user_by_id(session=session, user_id=user.id)
+
+    return {
+        "result": True,
+        "user": await user_to_out(session=session, user=user),
+    }
+
+
+async def user_changed_since(
+    session: AsyncSession, user_id: int, since_version: int
+) -> Tuple[bool, int]:
+    """
+    Проверяет по журналу изменений, менялся ли профиль пользователя
+    (подписчики и подписки) после токена since_version.
+    since_version=0 - у клиента профиля нет
+
+    :return: Tuple[bool, int]
+        Флаг изменения и токен для следующей проверки
+    """
+    if not since_version:
+        return True, await get_current_version(session)
+
+    state = await get_sync_state(session)
+    rows = await get_changes(
+        session=session,
+        since=since_version,
+        state=state,
+        condition=and_(
+            changes.c.author_id == user_id,
+            changes.c.kind.in_((FOLLOWERS_CHANGED, FOLLOWING_CHANGED)),
+        ),
     )
+    return rows is None or bool(rows), state.version
+
 
+async def get_user_by_id(session: AsyncSession, user_id: int) -> User:
+    q = await session.execute(select(User).where(User.id == user_id))
     user = q.scalars().one_or_none()
     if not user:
         raise BackendExeption(
             error_type="NO USER", error_message="No user with such id"
         )
+    return user
+
+
+async def get_user(session: AsyncSession, user_id: int):
+    user = await get_user_by_id(session=session, user_id=user_id)
+
+    return {
+        "result": True,
+        "user": await user_to_out(session=session, user=user),
+    }
+
+
+async def get_user_follows(
+    session: AsyncSession,
+    user_id: int,
+    direction: str,
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_LIMIT,
+):
+    await get_user_by_id(session=session, user_id=user_id)
+    users, next_cursor = await get_follows_page(
+        session=session,
+        user_id=user_id,
+        direction=direction,
+        cursor=cursor,
+        limit=limit,
+    )
 
-    return {"result": True, "user": user}
+    return {"result": True, "users": users, "next_cursor": next_cursor}
 
 
 async def post_user(session: AsyncSession, user) -> User:
@@ -104,4 +443,5 @@ async def post_user(session: AsyncSession, user) -> User:
     async with session.begin():
         session.add(new_user)
         await session.commit()
+    await invalidate_user_cache(api_key=new_user.api_key)
     return new_user
@@ -0,0 +1,105 @@
+"""
+warmup.py
+----------
+Модуль реализует фазы прогрева воркера при старте:
+pool - открываются db_pool_warm_size соединений каждого пула;
+statements - на каждом из этих соединений один раз выполняются
+горячие запросы (api-key, журнал изменений и запросы включенных
+групп роутеров: лента и твит, профиль): SQLAlchemy кеширует их
+компиляцию, asyncpg - подготовленные выражения соединения;
+serializers - строится схема OpenAPI со схемами ответов.
+Запросы выполняются для несуществующих id и ничего не меняют.
+Сервисы группы импортируются только если группа включена.
+
+"""
+
+from functools import partial
+from typing import Awaitable, Callable, Dict, Iterable, List
+
+from fastapi import FastAPI
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from .changes import get_sync_state
+from .database import User
+from .exeptions import BackendExeption
+from .metrics import FunctionMetric
+from .readiness import Phase, readiness, warm_pool
+from .schemas_overal import CurrentUser
+
+# Id, которого нет в БД: запросы прогрева возвращают пустой результат.
+MISSING_ID = 0
+
+
+async def _warm_tweets(session: AsyncSession):
+    from .tweets.services import get_tweet, get_tweets_json, load_tweet_bodies
+
+    await get_tweets_json(
+        session=session, user=CurrentUser(id=MISSING_ID, name="")
+    )
+    await load_tweet_bodies(session=session, tweet_ids=[MISSING_ID])
+    try:
+        await get_tweet(session=session, tweet_id=MISSING_ID)
+    except BackendExeption:
+        pass
+
+
+async def _warm_users(session: AsyncSession):
+    from .users.services import user_to_out
+
+    await user_to_out(
+        session=session,
+        user=User(
+            id=MISSING_ID, name="", followers_count=0, following_count=0
+        ),
+    )
+
+
+# Горячие запросы группы роутеров (см. main.ROUTER_GROUPS)
+GROUP_STATEMENTS: Dict[
+    str, List[Callable[[AsyncSession], Awaitable[None]]]
+] = {
+    "tweets": [_warm_tweets],
+    "users": [_warm_users],
+}
+
+
+async def run_hot_statements(session: AsyncSession, groups: Iterable[str]):
+    await session.execute(select(User).where(User.api_key == ""))
+    for warm in dict.fromkeys(
+        warm for group in groups for warm in GROUP_STATEMENTS.get(group, ())
+    ):
+        await warm(session)
+    await get_sync_state(session)
+
+
+async def _warm_pools(engines: List[AsyncEngine], size: int, warm=None):
+    for engine in engines:
+        await warm_pool(engine, size, warm)
+
+
+async def _build_serializers(app: FastAPI):
+    app.openapi_schema = None
+    app.openapi()
+
+
+def warmup_phases(
+    app: FastAPI, engines: Iterable[AsyncEngine], size: int
+) -> List[Phase]:
+    engines = list(engines)
+    statements = partial(
+        run_hot_statements, groups=app.state.config.api_routers
+    )
+    return [
+        ("pool", partial(_warm_pools, engines, size)),
+        ("statements", partial(_warm_pools, engines, size, statements)),
+        ("serializers", partial(_build_serializers, app)),
+    ]
+
+
+FunctionMetric(
+    "startup_phase_seconds",
+    "Duration of worker warm-up phases",
+    ("phase",),
+    lambda: [((name,), took) for name, took in readiness.phases.items()],
+)
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+import pytest
+
+from ..project.cache import (
+    MISSING,
+    ResponseCache,
+    SingleFlight,
+    TTLCache,
+    TwoLevelCache,
+)
+from ..project.config import Settings, cache_overrides_for
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is MISSING
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_expiration():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", None, ttl=0.01)
+    assert cache.get("a") is None
+    time.sleep(0.02)
+    assert cache.get("a") is MISSING
+
+
+async def test_two_level_cache_invalidation():
+    cache = TwoLevelCache(namespace="test", maxsize=10, ttl=60)
+    await cache.set("key", {"id": 1})
+    assert await cache.get("key") == {"id": 1}
+    await cache.delete("key")
+    assert await cache.get("key") is MISSING
+
+
+async def test_response_cache_get_many_loads_misses_once():
+    cache = ResponseCache(namespace="test-many", maxsize=10, ttl=60)
+    calls = []
+
+    async def loader(ids):
+        calls.append(ids)
+        return {entity_id: f'{{"id":{entity_id}}}' for entity_id in ids}
+
+    await cache.get_many_or_load([1, 2], loader)
+    await cache.invalidate(1)
+    entries = await cache.get_many_or_load([1, 2, 3], loader)
+
+    assert calls == [[1, 2], [1, 3]]
+    assert entries[2]["body"] == '{"id":2}'
+
+
+async def test_single_flight_leader_cancelled():
+    flight = SingleFlight()
+    started = asyncio.Event()
+
+    async def slow():
+        started.set()
+        await asyncio.sleep(60)
+
+    async def fast():
+        return "loaded"
+
+    leader = asyncio.create_task(flight.do("key", slow))
+    await started.wait()
+    waiters = [asyncio.create_task(flight.do("key", fast)) for _ in range(3)]
+    await asyncio.sleep(0)
+    leader.cancel()
+
+    assert await asyncio.gather(*waiters) == ["loaded"] * 3
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+
+
+def test_cache_overrides_for_workers():
+    shared = Settings(cache_redis_url="redis://redis:6379/0")
+
+    assert cache_overrides_for(Settings(), workers=1) == {}
+    assert cache_overrides_for(shared, workers=4) == {}
+    assert cache_overrides_for(Settings(), workers=4) == {
+        "response_cache_ttl": 0.0,
+        "auth_cache_ttl": 0.0,
+        "auth_cache_negative_ttl": 0.0,
+    }
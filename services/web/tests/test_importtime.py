@@ -0,0 +1,36 @@
+from ..benchmarks.importtime import measure_import
+
+# Бюджет с запасом для медленных CI: сейчас импорт занимает ~0.4 с,
+# прежний импорт со всеми роутерами - ~0.8 с.
+IMPORT_BUDGET_MS = 2000
+
+
+def test_import_main_is_lazy():
+    result = measure_import(
+        "project.main",
+        code=(
+            "import sys\n"
+            "from project import database\n"
+            "assert database._state.engine is None\n"
+            "assert 'project.tweets.routes' not in sys.modules\n"
+            "assert 'asyncpg' not in sys.modules\n"
+        ),
+    )
+    assert result["total_ms"] < IMPORT_BUDGET_MS
+
+
+def test_create_app_router_groups():
+    measure_import(
+        "project.main",
+        code=(
+            "import sys\n"
+            "from project.config import Settings\n"
+            "app = project.main.create_app(Settings(api_routers=['users']))\n"
+            "paths = {route.path for route in app.routes}\n"
+            "assert '/api/users/me' in paths\n"
+            "assert '/api/tweets/' not in paths\n"
+            "assert 'project.tweets.routes' not in sys.modules\n"
+            "import project.warmup\n"
+            "assert 'project.tweets.services' not in sys.modules\n"
+        ),
+    )
@@ -1,3 +1,13 @@
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..project.main import app
+from ..project.readiness import readiness
+from ..project.replicas import primary_of
+from ..project.warmup import warmup_phases
+from .conftest import engine_test
+
+
 def test_some():
     assert 1 == 1
 
@@ -6,3 +16,58 @@ def test_main(test_client):
     response = test_client.get("/api/test")
     assert response.status_code == 200
     assert response.json() == {"id": 1, "name": "sasa"}
+
+
+def test_pool_status(test_client):
+    response = test_client.get("/api/pool")
+    assert response.status_code == 200
+    assert {"size", "checked_out", "wait_seconds_max"} <= set(response.json())
+
+
+def test_replicas_status(test_client):
+    response = test_client.get("/api/replicas")
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_primary_of_read_session():
+    primary = AsyncSession()
+    replica = AsyncSession()
+    replica.info["primary"] = primary
+
+    assert primary_of(replica) is primary
+    assert primary_of(primary) is primary
+
+
+def test_metrics(test_client):
+    test_client.get("/api/test")
+    test_client.get("/api/users/100500")
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert (
+        'http_requests_total{method="GET",route="/api/test",status="200"}'
+        in text
+    )
+    assert 'route="/api/users/{id}"' in text
+    assert "/api/users/100500" not in text
+    assert 'db_pool_size{pool="primary"}' in text
+
+
+async def test_ready(ac: AsyncClient):
+    before = await ac.get("api/ready")
+    await readiness.warm(warmup_phases(app, engines=[engine_test], size=2))
+    after = await ac.get("api/ready", params={"wait": 1})
+    too_long = await ac.get("api/ready", params={"wait": 3600})
+
+    assert before.status_code == 503
+    assert before.json()["ready"] is False
+    assert after.status_code == 200
+    assert set(after.json()["phases"]) == {
+        "pool",
+        "statements",
+        "serializers",
+    }
+    assert engine_test.sync_engine.pool.checkedin() >= 2
+    assert too_long.status_code == 422
@@ -0,0 +1,92 @@
+from io import BytesIO
+
+import pytest
+from fastapi import FastAPI, Request, UploadFile
+from httpx import AsyncClient
+
+from ..project.exeptions import BackendExeption
+from ..project.media.renditions import render_image
+from ..project.media.services import save_upload, sniff_image_type
+from ..project.media.upload_limit import (
+    MULTIPART_OVERHEAD,
+    UploadLimitMiddleware,
+)
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+
+def test_sniff_image_type():
+    assert sniff_image_type(PNG) == ".png"
+    assert sniff_image_type(b"\xff\xd8\xff\xe0data") == ".jpg"
+    with pytest.raises(BackendExeption):
+        sniff_image_type(b"GIF89a")
+
+
+async def test_save_upload_deduplicates(tmp_path):
+    name = await save_upload(
+        UploadFile("a.png", BytesIO(PNG)), out_path=tmp_path, max_bytes=1000
+    )
+    name_2 = await save_upload(
+        UploadFile("b.png", BytesIO(PNG)), out_path=tmp_path, max_bytes=1000
+    )
+
+    assert name == name_2
+    assert [path.name for path in tmp_path.iterdir()] == [name]
+
+
+async def test_save_upload_size_limit(tmp_path):
+    with pytest.raises(BackendExeption) as e:
+        await save_upload(
+            UploadFile("a.png", BytesIO(PNG)), out_path=tmp_path, max_bytes=10
+        )
+
+    assert e.value.error_type == "FILE TOO LARGE"
+    assert list(tmp_path.iterdir()) == []
+
+
+async def test_upload_limit_middleware():
+    app = FastAPI()
+
+    @app.post("/api/medias/")
+    async def upload(request: Request):
+        return {"size": len(await request.body())}
+
+    app.add_middleware(
+        UploadLimitMiddleware, path_prefix="/api/medias", max_bytes=10
+    )
+    too_large = b"x" * (MULTIPART_OVERHEAD + 11)
+
+    async def chunks():
+        for _ in range(MULTIPART_OVERHEAD // 1024 + 1):
+            yield b"x" * 1024
+
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        small = await ac.post("/api/medias/", content=b"x" * 10)
+        declared = await ac.post("/api/medias/", content=too_large)
+        streamed = await ac.post("/api/medias/", content=chunks())
+
+    assert small.json() == {"size": 10}
+    assert declared.status_code == 413
+    assert declared.json()["error_type"] == "FILE TOO LARGE"
+    assert streamed.status_code == 413
+    assert streamed.json()["error_type"] == "FILE TOO LARGE"
+
+
+def test_render_image(tmp_path):
+    from PIL import Image
+
+    source = tmp_path / "image.png"
+    Image.new("RGB", (2000, 1000)).save(source)
+
+    renditions = render_image(str(source))
+
+    assert set(renditions) == {
+        "thumb",
+        "thumb_webp",
+        "feed",
+        "feed_webp",
+        "full",
+        "full_webp",
+    }
+    with Image.open(tmp_path / renditions["feed"]) as feed:
+        assert feed.size == (600, 300)
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from ..project.config import Settings, stream_backend_for
+from ..project.exeptions import BackendExeption
+from ..project.stream.broker import Broker, LocalBackend, PostgresBackend
+from ..project.stream.routes import sse_events
+
+
+def make_broker(**kwargs) -> Broker:
+    options = dict(buffer_size=2, heartbeat_interval=0.01, max_connections=2)
+    options.update(kwargs)
+    return Broker(LocalBackend(), **options)
+
+
+async def test_broker_routes_and_coalesces_events():
+    broker = make_broker()
+    subscription = broker.subscribe(user_id=1, authors={1, 2}, tweets={10})
+
+    broker.publish({"type": "tweet", "id": 5, "author_id": 2})
+    broker.publish({"type": "tweet", "id": 6, "author_id": 3})
+    broker.publish_likes({10: 1})
+    broker.publish_likes({10: 1, 11: 1})
+
+    assert await subscription.next_events() == [
+        {"type": "tweet", "id": 5, "author_id": 2},
+        {"type": "likes", "id": 10, "delta": 2},
+    ]
+
+
+async def test_broker_buffer_overflow_requests_resync():
+    broker = make_broker()
+    subscription = broker.subscribe(user_id=1, authors={2}, tweets=set())
+
+    for tweet_id in range(5):
+        broker.publish({"type": "tweet", "id": tweet_id, "author_id": 2})
+
+    events = await subscription.next_events()
+    assert [event["type"] for event in events] == ["tweet", "tweet", "resync"]
+
+
+async def test_postgres_backend_failure_requests_resync():
+    # На порту 1 никто не слушает: соединение LISTEN не открывается
+    backend = PostgresBackend("postgresql://stream@127.0.0.1:1/stream")
+    broker = Broker(
+        backend, buffer_size=2, heartbeat_interval=60, max_connections=2
+    )
+    subscription = broker.subscribe(user_id=1, authors={2}, tweets={10})
+
+    broker.publish({"type": "tweet", "id": 1, "author_id": 2})
+    events = await asyncio.wait_for(subscription.next_events(), timeout=5)
+    outbox = list(backend._outbox)
+    await broker.close()
+
+    assert events == [{"type": "resync"}]
+    assert outbox == [
+        {"type": "resync"},
+        {"type": "tweet", "id": 1, "author_id": 2},
+    ]
+
+
+async def test_broker_connection_limit_and_cleanup():
+    broker = make_broker(max_connections=1)
+    subscription = broker.subscribe(user_id=1, authors={1}, tweets={10})
+    try:
+        broker.subscribe(user_id=2, authors={1}, tweets=set())
+    except BackendExeption as e:
+        error_type = e.error_type
+
+    events = sse_events(broker, subscription)
+    assert await events.__anext__() == b"retry: 5000\n\n"
+    heartbeat = await asyncio.wait_for(events.__anext__(), timeout=1)
+    await events.aclose()
+
+    assert error_type == "TOO MANY CONNECTIONS"
+    assert heartbeat == b": ping\n\n"
+    assert broker.subscriptions == set()
+    broker.publish({"type": "tweet", "id": 1, "author_id": 1})
+    await broker.close()
+
+
+def test_stream_backend_for_workers():
+    assert stream_backend_for(Settings(), workers=1) == "local"
+    assert stream_backend_for(Settings(), workers=4) == "postgres"
+    assert (
+        stream_backend_for(Settings(stream_backend="postgres"), workers=4)
+        == "postgres"
+    )
+    with pytest.raises(ValueError):
+        stream_backend_for(Settings(stream_backend="local"), workers=4)
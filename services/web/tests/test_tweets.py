@@ -1,4 +1,33 @@
+import json
+from datetime import timedelta
+
+import sqlalchemy
 from httpx import AsyncClient
+from sqlalchemy.dialects import postgresql
+
+from ..project.cache import MISSING
+from ..project.database import Like, Tweet, idempotency_keys
+from ..project.exeptions import BackendExeption
+from ..project.idempotency import (
+    PENDING,
+    claim_key,
+    get_stored,
+    prune_idempotency_keys,
+)
+from ..project.instrumentation import assert_max_queries
+from ..project.pagination import encode_cursor
+from ..project.schemas_overal import CurrentUser
+from ..project.timelines.services import feed_branches
+from ..project.tweets import routes as tweet_routes
+from ..project.tweets.entities import backfill_tweet_entities
+from ..project.tweets.schemas import TweetListOutSchema
+from ..project.tweets.services import (
+    get_tweets,
+    get_tweets_orm,
+    reconcile_likes_count,
+)
+from ..project.tweets.write_behind import LikeWriteBehind
+from .conftest import async_session_maker
 
 
 async def test_get_tweet(ac: AsyncClient, insert_data):
@@ -69,3 +98,434 @@ async def test_delete_tweet(ac: AsyncClient, insert_data):
     assert response.json()["result"] is True
     assert response_2.status_code == 404
     assert response_3.status_code == 404
+
+
+async def test_get_tweets_pagination(ac: AsyncClient, insert_data):
+    for text in ("First page", "Second page"):
+        await ac.post(
+            "api/tweets/",
+            headers={"api-key": "aaa"},
+            json={"tweet_data": text},
+        )
+
+    response = await ac.get("api/tweets/?limit=1", headers={"api-key": "aaa"})
+    cursor = response.json()["next_cursor"]
+    response_2 = await ac.get(
+        "api/tweets/", headers={"api-key": "aaa"}, params={"cursor": cursor}
+    )
+    response_3 = await ac.get(
+        "api/tweets/", headers={"api-key": "aaa"}, params={"cursor": "bad"}
+    )
+
+    assert len(response.json()["tweets"]) == 1
+    assert cursor is not None
+    assert response.json()["tweets"][0]["id"] not in [
+        t["id"] for t in response_2.json()["tweets"]
+    ]
+    assert response_3.status_code == 404
+
+
+async def test_get_tweets_bad_cursor_values(ac: AsyncClient, insert_data):
+    for key in ((1.5, 2), (2**31, 1), (True, 1), ("1", 1)):
+        response = await ac.get(
+            "api/tweets/",
+            headers={"api-key": "aaa"},
+            params={"cursor": encode_cursor(key)},
+        )
+
+        assert response.status_code == 404
+        assert response.json()["error_type"] == "BAD CURSOR"
+
+
+async def test_get_tweet_etag(ac: AsyncClient, insert_data):
+    response = await ac.get("api/tweets/2")
+    etag = response.headers["etag"]
+    response_2 = await ac.get("api/tweets/2", headers={"if-none-match": etag})
+
+    await ac.post("api/tweets/2/likes", headers={"api-key": "sss"})
+    response_3 = await ac.get("api/tweets/2", headers={"if-none-match": etag})
+
+    assert response.status_code == 200
+    assert response_2.status_code == 304
+    assert response_3.status_code == 200
+    assert (
+        response_3.json()["likes_count"] == response.json()["likes_count"] + 1
+    )
+
+
+async def test_post_tweet_with_bad_media(ac: AsyncClient, insert_data):
+    response = await ac.post(
+        "api/tweets/",
+        headers={"api-key": "aaa"},
+        json={"tweet_data": "With picture", "tweet_media_ids": [100]},
+    )
+    assert response.status_code == 404
+    assert response.json()["error_type"] == "BAD MEDIA"
+
+
+async def test_tweets_query_budget(ac: AsyncClient, insert_data):
+    with assert_max_queries(5):
+        response = await ac.get("api/tweets/", headers={"api-key": "aaa"})
+    with assert_max_queries(2):
+        await ac.get("api/tweets/2/likes")
+
+    assert int(response.headers["x-db-query-count"]) <= 5
+
+
+async def test_tweets_read_paths_match(insert_data):
+    user = CurrentUser(id=1, name="Alex")
+    async with async_session_maker() as session:
+        core = await get_tweets(session=session, user=user)
+        orm = await get_tweets_orm(session=session, user=user)
+
+    assert core["tweets"]
+    assert TweetListOutSchema.parse_obj(core) == TweetListOutSchema.parse_obj(
+        orm
+    )
+
+
+async def test_get_tweets_composed_from_fragments(
+    ac: AsyncClient, insert_data
+):
+    response = await ac.get("api/tweets/", headers={"api-key": "aaa"})
+    async with async_session_maker() as session:
+        expected = await get_tweets(
+            session=session, user=CurrentUser(id=1, name="Alex")
+        )
+
+    assert response.status_code == 200
+    assert response.json() == expected
+
+
+def plan_nodes(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+async def test_feed_timeline_branch_plan(insert_data):
+    # На таблицах из пары строк планировщик и так выберет полный
+    # просмотр, поэтому он запрещается. Сортировка не запрещается:
+    # если порядок ветви не дает индекс, в плане останется Sort
+    materialized = feed_branches(
+        user_id=1, limit=11, after=(10, 100), since_id=0
+    )[0]
+    sql = materialized.compile(
+        dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    async with async_session_maker() as session:
+        for setting in ("enable_seqscan", "enable_bitmapscan"):
+            await session.execute(
+                sqlalchemy.text(f"SET LOCAL {setting} = off")
+            )
+        plan = (
+            await session.execute(
+                sqlalchemy.text(f"EXPLAIN (FORMAT JSON) {sql}")
+            )
+        ).scalar_one()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    limit, *scans = plan_nodes(plan[0]["Plan"])
+    assert limit["Node Type"] == "Limit"
+    assert [scan["Node Type"] for scan in scans] in (
+        ["Index Scan"],
+        ["Index Only Scan"],
+    )
+    assert scans[0]["Index Name"] == "ix_timelines_user_id_popularity"
+
+
+def batch_statuses(response):
+    return [(item["id"], item["status"]) for item in response.json()["items"]]
+
+
+async def test_batch_likes(ac: AsyncClient, insert_data):
+    response = await ac.post(
+        "api/tweets/likes:batch",
+        headers={"api-key": "aaa"},
+        json={"like": [2, 3, 999]},
+    )
+    response_2 = await ac.post(
+        "api/tweets/likes:batch",
+        headers={"api-key": "aaa"},
+        json={"like": [2], "unlike": [3, 999]},
+    )
+    response_3 = await ac.post(
+        "api/tweets/likes:batch",
+        headers={"api-key": "aaa"},
+        json={"like": [2], "unlike": [2]},
+    )
+    likes = await ac.get("api/tweets/2/likes")
+
+    assert batch_statuses(response) == [
+        (2, "applied"),
+        (3, "applied"),
+        (999, "not_found"),
+    ]
+    assert batch_statuses(response_2) == [
+        (2, "unchanged"),
+        (3, "applied"),
+        (999, "not_found"),
+    ]
+    assert response_3.status_code == 422
+    assert likes.json()["likes_count"] == 2
+
+
+async def test_post_like_idempotency_key(ac: AsyncClient, insert_data):
+    headers = {"api-key": "sss", "idempotency-key": "like-tweet-3"}
+    response = await ac.post("api/tweets/3/likes", headers=headers)
+    response_2 = await ac.post("api/tweets/3/likes", headers=headers)
+    response_3 = await ac.post(
+        "api/tweets/3/likes", headers={"api-key": "sss"}
+    )
+    response_4 = await ac.post(
+        "api/tweets/999/likes", headers={"api-key": "sss"}
+    )
+
+    assert response.status_code == 200
+    assert response_2.status_code == 200
+    assert response_2.headers["idempotent-replayed"] == "true"
+    assert response_3.json()["error_type"] == "BAD LIKE"
+    assert response_4.json()["error_type"] == "NO TWEET"
+
+
+async def test_idempotency_key_claim():
+    async with async_session_maker() as session:
+        claimed = await claim_key(session, "claim-once")
+        claimed_2 = await claim_key(session, "claim-once")
+        pending = await get_stored(session, "claim-once")
+
+        # Маркер упавшего запроса истекает, и ключ занимается заново
+        await session.execute(
+            sqlalchemy.update(idempotency_keys)
+            .where(idempotency_keys.c.key == "claim-once")
+            .values(expires_at=sqlalchemy.func.now() - timedelta(seconds=1))
+        )
+        await session.commit()
+        expired = await get_stored(session, "claim-once")
+        pruned = await prune_idempotency_keys(session)
+        claimed_3 = await claim_key(session, "claim-once")
+
+    assert claimed is True
+    assert claimed_2 is False
+    assert pending is PENDING
+    assert expired is MISSING
+    assert pruned == 1
+    assert claimed_3 is True
+
+
+async def test_like_write_behind(ac: AsyncClient, insert_data):
+    writer = LikeWriteBehind(
+        session_maker=async_session_maker, flush_size=100, flush_interval=60
+    )
+    response = await ac.post(
+        "api/tweets/",
+        headers={"api-key": "sss"},
+        json={"tweet_data": "Write-behind", "tweet_media_ids": []},
+    )
+    tweet_id = response.json()["tweet_id"]
+    alex, petr = CurrentUser(id=1, name="Alex"), CurrentUser(id=2, name="Petr")
+
+    async with async_session_maker() as session:
+        await writer.submit(session, alex, tweet_id, liked=True)
+        await writer.submit(session, petr, tweet_id, liked=True)
+        await writer.submit(session, petr, tweet_id, liked=False)
+        await writer.submit(session, petr, tweet_id, liked=True)
+        errors = []
+        # Те же ошибки, что у синхронной записи: повторный лайк,
+        # снятие несуществующего лайка, лайк несуществующего твита
+        for user, liked_tweet_id, liked in (
+            (alex, tweet_id, True),
+            (CurrentUser(id=3, name="Nobody"), tweet_id, False),
+            (alex, 999, True),
+        ):
+            try:
+                await writer.submit(session, user, liked_tweet_id, liked)
+            except BackendExeption as e:
+                errors.append(e.error_type)
+    pending = len(writer)
+    await writer.close()
+    likes = await ac.get(f"api/tweets/{tweet_id}/likes")
+
+    assert errors == ["BAD LIKE", "BAD LIKE DELETE", "NO TWEET"]
+    assert pending == 2
+    assert len(writer) == 0
+    assert likes.json()["likes_count"] == 2
+    assert sorted(like["user_id"] for like in likes.json()["likes"]) == [1, 2]
+
+
+async def test_batch_likes_supersede_write_behind(
+    ac: AsyncClient, insert_data, monkeypatch
+):
+    writer = LikeWriteBehind(
+        session_maker=async_session_maker, flush_size=100, flush_interval=60
+    )
+    monkeypatch.setattr(tweet_routes, "like_writer", writer)
+    response = await ac.post(
+        "api/tweets/",
+        headers={"api-key": "sss"},
+        json={"tweet_data": "Batch after write-behind", "tweet_media_ids": []},
+    )
+    tweet_id = response.json()["tweet_id"]
+
+    # Отложенный лайк, затем пакетное снятие того же лайка
+    like = await ac.post(
+        f"api/tweets/{tweet_id}/likes", headers={"api-key": "aaa"}
+    )
+    pending = len(writer)
+    batch = await ac.post(
+        "api/tweets/likes:batch",
+        headers={"api-key": "aaa"},
+        json={"unlike": [tweet_id]},
+    )
+    pending_2 = len(writer)
+    await writer.close()
+    likes = await ac.get(f"api/tweets/{tweet_id}/likes")
+
+    assert like.status_code == 200
+    assert pending == 1
+    assert batch_statuses(batch) == [(tweet_id, "unchanged")]
+    assert pending_2 == 0
+    assert likes.json()["likes_count"] == 0
+
+
+async def test_reconcile_likes_count(ac: AsyncClient, insert_data):
+    async with async_session_maker() as session:
+        await reconcile_likes_count(session=session)
+        q = await session.execute(
+            sqlalchemy.select(Tweet.id).order_by(Tweet.id)
+        )
+        tweet_ids = q.scalars().all()
+        corrupted = [tweet_ids[0], tweet_ids[-1]]
+        await session.execute(
+            sqlalchemy.update(Tweet)
+            .where(Tweet.id.in_(corrupted))
+            .values(likes_count=Tweet.likes_count + 5)
+        )
+        await session.commit()
+
+        # Пачки по два твита: испорченные счетчики в первой и последней
+        repaired = await reconcile_likes_count(session=session, batch_size=2)
+        actual = (
+            sqlalchemy.select(sqlalchemy.func.count(Like.id))
+            .where(Like.tweet_id == Tweet.id)
+            .scalar_subquery()
+        )
+        q = await session.execute(
+            sqlalchemy.select(sqlalchemy.func.count()).where(
+                Tweet.likes_count != actual
+            )
+        )
+        wrong = q.scalar_one()
+
+    assert len(tweet_ids) > 2
+    assert repaired == 2
+    assert wrong == 0
+
+
+async def test_search_tweets(ac: AsyncClient, insert_data):
+    tweet_ids = []
+    for content in ("Мои кошки спят", "Кошка видит кошку", "Собака лает"):
+        response = await ac.post(
+            "api/tweets/",
+            headers={"api-key": "sss"},
+            json={"tweet_data": content, "tweet_media_ids": []},
+        )
+        tweet_ids.append(response.json()["tweet_id"])
+
+    page = await ac.get("api/tweets/search", params={"q": "кошка", "limit": 1})
+    page_2 = await ac.get(
+        "api/tweets/search",
+        params={
+            "q": "кошка",
+            "limit": 1,
+            "cursor": page.json()["next_cursor"],
+        },
+    )
+    empty = await ac.get("api/tweets/search", params={"q": ""})
+
+    found = page.json()["tweets"] + page_2.json()["tweets"]
+    assert sorted(tweet["id"] for tweet in found) == tweet_ids[:2]
+    assert page_2.json()["next_cursor"] is None
+    assert empty.status_code == 422
+
+
+async def test_hashtags_and_mentions(ac: AsyncClient, insert_data):
+    tweet_ids = []
+    for content in ("Привет, @Alex! #Разбор", "#разбор #разбор ещё раз"):
+        response = await ac.post(
+            "api/tweets/",
+            headers={"api-key": "sss"},
+            json={"tweet_data": content, "tweet_media_ids": []},
+        )
+        tweet_ids.append(response.json()["tweet_id"])
+    await ac.post(
+        f"api/tweets/{tweet_ids[0]}/likes", headers={"api-key": "sss"}
+    )
+
+    recent = await ac.get("api/tweets/tags/РАЗБОР", params={"limit": 1})
+    recent_2 = await ac.get(
+        "api/tweets/tags/разбор",
+        params={"limit": 1, "cursor": recent.json()["next_cursor"]},
+    )
+    popular = await ac.get(
+        "api/tweets/tags/разбор", params={"order": "popular"}
+    )
+    mentioned = await ac.get("api/tweets/mentions", headers={"api-key": "aaa"})
+    bad_order = await ac.get(
+        "api/tweets/mentions",
+        headers={"api-key": "aaa"},
+        params={"order": "oldest"},
+    )
+    async with async_session_maker() as session:
+        await backfill_tweet_entities(session=session, batch_size=2)
+    again = await ac.get("api/tweets/tags/разбор")
+
+    assert [t["id"] for t in recent.json()["tweets"]] == [tweet_ids[1]]
+    assert [t["id"] for t in recent_2.json()["tweets"]] == [tweet_ids[0]]
+    assert recent_2.json()["next_cursor"] is None
+    assert [t["id"] for t in popular.json()["tweets"]] == tweet_ids
+    assert tweet_ids[0] in [t["id"] for t in mentioned.json()["tweets"]]
+    assert bad_order.status_code == 422
+    assert len(again.json()["tweets"]) == 2
+
+
+async def test_feed_delta(ac: AsyncClient, insert_data):
+    headers = {"api-key": "aaa"}
+    response = await ac.post(
+        "api/tweets/", headers=headers, json={"tweet_data": "Liked later"}
+    )
+    liked_id = response.json()["tweet_id"]
+
+    full = await ac.get(
+        "api/tweets/", headers=headers, params={"since_version": 0}
+    )
+    version = full.json()["version"]
+    unchanged = await ac.get(
+        "api/tweets/", headers=headers, params={"since_version": version}
+    )
+
+    new_ids = []
+    for content in ("Delta 1", "Delta 2"):
+        response = await ac.post(
+            "api/tweets/", headers=headers, json={"tweet_data": content}
+        )
+        new_ids.append(response.json()["tweet_id"])
+    await ac.delete(f"api/tweets/{new_ids[1]}", headers=headers)
+    await ac.post(f"api/tweets/{liked_id}/likes", headers={"api-key": "sss"})
+    delta = await ac.get(
+        "api/tweets/", headers=headers, params={"since_version": version}
+    )
+    newer = await ac.get(
+        "api/tweets/", headers=headers, params={"since_id": liked_id}
+    )
+
+    assert unchanged.json()["resync"] is False
+    assert unchanged.json()["tweets"] == []
+    body = delta.json()
+    assert body["resync"] is False
+    assert body["version"] > version
+    assert [t["id"] for t in body["tweets"]] == [new_ids[0]]
+    assert {"id": liked_id, "likes_count": 1} in body["likes"]
+    assert new_ids[1] in body["deleted"]
+    assert [t["id"] for t in newer.json()["tweets"]] == [new_ids[0]]
@@ -46,3 +46,91 @@ async def test_get_user_me(ac: AsyncClient, insert_data):
     assert response.status_code == 200
     assert response.json()["result"] is True
     assert response_2.status_code == 404
+
+
+async def test_feed_follows_timeline(ac: AsyncClient, insert_data):
+    response = await ac.post(
+        "api/tweets/",
+        headers={"api-key": "sss"},
+        json={"tweet_data": "Hello from Petr"},
+    )
+    tweet_id = response.json()["tweet_id"]
+
+    await ac.post("api/users/2/follow", headers={"api-key": "aaa"})
+    response_2 = await ac.get("api/tweets/", headers={"api-key": "aaa"})
+
+    await ac.delete("api/users/2/follow", headers={"api-key": "aaa"})
+    response_3 = await ac.get("api/tweets/", headers={"api-key": "aaa"})
+
+    assert tweet_id in [t["id"] for t in response_2.json()["tweets"]]
+    assert tweet_id not in [t["id"] for t in response_3.json()["tweets"]]
+
+
+async def test_get_user_followers(ac: AsyncClient, insert_data):
+    await ac.post("api/users/1/follow", headers={"api-key": "sss"})
+    response = await ac.get("api/users/1/followers")
+    response_2 = await ac.get("api/users/2/following?limit=1")
+    response_3 = await ac.get("api/users/3/followers")
+
+    assert response.json()["users"] == [{"id": 2, "name": "Petr"}]
+    assert response_2.json()["users"][0]["id"] == 1
+    assert response_3.status_code == 404
+
+
+async def test_batch_follows(ac: AsyncClient, insert_data):
+    response = await ac.post(
+        "api/users/follow:batch",
+        headers={"api-key": "aaa"},
+        json={"follow": [2, 1, 404]},
+    )
+    response_2 = await ac.post(
+        "api/users/follow:batch",
+        headers={"api-key": "aaa"},
+        json={"unfollow": [2, 2]},
+    )
+    followers = await ac.get("api/users/2/followers")
+
+    assert [
+        (item["id"], item["status"]) for item in response.json()["items"]
+    ] == [(2, "applied"), (1, "forbidden"), (404, "not_found")]
+    assert response_2.json()["items"] == [
+        {"id": 2, "action": "unfollow", "status": "applied"}
+    ]
+    assert followers.json()["users"] == []
+
+
+async def test_get_user_since_version(ac: AsyncClient, insert_data):
+    first = await ac.get("api/users/2", params={"since_version": 0})
+    version = first.json()["version"]
+    unchanged = await ac.get("api/users/2", params={"since_version": version})
+
+    await ac.post("api/users/2/follow", headers={"api-key": "aaa"})
+    changed = await ac.get("api/users/2", params={"since_version": version})
+    await ac.delete("api/users/2/follow", headers={"api-key": "aaa"})
+
+    assert first.json()["changed"] is True
+    assert first.json()["user"]["id"] == 2
+    assert unchanged.json() == {
+        "result": True,
+        "changed": False,
+        "version": unchanged.json()["version"],
+    }
+    assert changed.json()["changed"] is True
+    assert changed.json()["user"]["followers_count"] >= 1
+
+
+async def test_following_count(ac: AsyncClient, insert_data):
+    headers = {"api-key": "aaa"}
+    await ac.delete("api/users/2/follow", headers=headers)
+    before = await ac.get("api/users/me", headers=headers)
+
+    await ac.post("api/users/2/follow", headers=headers)
+    followed = await ac.get("api/users/me", headers=headers)
+    await ac.post(
+        "api/users/follow:batch", headers=headers, json={"unfollow": [2]}
+    )
+    unfollowed = await ac.get("api/users/me", headers=headers)
+
+    count = before.json()["user"]["following_count"]
+    assert followed.json()["user"]["following_count"] == count + 1
+    assert unfollowed.json()["user"]["following_count"] == count